@@ -1,12 +1,20 @@
+import os
+import time
+import datetime
+import functools
 import traceback
-from flask import render_template, request, redirect, url_for
+from flask import render_template, request, redirect, url_for, jsonify, g, Response, make_response
 import logging.config
 from flask import Flask
-import pandas as pd
-import pickle
+import numpy as np
 
-from src.train_model import predict_cluster
-from src.bean_db import BeanAttributes
+from src.bean_db import BeanAttributes, CatalogVersion, UserQuery
+from src.model_registry import ModelRegistry
+from src.recommend_cache import TopKCache
+from src.query_log import QueryLog
+from src.db_engine import engine_settings, engine_options, configure_engine
+from src.instrument import metrics
+from src.profiling import Profiler
 from flask_sqlalchemy import SQLAlchemy
 
 
@@ -16,15 +24,88 @@ app = Flask(__name__, template_folder="app/templates")
 # Configure flask app from flask_config.py
 app.config.from_pyfile('config/flaskconfig.py')
 
-logging.config.fileConfig(app.config["LOGGING_CONFIG"])
+logging.config.fileConfig(app.config["LOGGING_CONFIG"], disable_existing_loggers=False)
 logger = logging.getLogger(app.config["APP_NAME"])
 logger.debug('Test log')
 
-# Initialize the database
+# Initialize the database with the same pool options and SQLite pragmas as bean_db.py
+engine_config = engine_settings(app.config)
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"], engine_config)
 db = SQLAlchemy(app)
+configure_engine(db.engine, engine_config)
+
+# Load the feature scaler and the newest model once per worker process
+registry = ModelRegistry(app.config["MODEL_DIR"], app.config["FEATURE_SCALER_PATH"],
+                         k=app.config["MODEL_K"], check_interval=app.config["MODEL_CHECK_INTERVAL"])
+try:
+    registry.load()
+except Exception as e:
+    logger.error("Not able to load the model at startup, retrying on the first request")
+    logger.error(e)
+
+# Keep the top beans of the catalog and of every cluster in memory until the catalog version changes
+top_beans = TopKCache(db.engine, BeanAttributes.__table__, CatalogVersion.__table__, app.config["MAX_ROWS_SHOW"],
+                      check_interval=app.config["CATALOG_CHECK_INTERVAL"])
+try:
+    top_beans.load()
+except Exception as e:
+    logger.error("Not able to cache the catalog at startup, retrying on the first request")
+    logger.error(e)
+
+# Write the user queries to the database in batches from a background thread
+query_log = QueryLog(db.engine, UserQuery.__table__, max_queue=app.config["QUERY_LOG_MAX_QUEUE"],
+                     batch_size=app.config["QUERY_LOG_BATCH_SIZE"], flush_ms=app.config["QUERY_LOG_FLUSH_MS"],
+                     block_ms=app.config["QUERY_LOG_BLOCK_MS"])
+
+# Time the requests and their phases, exported with the cache and query log counters at /metrics
+metrics.enabled = app.config["METRICS_ENABLED"]
+metrics.register_gauges('top_beans_cache', top_beans.stats)
+metrics.register_gauges('query_log', query_log.stats)
+
+
+@app.before_request
+def start_timer():
+    if metrics.enabled:
+        g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    start = g.get('request_start')
+    if start is not None:
+        metrics.observe('request_seconds', time.perf_counter() - start, endpoint=request.endpoint or 'none',
+                        method=request.method, status=response.status_code)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Latency histograms of the requests and their phases, memory and cache gauges of this worker.
+    Returns: the metrics in the Prometheus text exposition format
+    """
+
+    return Response(metrics.prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+# Profile a sample of the requests, and every request of an admin sending the X-Profile-Token header
+profiler = Profiler(app.config["PROFILE_DIR"], app.config["PROFILE_SAMPLE_RATE"], app.config["PROFILE_TOP_N"],
+                    app.config["PROFILE_MAX_FILES"], app.config["PROFILE_ADMIN_TOKEN"])
+
+
+def profiled(view):
+    """Profile the sampled and admin requests of a view, whose profile file is named in the X-Profile header."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with profiler.profile(view.__name__, forced=profiler.is_admin(request.headers.get('X-Profile-Token'))) as p:
+            response = make_response(view(*args, **kwargs))
+        if p.path is not None:
+            response.headers['X-Profile'] = os.path.basename(p.path)
+        return response
+    return wrapper
 
 
 @app.route('/', methods=['POST', 'GET'])
+@profiled
 def index():
     """Main view that lists beans in the database.
     Create view into index page that uses data queried from BeanAttribute database and
@@ -34,49 +115,31 @@ def index():
 
     if request.method == 'POST':
         try:
-            # Insert the input entry into the database
-            entries = pd.DataFrame({'Aroma': [request.form['aroma']],
-                                    'Aftertaste': [request.form['aftertaste']],
-                                    'Acidity': [request.form['acidity']],
-                                    'Sweetness': [request.form['sweetness']],
-                                    'Moisture': [request.form['moisture']]})
-
-            sc = pickle.load(open('models/feature_scaler.pkl', 'rb'))
-            model = pickle.load(open('models/kmeans-5-2020-06-08.pkl', 'rb'))
-            cluster_pred = predict_cluster(sc, entries, model)[0]
-
-            bean1 = BeanAttributes(
-                                   species='Unknown',
-                                   owner='Unknown',
-                                   country='Unknown',
-                                   farm_name='Unknown',
-                                   company='Unknown',
-                                   region='Unknown',
-                                   producer='Unknown',
-                                   grading_date='Unknown',
-                                   processing_method='Unknown',
-                                   aroma=request.form['aroma'],
-                                   flavor=0,
-                                   aftertaste=0,
-                                   acidity=0,
-                                   body=0,
-                                   balance=0,
-                                   uniformity=0,
-                                   cleancup=0,
-                                   sweetness=request.form['sweetness'],
-                                   total_cup_point=0,
-                                   moisture=request.form['moisture'],
-                                   color='Unknown',
-                                   cluster=cluster_pred)
-            db.session.add(bean1)
-            db.session.commit()
-            logger.info("New cluster predicted: {}".format(cluster_pred))
-
-            # Query the beans based on the predicted cluster of input features
-            beans = db.session.query(BeanAttributes).\
-                filter(BeanAttributes.cluster == 1).\
-                order_by(BeanAttributes.total_cup_point.desc()).limit(app.config["MAX_ROWS_SHOW"]).all()
-            return render_template('index.html', beans=beans)
+            entries = [request.form['aroma'], request.form['aftertaste'], request.form['acidity'],
+                       request.form['sweetness'], request.form['moisture']]
+
+            with metrics.timer('request_phase_seconds', endpoint='index', phase='model'):
+                loaded = registry.get()
+            with metrics.timer('request_phase_seconds', endpoint='index', phase='predict'):
+                cluster_pred = loaded.predictor.predict(entries)[0]
+
+            # Log the query in the background, the response does not wait for the database
+            with metrics.timer('request_phase_seconds', endpoint='index', phase='log'):
+                query_log.submit({'created_at': datetime.datetime.utcnow(),
+                                  'aroma': float(request.form['aroma']),
+                                  'aftertaste': float(request.form['aftertaste']),
+                                  'acidity': float(request.form['acidity']),
+                                  'sweetness': float(request.form['sweetness']),
+                                  'moisture': float(request.form['moisture']),
+                                  'cluster': int(cluster_pred),
+                                  'model_version': loaded.version})
+            logger.info("New cluster predicted: {} (model {})".format(cluster_pred, loaded.version))
+
+            # Get the top beans of the predicted cluster from the cache, the nearest beans are served by /api/similar
+            with metrics.timer('request_phase_seconds', endpoint='index', phase='query'):
+                beans = top_beans.get(int(cluster_pred))
+            with metrics.timer('request_phase_seconds', endpoint='index', phase='render'):
+                return render_template('index.html', beans=beans)
         except Exception as e:
             traceback.print_exc()
             logger.error("Not able to add mew record")
@@ -85,16 +148,158 @@ def index():
 
     else:
         try:
-            # Query the beans and sort the displayed records by total cup point
-            beans = db.session.query(BeanAttributes).order_by(BeanAttributes.total_cup_point.desc()).\
-                limit(app.config["MAX_ROWS_SHOW"])
+            # Get the top beans of the catalog by total cup point
+            with metrics.timer('request_phase_seconds', endpoint='index', phase='query'):
+                beans = top_beans.get()
             logger.info("Successfully queried from the database")
-            return render_template('index.html', beans=beans)
+            with metrics.timer('request_phase_seconds', endpoint='index', phase='render'):
+                return render_template('index.html', beans=beans)
 
         except Exception as e:
             logger.warning("Not able to display tracks, error page returned", e)
             return render_template('error.html')
 
 
+def parse_profiles(payload, feature_names, max_profiles):
+    """Convert the flavor profiles of a prediction request to a feature matrix.
+    Args:
+        payload (`dict`): Request body with `profiles`, a list of objects keyed by feature name or of lists
+            of feature values in the order of `feature_names`.
+        feature_names (`:obj:`list` of :obj:`str`): Names of the model features.
+        max_profiles (`int`): Maximum number of profiles per request.
+    Returns:
+        features (`numpy.ndarray`): Array of shape (number of profiles, number of features).
+    """
+
+    profiles = payload.get('profiles') if isinstance(payload, dict) else None
+    if not isinstance(profiles, list) or not profiles:
+        raise ValueError("Expected a non-empty list of profiles")
+    if len(profiles) > max_profiles:
+        raise ValueError("At most {} profiles can be scored per request".format(max_profiles))
+
+    message = "Each profile needs the features {}".format(', '.join(feature_names))
+    try:
+        if isinstance(profiles[0], dict):
+            profiles = [[profile[name] for name in feature_names] for profile in profiles]
+        features = np.array(profiles, dtype=float)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(message)
+    if features.ndim != 2 or features.shape[1] != len(feature_names):
+        raise ValueError(message)
+    if not np.isfinite(features).all():
+        raise ValueError("Feature values must be finite numbers")
+    return features
+
+
+def parse_top_n(payload, max_rows):
+    """Read the number of beans asked for by a request.
+    Args:
+        payload (`dict`): Request body, with an optional `top_n`.
+        max_rows (`int`): Maximum number of beans returned per profile, also the default.
+    Returns:
+        top_n (`int`): Number of beans to return, at most `max_rows`.
+    """
+
+    top_n = int(payload.get('top_n', max_rows))
+    if top_n < 1:
+        raise ValueError("top_n must be a positive integer")
+    return min(top_n, max_rows)
+
+
+@app.route('/api/predict', methods=['POST'])
+def api_predict():
+    """Predict the clusters of a batch of flavor profiles and return the top beans of each predicted cluster.
+    Returns: JSON with the model version, one cluster per profile and the top beans keyed by cluster
+    """
+
+    try:
+        payload = request.get_json(force=True, silent=True)
+        features = parse_profiles(payload, app.config["FEATURE_NAMES"], app.config["MAX_PREDICT_ROWS"])
+        top_n = parse_top_n(payload, app.config["MAX_ROWS_SHOW"])
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("Invalid prediction request: {}".format(e))
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        loaded = registry.get()
+        clusters = loaded.predictor.predict(features)
+        beans = {str(cluster): top_beans.get(int(cluster))[:top_n] for cluster in np.unique(clusters)}
+        logger.info("Predicted clusters for {} profiles (model {})".format(len(clusters), loaded.version))
+        return jsonify({'model': loaded.version, 'clusters': clusters.tolist(), 'beans': beans})
+    except Exception as e:
+        logger.error("Not able to predict the clusters")
+        logger.error(e)
+        return jsonify({'error': 'Prediction failed'}), 500
+
+
+def similar_beans(index, profiles, k):
+    """Look up the beans nearest to each flavor profile in the catalog.
+    Args:
+        index (`src.similarity.SimilarityIndex`): Similarity index of the model being served.
+        profiles (`numpy.ndarray`): Unscaled features, one row per profile in the order of `FEATURE_NAMES`.
+        k (`int`): Number of beans per profile.
+    Returns:
+        beans (`:obj:`list` of :obj:`list` of :obj:`dict`): Rows of `bean_attributes` with their `distance` to each
+            profile, nearest first. Beans removed from the catalog since the index was built are left out.
+    """
+
+    results = [index.search(profile, k=k, n_probe=app.config["SIMILAR_N_PROBE"]) for profile in profiles]
+    ids = {int(bean_id) for bean_ids, _ in results for bean_id in bean_ids}
+    table = BeanAttributes.__table__
+    with db.engine.connect() as conn:
+        rows = {row['id']: dict(row) for row in conn.execute(table.select().where(table.c.id.in_(ids)))}
+
+    beans = []
+    for bean_ids, distances in results:
+        beans.append([dict(rows[int(bean_id)], distance=float(distance))
+                      for bean_id, distance in zip(bean_ids, distances) if int(bean_id) in rows])
+    return beans
+
+
+@app.route('/api/similar', methods=['POST'])
+def api_similar():
+    """Find the beans nearest to a batch of flavor profiles in the scaled feature space of the model.
+    Returns: JSON with the model version, whether the search was exact and the nearest beans of each profile
+    """
+
+    try:
+        payload = request.get_json(force=True, silent=True)
+        features = parse_profiles(payload, app.config["FEATURE_NAMES"], app.config["MAX_SIMILAR_PROFILES"])
+        top_n = parse_top_n(payload, app.config["MAX_ROWS_SHOW"])
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("Invalid similarity request: {}".format(e))
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        loaded = registry.get()
+        if loaded.index is None:
+            return jsonify({'error': 'No similarity index for model {}'.format(loaded.version)}), 503
+        beans = similar_beans(loaded.index, features, top_n)
+        logger.info("Found similar beans for {} profiles (model {})".format(len(features), loaded.version))
+        return jsonify({'model': loaded.version, 'exact': loaded.index.is_exact, 'beans': beans})
+    except Exception as e:
+        logger.error("Not able to find similar beans")
+        logger.error(e)
+        return jsonify({'error': 'Similarity search failed'}), 500
+
+
+@app.route('/api/clusters', methods=['GET'])
+def api_clusters():
+    """Describe the clusters of the served model from the statistics saved by train_model.py.
+    Returns: JSON with the model version and, for every cluster, its number of beans and the count, mean, standard
+        deviation, minimum, maximum and quantiles of every feature
+    """
+
+    try:
+        loaded = registry.get()
+        if loaded.stats is None:
+            return jsonify({'error': 'No cluster statistics for model {}'.format(loaded.version)}), 503
+        return jsonify({'model': loaded.version, 'clusters': loaded.stats.summary(app.config["CLUSTER_QUANTILES"])})
+    except Exception as e:
+        logger.error("Not able to describe the clusters")
+        logger.error(e)
+        return jsonify({'error': 'Cluster statistics failed'}), 500
+
+
 if __name__ == '__main__':
     app.run(debug=app.config["DEBUG"], port=app.config["PORT"], host=app.config["HOST"])
\ No newline at end of file
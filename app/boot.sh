@@ -1,4 +1,12 @@
 #!/usr/bin/env bash
 
 python3 src/bean_db.py
-python3 app.py
\ No newline at end of file
+
+# APP_SERVER=flask runs the single-process development server, the default is gunicorn with the settings of
+# config/gunicorn.conf.py (workers and threads from GUNICORN_WORKERS and GUNICORN_THREADS)
+if [ "${APP_SERVER:-gunicorn}" = "flask" ]; then
+    python3 app.py
+else
+    export FLASK_DEBUG=${FLASK_DEBUG:-false}
+    exec gunicorn -c config/gunicorn.conf.py app:app
+fi
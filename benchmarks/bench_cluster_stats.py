@@ -0,0 +1,66 @@
+"""Time of the per-cluster statistics evaluate_model.py needs: pandas groupby over the cluster table against the cluster
+statistics artifact (`src/cluster_stats.py`), and of adding newly appended beans to the statistics.
+
+Run from the root of the repository:
+
+    python3 benchmarks/bench_cluster_stats.py --sizes 100000 1000000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.append('./src')
+sys.path.append('./benchmarks')
+from cluster_stats import ClusterStats
+from synthetic import synthetic_beans
+
+FEATURE_NAMES = ['aroma', 'aftertaste', 'acidity', 'sweetness', 'moisture']
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+def seconds(func):
+    """Wall time in seconds of calling `func` once, and its result."""
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def groupby_stats(data):
+    """The statistics as evaluate_model.py computed them, plus the quantiles."""
+    grouped = data.groupby('cluster')[FEATURE_NAMES]
+    return (grouped.mean(), data[FEATURE_NAMES].mean(), data.groupby('cluster').count(), grouped.var(),
+            grouped.quantile(QUANTILES))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the cluster statistics artifact against pandas groupby")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000], help="Catalog sizes")
+    parser.add_argument('--append', type=float, default=0.01, help="Fraction of new beans appended to the catalog")
+    args = parser.parse_args()
+
+    print('{:>9} {:>12} {:>12} {:>12} {:>12}'.format('beans', 'groupby (s)', 'build (s)', 'load (s)', 'append (s)'))
+    for size in args.sizes:
+        data = synthetic_beans(size)
+        n_new = max(1, int(size * args.append))
+        old, new = data.iloc[:-n_new], data.iloc[-n_new:]
+        values = data[FEATURE_NAMES].values
+
+        groupby_seconds, _ = seconds(lambda: groupby_stats(data))
+        build_seconds, stats = seconds(lambda: ClusterStats.for_data(FEATURE_NAMES, values).update(
+            data['cluster'].values, values))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stats_path = os.path.join(tmp_dir, 'kmeans-5.stats.npz')
+            stats.save(stats_path)
+            load_seconds, _ = seconds(lambda: ClusterStats.load(stats_path).summary(QUANTILES))
+
+        # New beans are added to the statistics of the old ones instead of recomputing everything
+        old_stats = ClusterStats.for_data(FEATURE_NAMES, values).update(old['cluster'].values,
+                                                                        old[FEATURE_NAMES].values)
+        append_seconds, _ = seconds(lambda: old_stats.update(new['cluster'].values, new[FEATURE_NAMES].values))
+
+        print('{:>9d} {:>12.4f} {:>12.4f} {:>12.4f} {:>12.4f}'.format(size, groupby_seconds, build_seconds,
+                                                                       load_seconds, append_seconds))
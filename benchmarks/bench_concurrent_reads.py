@@ -0,0 +1,124 @@
+"""Read throughput and latency of the app's catalog query while bean_db.py reloads the catalog, with the default
+SQLite engine against the engine of src/db_engine.py (WAL mode, synchronous=NORMAL, memory map, connection pool).
+
+Run from the root of the repository:
+
+    python3 benchmarks/bench_concurrent_reads.py --rows 200000 --readers 4
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+import numpy as np
+import sqlalchemy as sql
+
+sys.path.append('./config')
+sys.path.append('./src')
+sys.path.append('./benchmarks')
+import config
+from bean_db import Base, BeanAttributes, bulk_insert, create_indexes, sync_to_db
+from db_engine import create_engine, engine_settings
+from synthetic import synthetic_beans
+
+MAX_ROWS_SHOW = 15
+
+
+def make_engine(engine_string, tuned):
+    if tuned:
+        return create_engine(engine_string, engine_settings(config))
+    return sql.create_engine(engine_string)
+
+
+def reload_catalog(engine_string, tuned, beans, chunk_size, go):
+    """Load a new version of every row, as the nightly reload does, in its own process, once `go` is set."""
+    go.wait()
+    engine = make_engine(engine_string, tuned)
+    try:
+        sync_to_db(engine, beans, chunk_size)
+    except sql.exc.OperationalError as e:
+        # Without WAL, a writer waiting for readers to let go of the database can time out
+        print('Reload failed: {}'.format(e.orig), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        engine.dispose()
+
+
+def read_loop(engine, stop, latencies, errors, seed):
+    """Query the top beans of random clusters until `stop` is set."""
+    table = BeanAttributes.__table__
+    rng = np.random.RandomState(seed)
+    while not stop.is_set():
+        query = sql.select([table]).where(table.c.cluster == int(rng.randint(0, 5))). \
+            order_by(table.c.total_cup_point.desc()).limit(MAX_ROWS_SHOW)
+        start = time.perf_counter()
+        try:
+            with engine.connect() as conn:
+                conn.execute(query).fetchall()
+            latencies.append((time.perf_counter() - start) * 1000)
+        except sql.exc.OperationalError:
+            errors.append(1)
+
+
+def bench(tuned, beans, new_beans, n_readers, chunk_size):
+    """Time the readers while a reload runs on a fresh database."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine_string = 'sqlite:///{}'.format(os.path.join(tmp_dir, 'bean.db'))
+        engine = make_engine(engine_string, tuned)
+        Base.metadata.create_all(engine)
+        bulk_insert(engine, beans, chunk_size)
+        create_indexes(engine)
+
+        stop = threading.Event()
+        latencies, errors = [], []
+        readers = [threading.Thread(target=read_loop, args=(engine, stop, latencies, errors, seed))
+                   for seed in range(n_readers)]
+        # Fork the loader before the readers start, a process forked while other threads hold locks can deadlock
+        go = multiprocessing.Event()
+        loader = multiprocessing.Process(target=reload_catalog,
+                                         args=(engine_string, tuned, new_beans, chunk_size, go))
+        loader.start()
+
+        for reader in readers:
+            reader.start()
+        start = time.perf_counter()
+        go.set()
+        loader.join()
+        elapsed = time.perf_counter() - start
+        failed = loader.exitcode != 0
+        stop.set()
+        for reader in readers:
+            reader.join()
+        engine.dispose()
+
+    return {'load_s': elapsed,
+            'reads_per_s': len(latencies) / elapsed,
+            'p50_ms': np.percentile(latencies, 50) if latencies else float('nan'),
+            'p99_ms': np.percentile(latencies, 99) if latencies else float('nan'),
+            'errors': len(errors),
+            'reload': 'failed' if failed else 'ok'}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark catalog reads during a reload of the catalog")
+    parser.add_argument('--rows', type=int, default=200000, help="Number of beans in the catalog")
+    parser.add_argument('--readers', type=int, default=4, help="Number of concurrent reader threads")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="Rows per executemany batch of the reload")
+    args = parser.parse_args()
+
+    beans = synthetic_beans(args.rows)
+    # The reload changes the score of every bean
+    new_beans = beans.copy()
+    new_beans['total_cup_point'] = (new_beans['total_cup_point'] + 0.01).round(2)
+
+    print('{:<10} {:>8} {:>10} {:>12} {:>10} {:>10} {:>8}'.format('engine', 'reload', 'load (s)', 'reads/s',
+                                                                  'p50 (ms)', 'p99 (ms)', 'errors'))
+    for name, tuned in [('default', False), ('tuned', True)]:
+        results = bench(tuned, beans, new_beans, args.readers, args.chunk_size)
+        print('{:<10} {:>8} {:>10.2f} {:>12.1f} {:>10.2f} {:>10.2f} {:>8d}'.format(
+            name, results['reload'], results['load_s'], results['reads_per_s'], results['p50_ms'], results['p99_ms'],
+            results['errors']))
@@ -0,0 +1,64 @@
+"""Cold-start import time of the Flask app, failing when it exceeds a budget or loads the training dependencies.
+
+Run from the root of the repository:
+
+    python3 benchmarks/bench_import.py --budget-ms 1000
+
+Exits with status 1 if the median import time is over the budget or if any forbidden module is imported, so that it
+can gate a build.
+"""
+import sys
+import argparse
+import subprocess
+
+import numpy as np
+
+FORBIDDEN = ['pandas', 'sklearn', 'matplotlib', 'seaborn', 'scipy', 'pyarrow']
+
+
+def import_profile(module):
+    """Import a module in a fresh interpreter with `-X importtime`.
+    Args:
+        module (`str`): Name of the module to import.
+    Returns:
+        timings (`:obj:`list` of :obj:`tuple`): Self and cumulative microseconds and name of every imported module.
+    """
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings.append((int(self_us), int(cumulative_us), name.strip()))
+    return timings
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the cold-start import time of the app")
+    parser.add_argument('--module', default='app', help="Module to import")
+    parser.add_argument('--repeats', type=int, default=5, help="Number of fresh interpreters to time")
+    parser.add_argument('--budget-ms', type=float, default=1000, help="Maximum median import time in milliseconds")
+    parser.add_argument('--top', type=int, default=10, help="Number of slowest imports to print")
+    args = parser.parse_args()
+
+    runs = [import_profile(args.module) for _ in range(args.repeats)]
+    totals_ms = [next(cumulative for _, cumulative, name in timings if name == args.module) / 1000
+                 for timings in runs]
+    median_ms = float(np.median(totals_ms))
+
+    print('{:<40} {:>10}'.format('slowest imports (self ms)', ''))
+    for self_us, _, name in sorted(runs[-1], reverse=True)[:args.top]:
+        print('  {:<38} {:>10.1f}'.format(name, self_us / 1000))
+    print('{:<40} {:>10.1f}'.format('import {} median (ms)'.format(args.module), median_ms))
+    print('{:<40} {:>10.1f}'.format('budget (ms)', args.budget_ms))
+
+    imported = {name for _, _, name in runs[-1]}
+    forbidden = sorted(name for name in FORBIDDEN if name in imported)
+    if forbidden:
+        print('FAIL: importing {} loads {}'.format(args.module, ', '.join(forbidden)))
+    if median_ms > args.budget_ms:
+        print('FAIL: import time is over the budget')
+    sys.exit(1 if forbidden or median_ms > args.budget_ms else 0)
@@ -0,0 +1,73 @@
+"""Latency of the app.py catalog queries against table size, with and without the bean_attributes indexes.
+
+Run from the root of the repository:
+
+    python3 benchmarks/bench_indexes.py --sizes 1000 10000 100000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import sqlalchemy as sql
+
+sys.path.append('./src')
+sys.path.append('./benchmarks')
+from bean_db import BeanAttributes, bulk_insert, create_indexes
+from synthetic import synthetic_beans
+
+MAX_ROWS_SHOW = 15
+
+
+def time_query(session_query, repeats):
+    """Median latency in milliseconds of running a query `repeats` times."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        session_query().all()
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+
+def bench_size(n_rows, repeats):
+    """Time the cluster and listing queries on a fresh SQLite table of `n_rows` beans."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = sql.create_engine('sqlite:///{}'.format(os.path.join(tmp_dir, 'bean.db')))
+        # Create the table without the indexes declared on the model
+        table = BeanAttributes.__table__
+        sql.Table(table.name, sql.MetaData(), *[column.copy() for column in table.columns]).create(engine)
+        bulk_insert(engine, synthetic_beans(n_rows), chunk_size=50000)
+        session = sql.orm.sessionmaker(bind=engine)()
+
+        queries = {
+            'cluster_top': lambda: session.query(BeanAttributes).filter(BeanAttributes.cluster == 1).
+                order_by(BeanAttributes.total_cup_point.desc()).limit(MAX_ROWS_SHOW),
+            'listing_top': lambda: session.query(BeanAttributes).
+                order_by(BeanAttributes.total_cup_point.desc()).limit(MAX_ROWS_SHOW),
+        }
+        results = {}
+        for name, query in queries.items():
+            results[(name, 'no_index')] = time_query(query, repeats)
+        create_indexes(engine)
+        for name, query in queries.items():
+            results[(name, 'index')] = time_query(query, repeats)
+        session.close()
+        engine.dispose()
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the catalog queries with and without indexes")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    print('{:>10} {:>12} {:>14} {:>12}'.format('rows', 'query', 'no index (ms)', 'index (ms)'))
+    for n_rows in args.sizes:
+        results = bench_size(n_rows, args.repeats)
+        for name in ['cluster_top', 'listing_top']:
+            print('{:>10} {:>12} {:>14.3f} {:>12.3f}'.format(n_rows, name, results[(name, 'no_index')],
+                                                              results[(name, 'index')]))
@@ -0,0 +1,78 @@
+"""Per-request latency and worker import time of the pickled sklearn pipeline against the NumPy predictor.
+
+Run from the root of the repository:
+
+    python3 benchmarks/bench_inference.py --requests 2000 --batch-size 10000
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+import tempfile
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+from sklearn.cluster import KMeans
+
+sys.path.append('./src')
+from train_model import predict_cluster, save_inference_artifact
+from inference import CentroidPredictor
+
+FEATURE_NAMES = ['Aroma', 'Aftertaste', 'Acidity', 'Sweetness', 'Moisture']
+
+
+def per_call_ms(func, n_calls):
+    """Mean latency in milliseconds of calling `func` `n_calls` times."""
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        func()
+    return (time.perf_counter() - start) * 1000 / n_calls
+
+
+def import_seconds(statement, repeats=3):
+    """Best wall time in seconds of a fresh interpreter running an import statement."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', "import sys; sys.path.append('./src'); " + statement], check=True)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the pickled pipeline against the NumPy predictor")
+    parser.add_argument('--requests', type=int, default=2000, help="Number of single-row requests to time")
+    parser.add_argument('--batch-size', type=int, default=10000, help="Number of rows of the batch to time")
+    args = parser.parse_args()
+
+    data = pd.read_csv('./data/data_clean.csv', usecols=FEATURE_NAMES)[FEATURE_NAMES]
+    scaler = StandardScaler().fit(data)
+    model = KMeans(n_clusters=5, random_state=1218).fit(scaler.transform(data))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        artifact_path = os.path.join(tmp_dir, 'kmeans-5.npz')
+        save_inference_artifact(scaler, model, artifact_path)
+        predictor = CentroidPredictor.load(artifact_path)
+
+    batch = data.values[np.random.RandomState(1218).randint(0, len(data), size=args.batch_size)]
+    assert (predictor.predict(batch) == predict_cluster(scaler, pd.DataFrame(batch, columns=FEATURE_NAMES),
+                                                        model)).all()
+
+    row = data.values[0]
+    results = [
+        ('single row, sklearn + pandas (ms)',
+         per_call_ms(lambda: predict_cluster(scaler, pd.DataFrame([row], columns=FEATURE_NAMES), model),
+                     args.requests)),
+        ('single row, numpy (ms)', per_call_ms(lambda: predictor.predict(row), args.requests)),
+        ('batch, sklearn + pandas (ms)',
+         per_call_ms(lambda: predict_cluster(scaler, pd.DataFrame(batch, columns=FEATURE_NAMES), model), 20)),
+        ('batch, numpy (ms)', per_call_ms(lambda: predictor.predict(batch), 20)),
+        ('worker import, sklearn + pandas (s)',
+         import_seconds("import pandas, pickle, sklearn.preprocessing, sklearn.cluster")),
+        ('worker import, numpy (s)', import_seconds("import inference")),
+    ]
+    for name, value in results:
+        print('{:<40} {:>10.4f}'.format(name, value))
@@ -0,0 +1,58 @@
+"""Per-call overhead of the timers of src/instrument.py when the metrics are enabled and disabled, against the bare
+call, and time to export the metrics in the Prometheus text format. The `timed` decorator also reads the peak memory
+of the process twice per call, so it is meant for pipeline functions rather than inner loops.
+
+Run from the root of the repository:
+
+    python3 benchmarks/bench_instrument.py --calls 1000000
+"""
+import sys
+import time
+import argparse
+
+sys.path.append('./src')
+from instrument import Metrics
+
+
+def noop():
+    return None
+
+
+def nanoseconds_per_call(func, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - start) / calls * 1e9
+
+
+def timer_call(metrics):
+    def call():
+        with metrics.timer('request_phase_seconds', endpoint='index', phase='predict'):
+            noop()
+    return call
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the overhead of the instrumentation timers")
+    parser.add_argument('--calls', type=int, default=1000000, help="Calls per measurement")
+    args = parser.parse_args()
+
+    bare = nanoseconds_per_call(noop, args.calls)
+    print('{:<10} {:<9} {:>14} {:>15}'.format('timer', 'metrics', 'ns per call', 'overhead (ns)'))
+    print('{:<10} {:<9} {:>14.0f} {:>15}'.format('none', '-', bare, '-'))
+    for enabled in [False, True]:
+        metrics = Metrics(enabled=enabled)
+        for name, func in [('timer', timer_call(metrics)), ('timed', metrics.timed('noop')(noop))]:
+            per_call = nanoseconds_per_call(func, args.calls)
+            print('{:<10} {:<9} {:>14.0f} {:>15.0f}'.format(name, 'enabled' if enabled else 'disabled', per_call,
+                                                            per_call - bare))
+
+    metrics = Metrics()
+    for endpoint in ['index', 'api_predict', 'api_similar', 'api_clusters']:
+        for status in [200, 400, 500]:
+            for _ in range(100):
+                metrics.observe('request_seconds', 0.002, endpoint=endpoint, method='POST', status=status)
+    start = time.perf_counter()
+    text = metrics.prometheus()
+    print('Exported {} lines in {:.2f} ms'.format(text.count('\n'), (time.perf_counter() - start) * 1e3))
@@ -0,0 +1,223 @@
+"""Time every stage of the pipeline and the app routes on synthetic raw data, save the timings as JSON and compare them
+against a stored baseline.
+
+The raw data is generated with the schema of `merged_data_cleaned.csv` (see `benchmarks/synthetic.py`). For every
+catalog size, the suite times reading and saving the data in generate_features.py, scaling, the k sweep, the fit and
+the batch prediction of train_model.py, loading the clusters with bean_db.persist_to_db, and GET and POST requests to
+`/` through the Flask test client.
+
+Run from the root of the repository:
+
+    python3 benchmarks/bench_pipeline.py --rows 10000 100000 --baseline benchmarks/baseline.json
+
+The run fails with exit code 1 if a timing is slower than its baseline by more than `--tolerance`. Use
+`--save-baseline` to store the timings of the run as the new baseline, on the machine the suite is compared on.
+"""
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+
+import numpy as np
+import yaml
+
+sys.path.append('./config')
+sys.path.append('./src')
+sys.path.append('./benchmarks')
+import config
+from synthetic import write_synthetic_raw_data
+
+# Flavor profile posted to the app, in the range of the catalog
+PROFILE = {'aroma': 7.6, 'aftertaste': 7.4, 'acidity': 7.5, 'sweetness': 9.9, 'moisture': 0.1}
+
+
+def best_seconds(func, repeat):
+    """Best wall time in seconds of `repeat` calls of `func`, and the result of the last call."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def run_metadata():
+    """Versions and machine the timings were measured with."""
+    import pandas as pd
+    import sklearn
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+            'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'sklearn': sklearn.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count()}
+
+
+def bench_stages(n_rows, config_yaml, work_dir, repeat, n_requests):
+    """Time every stage on `n_rows` rows of synthetic raw data in `work_dir`.
+    Returns:
+        timings (`dict`): Seconds per stage, and per request for the app routes.
+    """
+    import generate_features as gf
+    import train_model as tm
+    from bean_db import persist_to_db
+    from model_registry import find_latest_model, artifact_path
+
+    config_gf = config_yaml['generate_feature']
+    config_tm = config_yaml['train_model']
+    config_sweep = config_tm['plot_sil_iner']
+    config_fit = config_tm['train_model']
+    feature_names = config_gf['feature_split']['feature_names']
+    raw_path = os.path.join(work_dir, 'merged_data_cleaned.csv')
+    clean_path = os.path.join(work_dir, 'data_clean.csv')
+    clusters_path = os.path.join(work_dir, 'clusters.csv')
+    model_dir = os.path.join(work_dir, 'models')
+    os.makedirs(model_dir)
+    write_synthetic_raw_data(raw_path, n_rows)
+
+    timings = {}
+    timings['generate_features.read_data'], data = best_seconds(
+        lambda: gf.read_data(raw_path, config_gf['read_data']['column_names']), repeat)
+    timings['generate_features.save_csv'], _ = best_seconds(lambda: gf.save_csv(data, clean_path), repeat)
+
+    scaler_path = os.path.join(model_dir, 'feature_scaler.pkl')
+    timings['train_model.scale'], scaled = best_seconds(
+        lambda: tm.stand_feat(data, feature_names, tm.get_scaler(data, feature_names, scaler_path)), repeat)
+    timings['train_model.sweep_k'], _ = best_seconds(
+        lambda: tm.sweep_k(scaled, config_sweep['kmin'], config_sweep['kmax'], config_sweep['random_state'],
+                           n_jobs=config_sweep['n_jobs'], sample_size=config_sweep['sample_size'],
+                           patience=config_sweep['patience'], tol=config_sweep['tol']), repeat)
+    timings['train_model.fit'], kmeans_model = best_seconds(
+        lambda: tm.train_model(scaled, config_fit['k_chosen'], config_fit['random_state'], model_dir), repeat)
+
+    with open(scaler_path, 'rb') as f:
+        feat_scaler = pickle.load(f)
+    timings['train_model.predict'], clusters = best_seconds(
+        lambda: tm.predict_cluster_batch(feat_scaler, data[feature_names], kmeans_model), repeat)
+    data['cluster'] = clusters
+    data.to_csv(clusters_path, index=False)
+    # The app loads the model from its inference artifact
+    tm.save_inference_artifact(feat_scaler, kmeans_model,
+                               artifact_path(find_latest_model(model_dir, config_fit['k_chosen'])))
+
+    # Loading a new database, then syncing the same catalog again, which writes no rows
+    db_path = os.path.join(work_dir, 'bean.db')
+    engine_string = 'sqlite:///{}'.format(db_path)
+    timings['bean_db.persist_to_db'], _ = best_seconds(lambda: persist_to_db(engine_string, clusters_path), 1)
+    timings['bean_db.persist_to_db_unchanged'], _ = best_seconds(
+        lambda: persist_to_db(engine_string, clusters_path), repeat)
+
+    # The app reads its database and models when it is imported, so it is timed in a fresh interpreter
+    env = dict(os.environ, SQLALCHEMY_DATABASE_URI=engine_string, MODEL_DIR=model_dir)
+    worker = subprocess.run([sys.executable, __file__, '--app-worker', '--requests', str(n_requests)], env=env,
+                            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    timings.update(json.loads(worker.stdout.strip().splitlines()[-1]))
+    return timings
+
+
+def bench_app(n_requests):
+    """Median seconds per request of GET and POST `/` through the Flask test client."""
+    sys.path.insert(0, '.')
+    from app import app
+
+    client = app.test_client()
+    timings = {}
+    for route, request in [('app.GET /', lambda: client.get('/')),
+                           ('app.POST /', lambda: client.post('/', data=PROFILE))]:
+        # The first requests fill the caches of the worker
+        for _ in range(5):
+            assert request().status_code == 200
+        latencies = []
+        for _ in range(n_requests):
+            start = time.perf_counter()
+            request()
+            latencies.append(time.perf_counter() - start)
+        timings[route] = float(np.median(latencies))
+    return timings
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """Compare the timings of a run with the baseline.
+    Args:
+        results (`dict`): Timings per catalog size and stage of this run.
+        baseline (`dict`): Timings per catalog size and stage of the baseline.
+        tolerance (`float`): Relative slowdown above which a timing is a regression.
+        min_seconds (`float`): Slowdowns of less than this many seconds are noise, never regressions.
+    Returns:
+        rows (`:obj:`list` of :obj:`tuple`): Size, stage, baseline and current seconds, ratio and status of every
+            timing of this run.
+    """
+    rows = []
+    for size, timings in results.items():
+        for stage, seconds in timings.items():
+            before = baseline.get(size, {}).get(stage)
+            if before is None:
+                rows.append((size, stage, None, seconds, None, 'new'))
+                continue
+            ratio = seconds / before if before > 0 else float('inf')
+            regressed = ratio > 1 + tolerance and seconds - before > min_seconds
+            rows.append((size, stage, before, seconds, ratio, 'SLOWER' if regressed else 'ok'))
+    return rows
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages and app routes on synthetic data")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+                        help="Rows of synthetic raw data, from 10000 to 10000000")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per stage, the best one is kept")
+    parser.add_argument('--requests', type=int, default=200, help="Requests per app route")
+    parser.add_argument('--output', default='benchmarks/results/latest.json', help="Where to save the timings")
+    parser.add_argument('--baseline', default='benchmarks/baseline.json', help="Timings to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Relative slowdown counted as a regression")
+    parser.add_argument('--min-seconds', type=float, default=0.0005, help="Slowdowns below this are noise")
+    parser.add_argument('--save-baseline', action='store_true', help="Save the timings as the new baseline")
+    parser.add_argument('--app-worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.app_worker:
+        print(json.dumps(bench_app(args.requests)))
+        # The query log writer thread of the app does not keep the worker alive
+        sys.stdout.flush()
+        os._exit(0)
+
+    with open(config.YAML_PATH, "r") as f:
+        config_yaml = yaml.load(f, Loader=yaml.FullLoader)
+
+    results = {}
+    for n_rows in args.rows:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results[str(n_rows)] = bench_stages(n_rows, config_yaml, work_dir, args.repeat, args.requests)
+
+    report = {'meta': run_metadata(), 'results': results}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    rows = compare(results, baseline, args.tolerance, args.min_seconds)
+    print('{:>9} {:<34} {:>12} {:>12} {:>7} {:>7}'.format('rows', 'stage', 'baseline (s)', 'current (s)', 'ratio',
+                                                          'status'))
+    for size, stage, before, seconds, ratio, status in rows:
+        print('{:>9} {:<34} {:>12} {:>12.4f} {:>7} {:>7}'.format(
+            size, stage, '-' if before is None else '{:.4f}'.format(before), seconds,
+            '-' if ratio is None else '{:.2f}'.format(ratio), status))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Saved the baseline to {}'.format(args.baseline))
+    elif any(status == 'SLOWER' for *_, status in rows):
+        sys.exit(1)
@@ -0,0 +1,79 @@
+"""Bytes transferred and read time of the raw data for every layout of src/partitions.py: the single csv object,
+the gzip-compressed object and gzip or zstd partitions by grading year, for a full fetch and for a nightly update that
+changes the beans of the latest grading year.
+
+Run from the root of the repository:
+
+    python3 benchmarks/bench_raw_data.py --rows 200000 1000000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.append('./config')
+sys.path.append('./src')
+sys.path.append('./benchmarks')
+from partitions import write_partitions, compress, changed_partitions, partition_values
+from generate_features import read_data
+from synthetic import synthetic_raw_data
+
+COLUMN_NAMES = ['Unnamed: 0', 'Species', 'Owner.1', 'Country.of.Origin', 'Farm.Name', 'Company', 'Region', 'Producer',
+                'Grading.Date', 'Processing.Method', 'Aroma', 'Flavor', 'Aftertaste', 'Acidity', 'Body', 'Balance',
+                'Uniformity', 'Clean.Cup', 'Sweetness', 'Total.Cup.Points', 'Moisture', 'Color']
+
+
+def nightly_update(raw):
+    """The raw data after the scores of the beans of the latest grading year were revised."""
+    years = partition_values(raw, 'grading_year')
+    latest = years == years[years.str.isdigit()].max()
+    updated = raw.copy()
+    updated.loc[latest, 'Aroma'] = (updated.loc[latest, 'Aroma'] + 0.01).round(2)
+    return updated
+
+
+def seconds(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the transferred bytes and read time of raw data layouts")
+    parser.add_argument('--rows', type=int, nargs='+', default=[200000, 1000000], help="Rows of raw data")
+    args = parser.parse_args()
+
+    try:
+        import zstandard  # noqa: F401
+        compressions = ['gzip', 'zstd']
+    except ImportError:
+        compressions = ['gzip']
+
+    print('{:>9} {:<14} {:>10} {:>10} {:>12}'.format('rows', 'layout', 'full (MB)', 'read (s)', 'update (MB)'))
+    for n_rows in args.rows:
+        raw = synthetic_raw_data(n_rows)
+        updated = nightly_update(raw)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # A single object is transferred whole whenever any row changes
+            content = raw.to_csv(index=False).encode('utf-8')
+            for name, compression, suffix in [('csv', None, ''), ('csv.gz', 'gzip', '.gz')]:
+                path = os.path.join(tmp_dir, 'raw.csv' + suffix)
+                with open(path, 'wb') as f:
+                    f.write(compress(content, compression))
+                size_mb = os.path.getsize(path) / 1e6
+                read_seconds = seconds(lambda: read_data(path, COLUMN_NAMES))
+                print('{:>9d} {:<14} {:>10.2f} {:>10.2f} {:>12.2f}'.format(n_rows, name, size_mb, read_seconds,
+                                                                           size_mb))
+
+            for compression in compressions:
+                dataset_dir = os.path.join(tmp_dir, 'year-' + compression)
+                manifest = write_partitions(raw, dataset_dir, 'grading_year', compression)
+                size_mb = sum(p['compressed_bytes'] for p in manifest['partitions']) / 1e6
+                read_seconds = seconds(lambda: read_data(dataset_dir, COLUMN_NAMES))
+                new_manifest = write_partitions(updated, os.path.join(tmp_dir, 'new-' + compression), 'grading_year',
+                                                compression)
+                update_mb = sum(p['compressed_bytes'] for p in changed_partitions(new_manifest, manifest)) / 1e6
+                print('{:>9d} {:<14} {:>10.2f} {:>10.2f} {:>12.2f}'.format(
+                    n_rows, 'year-' + compression, size_mb, read_seconds, update_mb))
@@ -0,0 +1,70 @@
+"""Query latency and recall of the IVF similarity index against the exact search, by catalog size.
+
+Run from the root of the repository:
+
+    python3 benchmarks/bench_similarity.py --sizes 10000 100000 1000000 --queries 500
+"""
+import sys
+import time
+import argparse
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+sys.path.append('./src')
+sys.path.append('./benchmarks')
+from similarity import SimilarityIndex
+from synthetic import synthetic_beans
+
+FEATURE_NAMES = ['aroma', 'aftertaste', 'acidity', 'sweetness', 'moisture']
+
+
+def query_ms(index, queries, k, **kwargs):
+    """Latency in milliseconds and results of searching `index` for every query."""
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        ids, _ = index.search(query, k=k, **kwargs)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(ids)
+    return np.array(latencies), results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the IVF similarity index against the exact search")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help="Catalog sizes")
+    parser.add_argument('--queries', type=int, default=500, help="Number of profiles searched per catalog")
+    parser.add_argument('--k', type=int, default=15, help="Number of beans per query")
+    parser.add_argument('--list-size', type=int, default=1000, help="Approximate number of beans per IVF list")
+    parser.add_argument('--n-probe', type=int, nargs='+', default=[4, 8, 16], help="IVF lists scanned per query")
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(1218)
+    print('{:>9} {:<10} {:>10} {:>10} {:>10} {:>10}'.format('beans', 'search', 'build (s)', 'p50 (ms)', 'p99 (ms)',
+                                                            'recall'))
+    for size in args.sizes:
+        raw = synthetic_beans(size)[FEATURE_NAMES].values
+        mean, scale = raw.mean(axis=0), raw.std(axis=0)
+        centroids = KMeans(n_clusters=5, random_state=1218).fit((raw[:100000] - mean) / scale).cluster_centers_
+        # Profiles near catalog beans, as users describe beans they know
+        queries = raw[rng.randint(0, size, size=args.queries)] + rng.normal(scale=0.05 * scale, size=(args.queries, 5))
+
+        start = time.perf_counter()
+        exact = SimilarityIndex.build(mean, scale, np.arange(size), raw, centroids, exact_max=size)
+        exact_build = time.perf_counter() - start
+        latencies, truth = query_ms(exact, queries, args.k)
+        print('{:>9d} {:<10} {:>10.2f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+            size, 'exact', exact_build, np.percentile(latencies, 50), np.percentile(latencies, 99), 1.0))
+
+        start = time.perf_counter()
+        ivf = SimilarityIndex.build(mean, scale, np.arange(size), raw, centroids, exact_max=0,
+                                    list_size=args.list_size, random_state=1218)
+        ivf_build = time.perf_counter() - start
+        for n_probe in args.n_probe:
+            latencies, results = query_ms(ivf, queries, args.k, n_probe=n_probe)
+            recall = np.mean([len(np.intersect1d(found, expected)) / len(expected)
+                              for found, expected in zip(results, truth)])
+            print('{:>9d} {:<10} {:>10.2f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                size, 'ivf-{}'.format(n_probe), ivf_build, np.percentile(latencies, 50),
+                np.percentile(latencies, 99), recall))
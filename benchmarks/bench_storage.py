@@ -0,0 +1,52 @@
+"""Parse time and file size of the intermediate storage formats against csv.
+
+Run from the root of the repository (parquet and feather need pyarrow):
+
+    python3 benchmarks/bench_storage.py --sizes 100000 1000000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+sys.path.append('./src')
+from storage import FORMATS, write_table, read_table
+
+FEATURE_NAMES = ['Aroma', 'Aftertaste', 'Acidity', 'Sweetness', 'Moisture']
+
+
+def best_seconds(func, repeats):
+    """Best wall time in seconds of calling `func` `repeats` times."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the intermediate storage formats")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--formats', nargs='+', default=list(FORMATS))
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    source = pd.read_csv('./data/data_clean.csv')
+    print('{:>10} {:>8} {:>10} {:>10} {:>12} {:>14}'.format('rows', 'format', 'size (MB)', 'write (s)',
+                                                            'read all (s)', 'read feat. (s)'))
+    for n_rows in args.sizes:
+        data = source.iloc[np.random.RandomState(1218).randint(0, len(source), size=n_rows)].reset_index(drop=True)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for fmt in args.formats:
+                path = os.path.join(tmp_dir, 'data' + FORMATS[fmt])
+                write_seconds = best_seconds(lambda: write_table(data, path, fmt), 1)
+                read_all = best_seconds(lambda: read_table(path, fmt), args.repeats)
+                read_features = best_seconds(lambda: read_table(path, fmt, columns=FEATURE_NAMES), args.repeats)
+                print('{:>10} {:>8} {:>10.2f} {:>10.3f} {:>12.3f} {:>14.3f}'.format(
+                    n_rows, fmt, os.path.getsize(path) / 1e6, write_seconds, read_all, read_features))
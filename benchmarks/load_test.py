@@ -0,0 +1,76 @@
+"""Latency percentiles and throughput of the app's bean listing (GET /) and recommendation (POST /) routes.
+
+Start the app first, e.g. in production mode with `./app/boot.sh`, then run from the root of the repository:
+
+    python3 benchmarks/load_test.py --url http://127.0.0.1:5000 --requests 2000 --concurrency 16
+"""
+import time
+import argparse
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# A flavor profile within the ranges of the catalog
+PROFILE = {'aroma': 7.6, 'aftertaste': 7.4, 'acidity': 7.5, 'sweetness': 9.9, 'moisture': 0.11}
+
+
+def timed_request(url, data=None, timeout=30):
+    """Send one request.
+    Returns:
+        latency_ms (`float`): Latency in milliseconds, None if the request failed.
+    """
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, data=data, timeout=timeout) as response:
+            response.read()
+            if response.status != 200:
+                return None
+    except Exception:
+        return None
+    return (time.perf_counter() - start) * 1000
+
+
+def load_test(url, data, n_requests, concurrency):
+    """Send `n_requests` requests from `concurrency` concurrent clients.
+    Args:
+        url (`str`): URL of the route.
+        data (`bytes`): Form-encoded body of POST requests, None for GET requests.
+        n_requests (`int`): Total number of requests.
+        concurrency (`int`): Number of requests in flight at the same time.
+    Returns:
+        results (`dict`): p50 and p99 latency in milliseconds, requests per second and number of errors.
+    """
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(lambda _: timed_request(url, data), range(n_requests)))
+    elapsed = time.perf_counter() - start
+
+    succeeded = np.array([latency for latency in latencies if latency is not None])
+    return {'p50_ms': np.percentile(succeeded, 50) if len(succeeded) else float('nan'),
+            'p99_ms': np.percentile(succeeded, 99) if len(succeeded) else float('nan'),
+            'requests_per_sec': len(succeeded) / elapsed,
+            'errors': n_requests - len(succeeded)}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Load test the listing and recommendation routes of the app")
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="Base URL of the running app")
+    parser.add_argument('--requests', type=int, default=2000, help="Number of requests per route")
+    parser.add_argument('--concurrency', type=int, default=16, help="Number of concurrent clients")
+    parser.add_argument('--warmup', type=int, default=50, help="Number of untimed requests per route")
+    args = parser.parse_args()
+
+    url = args.url.rstrip('/') + '/'
+    routes = [('GET /', None), ('POST /', urllib.parse.urlencode(PROFILE).encode())]
+
+    print('{:<10} {:>10} {:>10} {:>12} {:>8}'.format('route', 'p50 (ms)', 'p99 (ms)', 'requests/s', 'errors'))
+    for name, data in routes:
+        load_test(url, data, args.warmup, min(args.concurrency, args.warmup))
+        results = load_test(url, data, args.requests, args.concurrency)
+        print('{:<10} {:>10.2f} {:>10.2f} {:>12.1f} {:>8d}'.format(name, results['p50_ms'], results['p99_ms'],
+                                                                  results['requests_per_sec'], results['errors']))
@@ -0,0 +1,78 @@
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.append('./src')
+from bean_db import read_clusters, FLOAT_COLUMNS
+
+RAW_DATA_PATH = './data/external/merged_data_cleaned.csv'
+
+# Cupping scores of the raw data, Total.Cup.Points is their sum
+SCORE_COLUMNS = ['Aroma', 'Flavor', 'Aftertaste', 'Acidity', 'Body', 'Balance', 'Uniformity', 'Clean.Cup', 'Sweetness',
+                 'Cupper.Points']
+
+
+def synthetic_beans(n_rows, n_clusters=5, seed=1218, data_path='./data/clusters.csv'):
+    """Create a synthetic catalog with the schema of `bean_attributes` by resampling the real cluster table.
+    Args:
+        n_rows (`int`): Number of beans to generate.
+        n_clusters (`int`): Number of cluster labels to assign.
+        seed (`int`): Seed of the random number generator.
+        data_path (`str`): Cluster table to resample from.
+    Returns:
+        beans (`pandas.DataFrame`): Normalized rows with unique ids, jittered scores and random clusters.
+    """
+
+    rng = np.random.RandomState(seed)
+    source = read_clusters(data_path)
+    beans = source.iloc[rng.randint(0, len(source), size=n_rows)].reset_index(drop=True)
+
+    noise = rng.normal(scale=0.1, size=(n_rows, len(FLOAT_COLUMNS)))
+    beans[FLOAT_COLUMNS] = (beans[FLOAT_COLUMNS].values + noise * (beans[FLOAT_COLUMNS].values > 1)).round(2)
+    beans['id'] = np.arange(n_rows)
+    beans['cluster'] = rng.randint(0, n_clusters, size=n_rows)
+    return beans
+
+
+def synthetic_raw_data(n_rows, seed=1218, data_path=RAW_DATA_PATH, first_id=0):
+    """Create synthetic raw data with the schema of `merged_data_cleaned.csv` by resampling the real raw data.
+    Args:
+        n_rows (`int`): Number of rows to generate.
+        seed (`int`): Seed of the random number generator.
+        data_path (`str`): Raw data to resample from.
+        first_id (`int`): Id of the first row, in the unnamed first column.
+    Returns:
+        raw (`pandas.DataFrame`): Rows with unique ids, jittered cupping scores and moisture, and the total of the
+            scores.
+    """
+
+    rng = np.random.RandomState(seed)
+    source = pd.read_csv(data_path)
+    raw = source.iloc[rng.randint(0, len(source), size=n_rows)].reset_index(drop=True)
+    raw.iloc[:, 0] = np.arange(first_id, first_id + n_rows)
+
+    # Scores of 0 mark beans that were not cupped and stay 0
+    scores = raw[SCORE_COLUMNS].values
+    noise = rng.normal(scale=0.1, size=scores.shape)
+    raw[SCORE_COLUMNS] = np.clip(scores + noise * (scores > 1), 0, 10).round(2)
+    raw['Total.Cup.Points'] = raw[SCORE_COLUMNS].sum(axis=1).round(2)
+    moisture = raw['Moisture'].values
+    raw['Moisture'] = np.clip(moisture + rng.normal(scale=0.01, size=n_rows) * (moisture > 0), 0, None).round(2)
+    return raw
+
+
+def write_synthetic_raw_data(file_path, n_rows, seed=1218, chunk_size=500000, data_path=RAW_DATA_PATH):
+    """Write synthetic raw data to a csv file in chunks, so that 10M rows never have to be in memory at once.
+    Args:
+        file_path (`str`): Path of the csv file to write.
+        n_rows (`int`): Number of rows to generate.
+        seed (`int`): Seed of the random number generator, every chunk gets its own seed derived from it.
+        chunk_size (`int`): Number of rows generated and written at a time.
+        data_path (`str`): Raw data to resample from.
+    Returns:
+        None.
+    """
+
+    for i, start in enumerate(range(0, n_rows, chunk_size)):
+        chunk = synthetic_raw_data(min(chunk_size, n_rows - start), seed + i, data_path, first_id=start)
+        chunk.to_csv(file_path, index=False, mode='w' if i == 0 else 'a', header=i == 0)
@@ -19,14 +19,48 @@ S3_BUCKET_NAME = 'msia423-bean'
 S3_OBJECT_NAME = 'merged_data_cleaned.csv'
 S3_PUBLIC_KEY = os.environ.get("AWS_ACCESS_KEY_ID")
 S3_SECRET_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")  # S3-compatible service such as MinIO, AWS S3 if not set
+
+# S3 transfers, see src/s3_transfer.py
+S3_CHUNK_SIZE_MB = 8  # Size of the uploaded parts and downloaded ranges, at least 5 for uploads to AWS S3
+S3_MAX_CONCURRENCY = 8  # Parts or ranges transferred at the same time
+S3_MAX_RETRIES = 5  # Retries of a failed range, with exponential backoff
+S3_SKIP_UNCHANGED = True  # If true, do not transfer a file whose ETag matches the object
+
+# Partitioned raw data, see src/partitions.py
+S3_PARTITIONED = False  # If true, the raw data is stored in S3 as compressed partitions listed in a manifest
+S3_DATASET_PREFIX = 'merged_data_cleaned/'  # Prefix of the partitions and of their manifest in the bucket
+S3_PARTITION_BY = 'Country.of.Origin'  # Column of the partitions, 'grading_year' for the grading year, None for one
+S3_COMPRESSION = 'gzip'  # Compression of the partitions: None, 'gzip' or 'zstd' (needs zstandard)
+DOWNLOADED_DATASET_DIR = path.join(PROJECT_HOME, 'data/external/merged_data_cleaned')
 
 # SQLite database connection config
 DATA_TABLE_PATH = path.join(PROJECT_HOME, 'data/clusters.csv')
+DB_CHUNK_SIZE = 10000  # Number of rows written per transaction when loading the database
+DB_LOAD_MODE = 'sync'  # 'sync' writes only changed rows, 'swap' swaps in a staging table, 'replace' reloads all
 LOCAL_DB_FLAG = True  # If true, create a local SQLite database
 LOCAL_DB_NAME = 'data/bean.db'
 LOCAL_DATABASE_PATH = path.join(PROJECT_HOME, LOCAL_DB_NAME)
 SQLALCHEMY_DATABASE_URI = os.environ.get("SQLALCHEMY_DATABASE_URI")
 
+# Database engine, applied by src/db_engine.py the same way in bean_db.py and in the app (see flaskconfig.py)
+DB_POOL_SIZE = 5  # Connections kept open per process
+DB_MAX_OVERFLOW = 10  # Connections opened on top of the pool under load
+DB_POOL_RECYCLE = 3600  # Seconds before a MySQL connection is replaced, below the server's wait_timeout
+DB_POOL_PRE_PING = True  # If true, check MySQL connections before use
+SQLITE_MMAP_SIZE = 268435456  # Bytes of the SQLite database file read through a memory map
+SQLITE_BUSY_TIMEOUT_MS = 5000  # Time a SQLite writer waits for a lock before failing
+
+# Instrumentation of the pipeline scripts, see src/instrument.py
+METRICS_ENABLED = True  # If true, time the pipeline functions and record the peak memory of the stages
+METRICS_REPORT_DIR = path.join(PROJECT_HOME, 'reports')  # JSON report of every script run, none if None
+
+# Profiling of the runs of generate_features.py, train_model.py and bean_db.py, see src/profiling.py
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))  # Fraction of the runs profiled, 1 for every run
+PROFILE_DIR = os.environ.get("PROFILE_DIR", path.join(PROJECT_HOME, 'profiles'))  # cProfile dumps and summaries
+PROFILE_TOP_N = 30  # Functions listed in the summary of a profile
+PROFILE_MAX_FILES = 100  # Profiles kept in PROFILE_DIR, the oldest are deleted
+
 # YAML for modeling
 YAML_PATH = path.join(PROJECT_HOME, 'config/config.yaml')
 
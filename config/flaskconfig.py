@@ -1,9 +1,55 @@
-DEBUG = True
+import os
+
+DEBUG = os.environ.get("FLASK_DEBUG", "true").lower() in ("1", "true")  # app/boot.sh sets it to false in production
 LOGGING_CONFIG = "config/logging/logging.conf"
 PORT = 5000
 APP_NAME = "bean"
-SQLALCHEMY_DATABASE_URI = 'sqlite:///data/bean.db'
+SQLALCHEMY_DATABASE_URI = os.environ.get("SQLALCHEMY_DATABASE_URI", 'sqlite:///data/bean.db')
 SQLALCHEMY_TRACK_MODIFICATIONS = True
 HOST = "0.0.0.0"
 SQLALCHEMY_ECHO = False  # If true, SQL for queries made will be printed
-MAX_ROWS_SHOW = 15
\ No newline at end of file
+MAX_ROWS_SHOW = 15
+
+# Database engine, applied by src/db_engine.py the same way in bean_db.py and in the app (see config.py)
+DB_POOL_SIZE = 5  # Connections kept open per worker
+DB_MAX_OVERFLOW = 10  # Connections opened on top of the pool under load
+DB_POOL_RECYCLE = 3600  # Seconds before a MySQL connection is replaced, below the server's wait_timeout
+DB_POOL_PRE_PING = True  # If true, check MySQL connections before use
+SQLITE_MMAP_SIZE = 268435456  # Bytes of the SQLite database file read through a memory map
+SQLITE_BUSY_TIMEOUT_MS = 5000  # Time a SQLite writer waits for a lock before failing
+
+# Trained model objects, loaded once per worker and reloaded when a newer model is saved
+MODEL_DIR = os.environ.get("MODEL_DIR", "models")
+FEATURE_SCALER_PATH = os.path.join(MODEL_DIR, "feature_scaler.pkl")
+MODEL_K = 5
+MODEL_CHECK_INTERVAL = 30  # Minimum number of seconds between checks for a newer model
+
+# Top beans per cluster cached in memory, rebuilt when the catalog version stamped by bean_db.py changes
+CATALOG_CHECK_INTERVAL = 10  # Minimum number of seconds between checks of the catalog version
+
+# Batch prediction API
+FEATURE_NAMES = ['Aroma', 'Aftertaste', 'Acidity', 'Sweetness', 'Moisture']  # Same order as in config.yaml
+MAX_PREDICT_ROWS = 50000  # Maximum number of flavor profiles scored per request
+
+# Beans nearest to a flavor profile, from the similarity index saved next to the model by train_model.py
+SIMILAR_N_PROBE = 8  # Lists of an IVF index scanned per query, more lists find more of the exact nearest beans
+MAX_SIMILAR_PROFILES = 100  # Maximum number of flavor profiles per similarity request
+
+# Per-cluster feature statistics served by /api/clusters, saved next to the model by train_model.py
+CLUSTER_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+# Request latency histograms and gauges of the caches, exported in the Prometheus text format by /metrics
+METRICS_ENABLED = True  # If false, requests are not timed and /metrics only reports the gauges
+
+# Profiling of the index() handler with cProfile, see src/profiling.py
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))  # Fraction of the requests profiled, e.g. 0.001
+PROFILE_ADMIN_TOKEN = os.environ.get("PROFILE_ADMIN_TOKEN")  # Requests with this X-Profile-Token are always profiled
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")  # cProfile dumps and summaries of the profiled requests
+PROFILE_TOP_N = 30  # Functions listed in the summary of a profile
+PROFILE_MAX_FILES = 100  # Profiles kept in PROFILE_DIR, the oldest are deleted
+
+# User queries logged to the user_query table by a background writer
+QUERY_LOG_MAX_QUEUE = 10000  # Queries waiting to be written, new queries are dropped when full
+QUERY_LOG_BATCH_SIZE = 100  # Maximum number of queries inserted per transaction
+QUERY_LOG_FLUSH_MS = 500  # Maximum time a query waits for its batch to fill up
+QUERY_LOG_BLOCK_MS = 0  # Maximum time a request waits for room on a full queue before dropping its query
@@ -0,0 +1,39 @@
+import gc
+import os
+import multiprocessing
+
+# Production server settings, see app/boot.sh. Every setting can be overridden from the environment.
+bind = "{}:{}".format(os.environ.get("HOST", "0.0.0.0"), os.environ.get("PORT", "5000"))
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+worker_class = "gthread" if threads > 1 else "sync"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG", None)
+
+# Import app.py, and with it load the model and the top beans, once in the master process. The workers are forked
+# from it and share the memory of the loaded model and catalog copy-on-write.
+preload_app = True
+
+
+def when_ready(server):
+    # Keep the garbage collector from touching, and so copying, the objects loaded before the fork (Python 3.7+)
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+
+def pre_fork(server, worker):
+    # Close the database connections the master opened while loading the catalog, before the fork, so that no worker
+    # inherits a socket or SQLite handle shared with the master or its siblings. Each worker opens its own
+    # connections on its first query. SQLAlchemy 1.3 has no dispose(close=False) to drop them in the child instead.
+    from app import db
+    db.engine.dispose()
+
+
+def on_reload(server):
+    # `kill -HUP <master pid>` reloads the newest model and catalog in the master before the new workers are forked,
+    # the old workers finish their requests and exit
+    from app import registry, top_beans
+    loaded = registry.load()
+    top_beans.load()
+    server.log.info("Reloaded model %s for the new workers", loaded.version)
@@ -1,13 +1,5 @@
 #!/usr/bin/env bash
 
-# Acquire data from S3 bucket
-python3 src/acquire_data.py
-
-# Generate features
-python3 src/generate_features.py --input=data/external/merged_data_cleaned.csv --config=config/config.yaml --output=data/data_clean.csv
-
-# Train model
-python3 src/train_model.py --input=data/data_clean.csv --config=config/config.yaml --output=ddata/clusters.csv
-
-# Evaluate model
-python3 src/evaluate_model.py --input=data/clusters.csv --config=config/config.yaml --output=figures/model_evaluation/cluster_counts.csv
\ No newline at end of file
+# Acquire data from S3 bucket, then generate features, train and evaluate the model.
+# Stages whose input data, config and source did not change since a previous run are restored from the cache.
+python3 src/pipeline.py "$@"
@@ -1,26 +1,36 @@
-import boto3
 import os
 import sys
 import logging.config
 import logging
-from botocore.exceptions import ClientError
+import yaml
 
 sys.path.append('./config')
 import config
 
-logging.config.fileConfig(config.LOGGING_CONFIG)
+sys.path.append('./src')
+from s3_transfer import s3_client, download, is_s3_url
+from partitions import download_dataset
+
+logging.config.fileConfig(config.LOGGING_CONFIG, disable_existing_loggers=False)
 logger = logging.getLogger('acquire_data')
 
 
 if __name__ == "__main__":
-    """Write the data object to S3 bucket. 
+    """Download the raw data object, or the partitions of the raw data that changed, from the S3 bucket.
     """
 
     S3_BUCKET_NAME = config.S3_BUCKET_NAME
-    S3_OBJECT_NAME = config.S3_OBJECT_NAME
+    S3_OBJECT_NAME = config.S3_DATASET_PREFIX if config.S3_PARTITIONED else config.S3_OBJECT_NAME
     S3_PUBLIC_KEY = config.S3_PUBLIC_KEY
     S3_SECRET_KEY = config.S3_SECRET_KEY
-    DOWNLOADED_DATA_PATH = config.DOWNLOADED_DATA_PATH
+    DOWNLOADED_DATA_PATH = config.DOWNLOADED_DATASET_DIR if config.S3_PARTITIONED else config.DOWNLOADED_DATA_PATH
+
+    # With an s3:// URL as raw data, generate_features.py streams the object and nothing is downloaded
+    with open(config.YAML_PATH, "r") as f:
+        raw_data_path = yaml.load(f, Loader=yaml.FullLoader)['generate_feature']['read_data']['file_path']
+    if is_s3_url(raw_data_path):
+        logger.info("The raw data is streamed from %s by generate_features.py, nothing to download", raw_data_path)
+        sys.exit(0)
 
     # Check the elements for boto3 to be non-empty
     for element in [S3_PUBLIC_KEY, S3_SECRET_KEY, S3_BUCKET_NAME, S3_OBJECT_NAME, DOWNLOADED_DATA_PATH]:
@@ -28,16 +38,19 @@ if __name__ == "__main__":
             logger.error("Empty info for DOWNLOADED_DATA_PATH and S3 bucket in config.py")
             sys.exit(1)
 
-    s3 = boto3.resource('s3', aws_access_key_id=S3_PUBLIC_KEY, aws_secret_access_key=S3_SECRET_KEY)
-
     # Acquire raw data from S3
     try:
-        s3 = boto3.resource('s3', aws_access_key_id=S3_PUBLIC_KEY, aws_secret_access_key=S3_SECRET_KEY)
-        bucket = s3.Bucket(S3_BUCKET_NAME)
-        bucket.download_file(S3_OBJECT_NAME, DOWNLOADED_DATA_PATH)
+        s3 = s3_client(S3_PUBLIC_KEY, S3_SECRET_KEY, config.S3_ENDPOINT_URL, config.S3_MAX_CONCURRENCY)
+        if config.S3_PARTITIONED:
+            download_dataset(s3, S3_BUCKET_NAME, S3_OBJECT_NAME, DOWNLOADED_DATA_PATH,
+                             max_concurrency=config.S3_MAX_CONCURRENCY, chunk_size_mb=config.S3_CHUNK_SIZE_MB,
+                             max_retries=config.S3_MAX_RETRIES)
+        else:
+            download(s3, S3_BUCKET_NAME, S3_OBJECT_NAME, DOWNLOADED_DATA_PATH, chunk_size_mb=config.S3_CHUNK_SIZE_MB,
+                     max_concurrency=config.S3_MAX_CONCURRENCY, max_retries=config.S3_MAX_RETRIES,
+                     skip_unchanged=config.S3_SKIP_UNCHANGED)
         logger.info("Data successfully acquired")
     except Exception as e:
+        # The ranges already downloaded are kept, running the script again resumes the download
         logger.error(e)
         sys.exit(1)
-
-
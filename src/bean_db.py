@@ -1,14 +1,18 @@
 import os
 import sys
+import time
+import datetime
 import logging.config
 import sqlalchemy as sql
-from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Float, String, Text, Integer
-import pandas as pd
-import numpy as np
+from sqlalchemy import Column, Float, String, Text, Integer, DateTime, Index
+from sqlalchemy.schema import CreateIndex
 sys.path.append('./config')
 import config
+sys.path.append('./src')
+from db_engine import create_engine, engine_settings
+from instrument import metrics
+from profiling import Profiler
 
 logging.basicConfig(level=logging.INFO, format='%(name)s - %(levelname)s - %(asctime)s - %(message)s')
 logger = logging.getLogger(__file__)
@@ -48,73 +52,359 @@ class BeanAttributes(Base):
         return '<BeanAttributes %r>' % self.id
 
 
-def persist_to_db(engine_string):
-    """Persist the data to database.
+class CatalogVersion(Base):
+    """ Defines the data model for the table `catalog_version`, stamped whenever `bean_attributes` changes. """
+
+    __tablename__ = 'catalog_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(String(100), unique=False, nullable=False)
+
+    def __repr__(self):
+        return '<CatalogVersion %r>' % self.version
+
+
+class UserQuery(Base):
+    """ Defines the data model for the table `user_query`, the flavor profiles users asked recommendations for. """
+
+    __tablename__ = 'user_query'
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, unique=False, nullable=False)
+    aroma = Column(Float, unique=False, nullable=True)
+    aftertaste = Column(Float, unique=False, nullable=True)
+    acidity = Column(Float, unique=False, nullable=True)
+    sweetness = Column(Float, unique=False, nullable=True)
+    moisture = Column(Float, unique=False, nullable=True)
+    cluster = Column(Integer, unique=False, nullable=True)
+    model_version = Column(String(100), unique=False, nullable=True)
+
+    def __repr__(self):
+        return '<UserQuery %r>' % self.id
+
+
+# Indexes for the queries in app.py: top beans of a cluster and top beans of the whole catalog
+Index('ix_bean_attributes_cluster_cup', BeanAttributes.cluster, BeanAttributes.total_cup_point.desc())
+Index('ix_bean_attributes_cup', BeanAttributes.total_cup_point.desc())
+
+
+# Map the columns of the cluster table to the columns of `bean_attributes`
+COLUMN_MAP = {'Unnamed: 0': 'id',
+              'Species': 'species',
+              'Owner.1': 'owner',
+              'Country.of.Origin': 'country',
+              'Farm.Name': 'farm_name',
+              'Company': 'company',
+              'Region': 'region',
+              'Producer': 'producer',
+              'Grading.Date': 'grading_date',
+              'Processing.Method': 'processing_method',
+              'Aroma': 'aroma',
+              'Flavor': 'flavor',
+              'Aftertaste': 'aftertaste',
+              'Acidity': 'acidity',
+              'Body': 'body',
+              'Balance': 'balance',
+              'Uniformity': 'uniformity',
+              'Clean.Cup': 'cleancup',
+              'Sweetness': 'sweetness',
+              'Total.Cup.Points': 'total_cup_point',
+              'Moisture': 'moisture',
+              'Color': 'color',
+              'cluster': 'cluster'}
+STRING_COLUMNS = ['species', 'owner', 'country', 'farm_name', 'company', 'region', 'producer',
+                  'grading_date', 'processing_method', 'color']
+FLOAT_COLUMNS = ['aroma', 'flavor', 'aftertaste', 'acidity', 'body', 'balance', 'uniformity',
+                 'cleancup', 'sweetness', 'total_cup_point', 'moisture']
+INTEGER_COLUMNS = ['id', 'cluster']
+
+
+def create_indexes(engine):
+    """Create the indexes declared on `bean_attributes` that do not exist yet.
     Args:
-        engine_string (`str`): Engine string for SQLAlchemy.
+        engine (`sqlalchemy.engine.Engine`): Engine connected to the database.
+    Returns:
+        created (`:obj:`list` of :obj:`str`): Names of the indexes created.
+    """
+
+    table = BeanAttributes.__table__
+    existing = {index['name'] for index in sql.inspect(engine).get_indexes(table.name)}
+    created = []
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(engine)
+            created.append(index.name)
+    if created:
+        logger.info("Created indexes %s", ', '.join(created))
+    return created
+
+
+def stamp_catalog(engine):
+    """Write a new catalog version so that readers caching `bean_attributes` know to refresh.
+    Args:
+        engine (`sqlalchemy.engine.Engine`): Engine connected to the database.
+    Returns:
+        version (`str`): The new catalog version.
+    """
+
+    table = CatalogVersion.__table__
+    version = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')
+    with engine.begin() as conn:
+        conn.execute(table.delete())
+        conn.execute(table.insert(), {'id': 1, 'version': version})
+    logger.info("Catalog version stamped as %s", version)
+    return version
+
+
+def read_clusters(data_path):
+    """Read the cluster table and map it to the schema of `bean_attributes`.
+    Args:
+        data_path (`str`): Location of the cluster table written by train_model.py, as csv, parquet or feather.
+    Returns:
+        beans (`pandas.DataFrame`): One row per bean with the column names and types of `bean_attributes`.
+    """
+
+    # pandas is only imported for loading the catalog, the app only needs the table definitions of this module
+    import pandas as pd
+    from storage import infer_format, read_table
+
+    if infer_format(data_path) == 'csv':
+        raw_data = pd.read_csv(data_path, usecols=list(COLUMN_MAP),
+                               dtype={column: str for column, name in COLUMN_MAP.items() if name in STRING_COLUMNS})
+    else:
+        raw_data = read_table(data_path, columns=list(COLUMN_MAP))
+    beans = raw_data.rename(columns=COLUMN_MAP)
+    return normalize_beans(beans)
+
+
+def normalize_beans(beans):
+    """Order and type the columns of `bean_attributes` so that rows from the CSV and the database compare equal.
+    Args:
+        beans (`pandas.DataFrame`): Rows with the column names of `bean_attributes`.
+    Returns:
+        beans (`pandas.DataFrame`): Rows with empty strings for missing text, floats and integer ids/clusters.
+    """
+    import pandas as pd
+
+    beans = beans[list(COLUMN_MAP.values())].copy()
+    beans[STRING_COLUMNS] = beans[STRING_COLUMNS].fillna('').astype(str)
+    beans[FLOAT_COLUMNS] = beans[FLOAT_COLUMNS].astype(float)
+    # Rows inserted by older versions of app.py can hold NumPy integers stored as blobs, they become -1
+    beans[INTEGER_COLUMNS] = beans[INTEGER_COLUMNS].apply(pd.to_numeric, errors='coerce').fillna(-1).astype(int)
+    return beans
+
+
+def row_hashes(beans):
+    """Hash the content of every row, keyed by bean id.
+    Args:
+        beans (`pandas.DataFrame`): Normalized rows of `bean_attributes`.
+    Returns:
+        hashes (`pandas.Series`): 64-bit content hash of all columns but the id, indexed by id.
+    """
+
+    import pandas as pd
+
+    hashes = pd.util.hash_pandas_object(beans.drop(columns='id'), index=False)
+    hashes.index = beans['id'].values
+    return hashes
+
+
+def to_records(beans):
+    """Convert a data frame to a list of dictionaries with native Python values for executemany.
+    Args:
+        beans (`pandas.DataFrame`): Rows to be written.
+    Returns:
+        records (`:obj:`list` of :obj:`dict`): One dictionary per row, missing values as None.
+    """
+
+    values = beans.astype(object).where(beans.notnull(), None).values.tolist()
+    columns = beans.columns.tolist()
+    return [dict(zip(columns, row)) for row in values]
+
+
+def bulk_insert(engine, beans, chunk_size, table=None):
+    """Insert rows into `bean_attributes` in chunks, one transaction per chunk.
+    Args:
+        engine (`sqlalchemy.engine.Engine`): Engine connected to the database.
+        beans (`pandas.DataFrame`): Rows with the column names of `bean_attributes`.
+        chunk_size (`int`): Number of rows inserted per transaction.
+        table (`sqlalchemy.Table`): Table to insert into. Defaults to `bean_attributes`.
+    Returns:
+        rows_per_sec (`float`): Insert throughput.
+    """
+
+    table = BeanAttributes.__table__ if table is None else table
+    start = time.perf_counter()
+    for offset in range(0, len(beans), chunk_size):
+        records = to_records(beans.iloc[offset:offset + chunk_size])
+        with engine.begin() as conn:
+            conn.execute(table.insert(), records)
+        logger.debug('Rows %d to %d added to table', offset, offset + len(records) - 1)
+
+    elapsed = time.perf_counter() - start
+    rows_per_sec = len(beans) / elapsed if elapsed > 0 else float('inf')
+    logger.info("Inserted %d rows in %.2f seconds (%.0f rows/sec)", len(beans), elapsed, rows_per_sec)
+    return rows_per_sec
+
+
+def sync_to_db(engine, beans, chunk_size):
+    """Apply only the inserts, updates and deletes needed to make `bean_attributes` match `beans`.
+
+    Rows are matched on the bean id and compared by content hash. All changes are written in one transaction,
+    so readers see either the old or the new catalog, never a partial one.
+    Args:
+        engine (`sqlalchemy.engine.Engine`): Engine connected to the database.
+        beans (`pandas.DataFrame`): Normalized rows with the column names of `bean_attributes`.
+        chunk_size (`int`): Number of rows per executemany batch.
+    Returns:
+        changes (`dict`): Number of inserted, updated, deleted and unchanged rows.
+    """
+
+    import pandas as pd
+
+    table = BeanAttributes.__table__
+    result = engine.execute(sql.select([table]))
+    current = normalize_beans(pd.DataFrame.from_records(result.fetchall(), columns=result.keys()))
+
+    new_hashes = row_hashes(beans)
+    old_hashes = row_hashes(current)
+    common = new_hashes.index.intersection(old_hashes.index)
+    changed = common[new_hashes[common].values != old_hashes[common].values]
+    inserted = new_hashes.index.difference(old_hashes.index)
+    deleted = old_hashes.index.difference(new_hashes.index)
+
+    beans = beans.set_index('id', drop=False)
+    update_stmt = table.update().where(table.c.id == sql.bindparam('bean_id'))
+    with engine.begin() as conn:
+        for offset in range(0, len(deleted), chunk_size):
+            ids = [int(bean_id) for bean_id in deleted[offset:offset + chunk_size]]
+            conn.execute(table.delete().where(table.c.id.in_(ids)))
+        for offset in range(0, len(changed), chunk_size):
+            records = to_records(beans.loc[changed[offset:offset + chunk_size]].drop(columns='id'))
+            for record, bean_id in zip(records, changed[offset:offset + chunk_size]):
+                record['bean_id'] = int(bean_id)
+            conn.execute(update_stmt, records)
+        for offset in range(0, len(inserted), chunk_size):
+            conn.execute(table.insert(), to_records(beans.loc[inserted[offset:offset + chunk_size]]))
+
+    changes = {'inserted': len(inserted), 'updated': len(changed), 'deleted': len(deleted),
+               'unchanged': len(common) - len(changed)}
+    logger.info("Synced bean_attributes: %(inserted)d inserted, %(updated)d updated, %(deleted)d deleted, "
+                "%(unchanged)d unchanged", changes)
+    return changes
+
+
+def swap_to_db(engine, beans, chunk_size):
+    """Load `beans` into a staging table and swap it in for `bean_attributes` in one atomic step.
+    Args:
+        engine (`sqlalchemy.engine.Engine`): Engine connected to a MySQL or SQLite database.
+        beans (`pandas.DataFrame`): Normalized rows with the column names of `bean_attributes`.
+        chunk_size (`int`): Number of rows inserted per transaction into the staging table.
     Returns:
         None.
     """
 
-    engine = sql.create_engine(engine_string)
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    table = BeanAttributes.__table__
+    staging = sql.Table(table.name + '_staging', sql.MetaData(), *[column.copy() for column in table.columns])
+    staging.drop(engine, checkfirst=True)
+    staging.create(engine)
+    bulk_insert(engine, beans, chunk_size, table=staging)
 
-    # Delete all existing records in the table
-    if config.LOCAL_DB_FLAG:
-        try:
-            session.execute('''DELETE FROM msia_db.bean_attributes''')
-        except:
-            pass
+    if engine.dialect.name == 'mysql':
+        # RENAME TABLE swaps both names atomically
+        with engine.begin() as conn:
+            conn.execute('RENAME TABLE {0} TO {0}_old, {0}_staging TO {0}'.format(table.name))
+            conn.execute('DROP TABLE {}_old'.format(table.name))
+        create_indexes(engine)
     else:
+        # pysqlite runs DDL outside of any transaction, so the swap is begun explicitly on the DBAPI connection:
+        # readers see the old table until the commit
+        statements = ['DROP TABLE {}'.format(table.name), 'ALTER TABLE {0}_staging RENAME TO {0}'.format(table.name)]
+        statements += [str(CreateIndex(index).compile(dialect=engine.dialect)) for index in table.indexes]
+        raw = engine.raw_connection()
+        isolation_level = raw.connection.isolation_level
         try:
-            session.execute('''DELETE FROM bean_attributes''')
-        except:
-            pass
+            raw.connection.isolation_level = None
+            cursor = raw.cursor()
+            cursor.execute('BEGIN')
+            try:
+                for statement in statements:
+                    cursor.execute(statement)
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+        finally:
+            raw.connection.isolation_level = isolation_level
+            raw.close()
+    logger.info("Swapped in %d rows for bean_attributes", len(beans))
 
-    # Read the data table and persist it into the database
-    raw_data = pd.read_csv(config.DATA_TABLE_PATH)
-    raw_data = raw_data.replace(np.nan, '', regex=True)
+
+@metrics.timed('bean_db.persist_to_db')
+def persist_to_db(engine_string, data_path=None, chunk_size=None, mode=None):
+    """Persist the data to database.
+    Args:
+        engine_string (`str`): Engine string for SQLAlchemy.
+        data_path (`str`): Location of the cluster table to be persisted. Defaults to `DATA_TABLE_PATH` in config.py.
+        chunk_size (`int`): Number of rows written per transaction. Defaults to `DB_CHUNK_SIZE` in config.py.
+        mode (`str`): How to load the table, defaults to `DB_LOAD_MODE` in config.py. One of
+            'sync' (only write the rows that changed), 'swap' (load a staging table and swap it in atomically)
+            or 'replace' (delete all rows and reinsert).
+    Returns:
+        None.
+    """
+
+    data_path = data_path or config.DATA_TABLE_PATH
+    chunk_size = chunk_size or config.DB_CHUNK_SIZE
+    mode = mode or config.DB_LOAD_MODE
+
+    engine = create_engine(engine_string, engine_settings(config))
+    Base.metadata.create_all(engine)
 
     try:
-        for i in range(raw_data.shape[0]):
-            bean_row = BeanAttributes(id=int(raw_data.iloc[i]['Unnamed: 0']),
-                                      species=str(raw_data.iloc[i]['Species']),
-                                      owner=str(raw_data.iloc[i]['Owner.1']),
-                                      country=str(raw_data.iloc[i]['Country.of.Origin']),
-                                      farm_name=str(raw_data.iloc[i]['Farm.Name']),
-                                      company=str(raw_data.iloc[i]['Company']),
-                                      region=str(raw_data.iloc[i]['Region']),
-                                      producer=str(raw_data.iloc[i]['Producer']),
-                                      grading_date=str(raw_data.iloc[i]['Grading.Date']),
-                                      processing_method=str(raw_data.iloc[i]['Processing.Method']),
-                                      aroma=float(raw_data.iloc[i]['Aroma']),
-                                      flavor=float(raw_data.iloc[i]['Flavor']),
-                                      aftertaste=float(raw_data.iloc[i]['Aftertaste']),
-                                      acidity=float(raw_data.iloc[i]['Acidity']),
-                                      body=float(raw_data.iloc[i]['Body']),
-                                      balance=float(raw_data.iloc[i]['Balance']),
-                                      uniformity=float(raw_data.iloc[i]['Uniformity']),
-                                      cleancup=float(raw_data.iloc[i]['Clean.Cup']),
-                                      sweetness=float(raw_data.iloc[i]['Sweetness']),
-                                      total_cup_point=float(raw_data.iloc[i]['Total.Cup.Points']),
-                                      moisture=float(raw_data.iloc[i]['Moisture']),
-                                      color=str(raw_data.iloc[i]['Color']),
-                                      cluster=int(raw_data.iloc[i]['cluster'])
-                                      )
-            session.add(bean_row)
-            logger.debug('Row %d added to table ' % i)
-            session.commit()
+        # Read the data table and map it to the table schema
+        beans = read_clusters(data_path)
+
+        changed = True
+        if mode == 'sync':
+            changes = sync_to_db(engine, beans, chunk_size)
+            changed = changes['inserted'] + changes['updated'] + changes['deleted'] > 0
+        elif mode == 'swap' and engine.dialect.name in ('mysql', 'sqlite'):
+            swap_to_db(engine, beans, chunk_size)
+        else:
+            if mode != 'replace':
+                logger.warning("Load mode %s is not supported for %s, replacing all rows", mode, engine.dialect.name)
+            # Delete all existing records in the table
+            with engine.begin() as conn:
+                conn.execute(BeanAttributes.__table__.delete())
+            bulk_insert(engine, beans, chunk_size)
+
+        create_indexes(engine)
+        if changed:
+            stamp_catalog(engine)
     except sql.exc.IntegrityError:  # Check primary key duplication
         logger.error("Duplicated coffee bean")
+        raise
     except Exception as e:
-        logger.error("Incorrect credentials, access denied", e)
+        logger.error("Not able to load the beans into the database: %s", e)
+        raise
     finally:
-        session.close()
+        engine.dispose()
 
 
-if __name__ == "__main__":
+def default_engine_string():
+    """Build the engine string from `SQLALCHEMY_DATABASE_URI`, or from `LOCAL_DB_FLAG` and the MySQL environment.
+    Returns:
+        engine_string (`str`): SQLAlchemy connection string of the bean database.
+    """
+
+    # If users wish to write to their own SQLALCHEMY_DATABASE_URI in the environment
+    if config.SQLALCHEMY_DATABASE_URI is not None:
+        return config.SQLALCHEMY_DATABASE_URI
+
+    # Whether to create a local SQLite database or an AWS RDS database
+    if config.LOCAL_DB_FLAG:
+        return "sqlite:///{}".format(config.LOCAL_DATABASE_PATH)
 
     # Obtain parameters from os
     conn_type = "mysql+pymysql"
@@ -123,24 +413,19 @@ if __name__ == "__main__":
     host = os.environ.get("MYSQL_HOST")
     port = os.environ.get("MYSQL_PORT")
     database = os.environ.get("DATABASE_NAME")
-    local_database_path = config.LOCAL_DATABASE_PATH
+    return "{}://{}:{}@{}:{}/{}".format(conn_type, user, password, host, port, database)
 
-    # If users wish to write to their own SQLALCHEMY_DATABASE_URI in the environment
-    if config.SQLALCHEMY_DATABASE_URI is None:
-        # Whether to create a local SQLite database or an AWS RDS database
-        if config.LOCAL_DB_FLAG:
-            engine_string = "sqlite:///{}".format(local_database_path)
-        else:
-            engine_string = "{}://{}:{}@{}:{}/{}".format(conn_type, user, password, host, port, database)
-    else:
-        engine_string = config.SQLALCHEMY_DATABASE_URI
+
+if __name__ == "__main__":
+
+    metrics.start_run('bean_db', config.METRICS_ENABLED, config.METRICS_REPORT_DIR)
+    Profiler(config.PROFILE_DIR, config.PROFILE_SAMPLE_RATE, config.PROFILE_TOP_N,
+             config.PROFILE_MAX_FILES).start_run('bean_db')
+    engine_string = default_engine_string()
 
     try:
-        engine_string = 'sqlite:///data/bean.db'
         persist_to_db(engine_string)
         logger.info("Data successfully persisted into the database")
     except Exception as e:
         logger.error(e)
         sys.exit(1)
-
-
@@ -0,0 +1,255 @@
+import numpy as np
+
+
+def combine_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    """Combine the counts, means and sums of squared deviations of two sets of values (Chan et al.).
+    Args:
+        count_a, mean_a, m2_a (`numpy.ndarray`): Moments of the first set.
+        count_b, mean_b, m2_b (`numpy.ndarray`): Moments of the second set, same shape as the first.
+    Returns:
+        count, mean, m2 (`numpy.ndarray`): Moments of the union of both sets.
+    """
+
+    count = count_a + count_b
+    safe_count = np.maximum(count, 1)
+    delta = mean_b - mean_a
+    mean = np.where(count > 0, mean_a + delta * count_b / safe_count, 0.0)
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / safe_count
+    return count, mean, m2
+
+
+class ClusterStats(object):
+    """Per-cluster statistics of the features, accumulated in one pass and mergeable.
+
+    For every cluster and feature, the accumulators hold the number of values, their mean, their sum of squared
+    deviations from the mean, their minimum and maximum, and a histogram over fixed bins. Statistics of two sets of
+    beans merge exactly into the statistics of their union, so new beans are added with `update` without rescanning
+    the beans already counted. Quantiles are interpolated within the histogram bins, so their precision is the bin
+    width.
+
+    Like `CentroidPredictor`, the statistics only need NumPy. They are saved by train_model.py as a `.npz` file next
+    to the pickled model.
+    """
+
+    def __init__(self, feature_names, lower, upper, n_bins=512):
+        """
+        Args:
+            feature_names (`:obj:`list` of :obj:`str`): Names of the features.
+            lower (`numpy.ndarray`): Lower edge of the histogram of every feature, shape (n_features,).
+            upper (`numpy.ndarray`): Upper edge of the histogram of every feature, shape (n_features,). Values outside
+                of the edges are counted in the first or last bin.
+            n_bins (`int`): Number of histogram bins per feature.
+        """
+        self.feature_names = list(feature_names)
+        self.lower = np.asarray(lower, dtype=float)
+        self.upper = np.asarray(upper, dtype=float)
+        self.n_bins = int(n_bins)
+        n_features = len(self.feature_names)
+        self.clusters = np.empty(0, dtype=np.int64)
+        self.sizes = np.empty(0, dtype=np.int64)
+        self.count = np.empty((0, n_features), dtype=np.int64)
+        self.mean = np.empty((0, n_features))
+        self.m2 = np.empty((0, n_features))
+        self.min = np.empty((0, n_features))
+        self.max = np.empty((0, n_features))
+        self.hist = np.empty((0, n_features, self.n_bins), dtype=np.int64)
+
+    @classmethod
+    def for_data(cls, feature_names, values, n_bins=512, margin=0.5):
+        """Create empty statistics with histogram edges that cover `values` with some room for later beans.
+        Args:
+            feature_names (`:obj:`list` of :obj:`str`): Names of the features.
+            values (`numpy.ndarray`): Sample of the features, shape (n_beans, n_features).
+            n_bins (`int`): Number of histogram bins per feature.
+            margin (`float`): Room added below the minimum and above the maximum, as a fraction of the range.
+        Returns:
+            stats (`ClusterStats`): Statistics without any bean.
+        """
+        values = np.asarray(values, dtype=float)
+        lower, upper = np.nanmin(values, axis=0), np.nanmax(values, axis=0)
+        width = np.where(upper > lower, upper - lower, 1.0)
+        return cls(feature_names, lower - margin * width, upper + margin * width, n_bins)
+
+    def _empty_like(self):
+        return ClusterStats(self.feature_names, self.lower, self.upper, self.n_bins)
+
+    def _batch(self, clusters, values):
+        """Compute the statistics of one batch of beans."""
+        labels, inverse = np.unique(clusters, return_inverse=True)
+        n_clusters, n_features = len(labels), len(self.feature_names)
+        batch = self._empty_like()
+        batch.clusters = labels.astype(np.int64)
+        batch.sizes = np.bincount(inverse, minlength=n_clusters)
+        batch.count = np.zeros((n_clusters, n_features), dtype=np.int64)
+        batch.mean = np.zeros((n_clusters, n_features))
+        batch.m2 = np.zeros((n_clusters, n_features))
+        batch.min = np.full((n_clusters, n_features), np.inf)
+        batch.max = np.full((n_clusters, n_features), -np.inf)
+        batch.hist = np.zeros((n_clusters, n_features, self.n_bins), dtype=np.int64)
+
+        bin_width = (self.upper - self.lower) / self.n_bins
+        for feature in range(n_features):
+            # Missing values are left out of the statistics of their feature
+            valid = ~np.isnan(values[:, feature])
+            rows, x = inverse[valid], values[valid, feature]
+            count = np.bincount(rows, minlength=n_clusters)
+            mean = np.bincount(rows, x, minlength=n_clusters) / np.maximum(count, 1)
+            batch.count[:, feature] = count
+            batch.mean[:, feature] = mean
+            batch.m2[:, feature] = np.bincount(rows, (x - mean[rows]) ** 2, minlength=n_clusters)
+            np.minimum.at(batch.min[:, feature], rows, x)
+            np.maximum.at(batch.max[:, feature], rows, x)
+            bins = np.clip(np.floor((x - self.lower[feature]) / bin_width[feature]), 0, self.n_bins - 1)
+            batch.hist[:, feature, :] = np.bincount(rows * self.n_bins + bins.astype(np.int64),
+                                                    minlength=n_clusters * self.n_bins).reshape(n_clusters, -1)
+        return batch
+
+    def _add(self, other):
+        """Add the statistics of other beans to these, in place."""
+        if (other.feature_names != self.feature_names or other.n_bins != self.n_bins or
+                not np.array_equal(other.lower, self.lower) or not np.array_equal(other.upper, self.upper)):
+            raise ValueError("Only statistics of the same features and histogram bins can be merged")
+
+        # Align both on the union of their clusters, a cluster missing from one side has no beans there
+        clusters = np.union1d(self.clusters, other.clusters)
+        mine, theirs = self._aligned(clusters), other._aligned(clusters)
+        self.clusters = clusters
+        self.sizes = mine['sizes'] + theirs['sizes']
+        count, self.mean, self.m2 = combine_moments(mine['count'], mine['mean'], mine['m2'],
+                                                    theirs['count'], theirs['mean'], theirs['m2'])
+        self.count = count.astype(np.int64)
+        self.min = np.minimum(mine['min'], theirs['min'])
+        self.max = np.maximum(mine['max'], theirs['max'])
+        self.hist = mine['hist'] + theirs['hist']
+        return self
+
+    def _aligned(self, clusters):
+        """The accumulators with one row per cluster of `clusters`, a superset of `self.clusters`."""
+        rows = np.searchsorted(clusters, self.clusters)
+        shape = (len(clusters), len(self.feature_names))
+        aligned = {'sizes': np.zeros(len(clusters), dtype=np.int64),
+                   'count': np.zeros(shape, dtype=np.int64),
+                   'mean': np.zeros(shape),
+                   'm2': np.zeros(shape),
+                   'min': np.full(shape, np.inf),
+                   'max': np.full(shape, -np.inf),
+                   'hist': np.zeros(shape + (self.n_bins,), dtype=np.int64)}
+        for name, accumulator in aligned.items():
+            accumulator[rows] = getattr(self, name)
+        return aligned
+
+    def update(self, clusters, values):
+        """Add beans to the statistics.
+        Args:
+            clusters (`numpy.ndarray`): Cluster of every bean, shape (n_beans,).
+            values (`numpy.ndarray`): Features of every bean in the order of `feature_names`, shape (n_beans,
+                n_features).
+        Returns:
+            stats (`ClusterStats`): These statistics, updated.
+        """
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return self
+        return self._add(self._batch(np.asarray(clusters).astype(np.int64), values))
+
+    def merge(self, other):
+        """Merge with the statistics of other beans, e.g. of another chunk or another worker.
+        Args:
+            other (`ClusterStats`): Statistics with the same features and histogram bins.
+        Returns:
+            stats (`ClusterStats`): New statistics of the beans of both.
+        """
+        return self._empty_like()._add(self)._add(other)
+
+    def total(self):
+        """Statistics of all the beans, as one cluster labelled -1.
+        Returns:
+            stats (`ClusterStats`): Statistics of the whole population.
+        """
+        total = self._empty_like()
+        for row in range(len(self.clusters)):
+            single = self._empty_like()
+            single.clusters = np.array([-1])
+            for name in ['sizes', 'count', 'mean', 'm2', 'min', 'max', 'hist']:
+                setattr(single, name, getattr(self, name)[row:row + 1])
+            total._add(single)
+        return total
+
+    def variance(self, ddof=0):
+        """Variance of every feature in every cluster, NaN where there are not more than `ddof` values."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > ddof, self.m2 / (self.count - ddof), np.nan)
+
+    def quantiles(self, qs):
+        """Estimate quantiles of every feature in every cluster from the histograms.
+        Args:
+            qs (`:obj:`list` of :obj:`float`): Quantiles to estimate, between 0 and 1.
+        Returns:
+            quantiles (`numpy.ndarray`): Estimates of shape (n_clusters, n_features, len(qs)), NaN without values.
+        """
+
+        cumulative = np.cumsum(self.hist, axis=2)
+        total = cumulative[..., -1:]
+        targets = np.asarray(qs, dtype=float) * total
+        # First bin whose cumulative count reaches the target, interpolating linearly within it
+        bins = np.minimum((cumulative[..., None, :] < targets[..., None]).sum(axis=-1), self.n_bins - 1)
+        before = np.where(bins > 0, np.take_along_axis(cumulative, np.maximum(bins - 1, 0), axis=2), 0)
+        in_bin = np.maximum(np.take_along_axis(self.hist, bins, axis=2), 1)
+        position = bins + np.clip((targets - before) / in_bin, 0, 1)
+        bin_width = (self.upper - self.lower) / self.n_bins
+        estimates = self.lower[:, None] + position * bin_width[:, None]
+        estimates = np.clip(estimates, self.min[..., None], self.max[..., None])
+        return np.where(total > 0, estimates, np.nan)
+
+    def summary(self, qs=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        """Describe every cluster in JSON-serializable form.
+        Args:
+            qs (`:obj:`list` of :obj:`float`): Quantiles to report.
+        Returns:
+            summary (`:obj:`list` of :obj:`dict`): Cluster label, number of beans, and count, mean, standard
+                deviation, minimum, maximum and quantiles of every feature.
+        """
+
+        std = np.sqrt(self.variance(ddof=1))
+        quantiles = self.quantiles(qs)
+        summary = []
+        for row, cluster in enumerate(self.clusters):
+            features = {}
+            for column, name in enumerate(self.feature_names):
+                has_values = self.count[row, column] > 0
+                features[name] = {
+                    'count': int(self.count[row, column]),
+                    'mean': float(self.mean[row, column]) if has_values else None,
+                    'std': float(std[row, column]) if np.isfinite(std[row, column]) else None,
+                    'min': float(self.min[row, column]) if has_values else None,
+                    'max': float(self.max[row, column]) if has_values else None,
+                    'quantiles': {str(q): float(value) if has_values else None
+                                  for q, value in zip(qs, quantiles[row, column])}}
+            summary.append({'cluster': int(cluster), 'beans': int(self.sizes[row]), 'features': features})
+        return summary
+
+    def save(self, stats_path):
+        """Save the statistics as a `.npz` file.
+        Args:
+            stats_path (`str`): Path to save the statistics.
+        Returns:
+            None.
+        """
+        # Most histogram bins are empty, so the file compresses well
+        np.savez_compressed(stats_path, feature_names=np.array(self.feature_names), lower=self.lower,
+                            upper=self.upper, clusters=self.clusters, sizes=self.sizes, count=self.count,
+                            mean=self.mean, m2=self.m2, min=self.min, max=self.max, hist=self.hist)
+
+    @classmethod
+    def load(cls, stats_path):
+        """Load statistics saved with `save`.
+        Args:
+            stats_path (`str`): Path to the `.npz` statistics.
+        Returns:
+            stats (`ClusterStats`): The loaded statistics.
+        """
+        with np.load(stats_path) as saved:
+            stats = cls(saved['feature_names'].tolist(), saved['lower'], saved['upper'], saved['hist'].shape[2])
+            for name in ['clusters', 'sizes', 'count', 'mean', 'm2', 'min', 'max', 'hist']:
+                setattr(stats, name, saved[name])
+        return stats
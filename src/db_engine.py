@@ -0,0 +1,101 @@
+import logging
+
+import sqlalchemy as sql
+from sqlalchemy.engine.url import make_url
+
+logger = logging.getLogger('db-engine')
+
+# Settings of config.py and flaskconfig.py, and their defaults
+SETTINGS = {'DB_POOL_SIZE': 5,
+            'DB_MAX_OVERFLOW': 10,
+            'DB_POOL_RECYCLE': 3600,
+            'DB_POOL_PRE_PING': True,
+            'SQLITE_MMAP_SIZE': 256 * 1024 * 1024,
+            'SQLITE_BUSY_TIMEOUT_MS': 5000}
+
+
+def engine_settings(source):
+    """Collect the engine settings from config.py or from the config of the Flask app.
+    Args:
+        source (`module` or `dict`): The config.py module or `app.config`.
+    Returns:
+        settings (`dict`): Setting names mapped to their values, defaults for the settings that are not set.
+    """
+    if isinstance(source, dict):
+        return {name: source.get(name, default) for name, default in SETTINGS.items()}
+    return {name: getattr(source, name, default) for name, default in SETTINGS.items()}
+
+
+def is_sqlite_file(engine_string):
+    url = make_url(engine_string)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def engine_options(engine_string, settings):
+    """Keyword arguments of `sqlalchemy.create_engine` for a database.
+
+    MySQL connections are pooled, recycled before the server's `wait_timeout` closes them and pinged when they are
+    checked out. SQLite files get a pool of connections too, so that the pragmas of `configure_engine` are applied
+    once per connection rather than once per query.
+    Args:
+        engine_string (`str`): Engine string for SQLAlchemy.
+        settings (`dict`): Settings returned by `engine_settings`.
+    Returns:
+        options (`dict`): Options for `sqlalchemy.create_engine` or `SQLALCHEMY_ENGINE_OPTIONS`.
+    """
+
+    if make_url(engine_string).get_backend_name() == 'sqlite':
+        if not is_sqlite_file(engine_string):
+            return {}
+        return {'poolclass': sql.pool.QueuePool,
+                'pool_size': settings['DB_POOL_SIZE'],
+                'max_overflow': settings['DB_MAX_OVERFLOW'],
+                # A connection is only used by one thread at a time, the one that checked it out of the pool
+                'connect_args': {'check_same_thread': False}}
+    return {'pool_size': settings['DB_POOL_SIZE'],
+            'max_overflow': settings['DB_MAX_OVERFLOW'],
+            'pool_recycle': settings['DB_POOL_RECYCLE'],
+            'pool_pre_ping': settings['DB_POOL_PRE_PING']}
+
+
+def configure_engine(engine, settings):
+    """Apply the per-connection pragmas to every new connection of a SQLite engine.
+
+    In WAL mode, readers see the last committed catalog while bean_db.py loads a new one, instead of waiting for the
+    load to commit. `synchronous=NORMAL` is safe with WAL, and the memory map lets reads skip copying pages.
+    Args:
+        engine (`sqlalchemy.engine.Engine`): Engine to configure. Engines of other databases are left unchanged.
+        settings (`dict`): Settings returned by `engine_settings`.
+    Returns:
+        engine (`sqlalchemy.engine.Engine`): The engine.
+    """
+
+    if engine.dialect.name != 'sqlite':
+        return engine
+
+    pragmas = ['PRAGMA busy_timeout = {:d}'.format(int(settings['SQLITE_BUSY_TIMEOUT_MS'])),
+               'PRAGMA synchronous = NORMAL',
+               'PRAGMA mmap_size = {:d}'.format(int(settings['SQLITE_MMAP_SIZE']))]
+    if is_sqlite_file(str(engine.url)):
+        pragmas.insert(0, 'PRAGMA journal_mode = WAL')
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    sql.event.listen(engine, 'connect', set_pragmas)
+    return engine
+
+
+def create_engine(engine_string, settings):
+    """Create an engine with the pool options and pragmas of this module.
+    Args:
+        engine_string (`str`): Engine string for SQLAlchemy.
+        settings (`dict`): Settings returned by `engine_settings`.
+    Returns:
+        engine (`sqlalchemy.engine.Engine`): The configured engine.
+    """
+    engine = sql.create_engine(engine_string, **engine_options(engine_string, settings))
+    return configure_engine(engine, settings)
@@ -5,9 +5,6 @@ import yaml
 import warnings
 warnings.filterwarnings('ignore')
 import pandas as pd
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import seaborn as sns
 from cycler import cycler
 import datetime
 
@@ -17,10 +14,16 @@ dateplus = lambda x: "%s-%s" % (now, x)
 sys.path.append('./config')
 import config
 
-logging.config.fileConfig(config.LOGGING_CONFIG)
+from storage import read_table, resolve_path
+from render import FigureJob, render
+from cluster_stats import ClusterStats
+from model_registry import find_latest_model, stats_path
+from instrument import metrics
+
+logging.config.fileConfig(config.LOGGING_CONFIG, disable_existing_loggers=False)
 logger = logging.getLogger('evaluate-model')
 
-# Update matplotlib defaults to something nicer
+# matplotlib defaults for the figures of this stage, applied by render.render
 mpl_update = {
     'font.size': 16,
     'axes.prop_cycle': cycler('color', ['#0085ca', '#888b8d', '#00c389', '#f4364c', '#e56db1']),
@@ -36,13 +39,14 @@ mpl_update = {
     'font.family': 'sans-serif',
     'font.sans-serif': 'Tahoma'
 }
-mpl.rcParams.update(mpl_update)
 
 
-def read_data(data_folder):
-    """Read the data frame.
+@metrics.timed('evaluate_model.read_data')
+def read_data(data_folder, columns=None):
+    """Read the data frame in any format of storage.py, inferred from its extension.
     Args:
         data_folder (`str`): Directory of the data.
+        columns (`:obj:`list` of :obj:`str`): Columns to read. All columns are read if None.
     Returns:
         df (`pandas.DataFrame`): Data frame that's read in.
     """
@@ -52,7 +56,7 @@ def read_data(data_folder):
         raise FileNotFoundError
 
     try:
-        df = pd.read_csv(data_folder)
+        df = read_table(data_folder, columns=columns)
     except Exception as e:
         logger.error("Failed to read data from {}".format(data_folder), e)
         pass
@@ -60,54 +64,93 @@ def read_data(data_folder):
     return df
 
 
-def plot_lift(data, feature_names, figs_folder):
+def draw_lift(fig, ax, lifts):
+    """Draw the heatmap of the cluster lifts."""
+    import seaborn as sns
+
+    sns.heatmap(lifts.T, center=1, vmax=2.5, cmap=sns.diverging_palette(10, 220, sep=80, n=7),
+                xticklabels=lifts.index.tolist(), yticklabels=lifts.columns.tolist(), ax=ax)
+    ax.set_xlabel('Cluster number')
+    ax.set_title('Lift in cluster features (Cluster mean/population mean)')
+
+
+@metrics.timed('evaluate_model.load_cluster_stats')
+def load_cluster_stats(model_dir, k, data_path, feature_names, n_bins=512, margin=0.5):
+    """Load the cluster statistics saved with the newest model, or compute them from the data if there are none.
+    Args:
+        model_dir (`str`): Directory with the trained model objects.
+        k (`int`): Number of clusters of the model.
+        data_path (`str`): Location of the data with clusters assigned, read only without saved statistics.
+        feature_names (`:obj:`list` of :obj:`str`): List of feature names.
+        n_bins (`int`): Number of histogram bins per feature of computed statistics.
+        margin (`float`): Room in the histograms of computed statistics, as a fraction of the range.
+    Returns:
+        stats (`cluster_stats.ClusterStats`): Statistics of the features of every cluster.
+    """
+
+    model_path = find_latest_model(model_dir, k)
+    if model_path is not None and os.path.exists(stats_path(model_path)):
+        logger.info("Reading the cluster statistics of %s", model_path)
+        return ClusterStats.load(stats_path(model_path))
+
+    logger.warning("No cluster statistics saved with the model, computing them from %s", data_path)
+    data = read_data(data_path, columns=feature_names + ['cluster'])
+    values = data[feature_names].values
+    return ClusterStats.for_data(feature_names, values, n_bins, margin).update(data['cluster'].values, values)
+
+
+@metrics.timed('evaluate_model.plot_lift')
+def plot_lift(stats, feature_names, figs_folder, n_jobs=None, skip_unchanged=False):
     """Create lift plot of the trained model.
     Args:
-        data (`pandas.DataFrame`): Data with clusters assigned.
+        stats (`cluster_stats.ClusterStats`): Statistics of the features of every cluster.
         feature_names (`:obj:`list` of :obj:`str`): List of feature names.
         figs_folder (`str`): Directory to save the lift plot.
+        n_jobs (`int`): Number of processes rendering the plot.
+        skip_unchanged (`bool`): If true, do not redraw the plot if the lifts did not change.
     Returns:
         None.
     """
 
-    cluster_means = data.groupby('cluster')[feature_names].mean()
-    population_means = data[feature_names].mean()
+    columns = [stats.feature_names.index(name) for name in feature_names]
+    cluster_means = pd.DataFrame(stats.mean[:, columns], index=stats.clusters, columns=feature_names)
+    population_means = stats.total().mean[0, columns]
     lifts = cluster_means.divide(population_means)
 
-    fig, ax = plt.subplots(figsize=(16, 10))
+    fig_path = os.path.join(figs_folder, 'lift-' + now + '.png')
+    render([FigureJob(draw_lift, fig_path, (lifts,), (16, 10))], rc=mpl_update, n_jobs=n_jobs,
+           skip_unchanged=skip_unchanged)
 
-    xticklabels = lifts.index.tolist()
-    yticklabels = lifts.columns.tolist()
 
-    ax = sns.heatmap(lifts.T, center=1, vmax=2.5, cmap=sns.diverging_palette(10, 220, sep=80, n=7),
-                     xticklabels=xticklabels, yticklabels=yticklabels, )
-    ax.set_xlabel('Cluster number')
-    ax.set_title('Lift in cluster features (Cluster mean/population mean)')
-    fig_path = os.path.join(figs_folder, 'lift-' + now + '.png')
-    fig.savefig(fig_path)
+def draw_cluster_counts(fig, ax, cluster_fractions):
+    """Draw the bar chart of the fraction of beans in each cluster."""
+    cluster_fractions.plot(kind="barh", color='#888b8d', alpha=0.5, ax=ax)
+    ax.set_xlabel("Fraction of beans belonging to cluster")
+    ax.set_ylabel("Cluster label")
+    ax.set_title("Relative size of each cluster")
+    ax.get_legend().remove()
 
 
-def count_clusters(data, figs_folder):
+@metrics.timed('evaluate_model.count_clusters')
+def count_clusters(stats, figs_folder, n_jobs=None, skip_unchanged=False):
     """Count the number of coffee beans for each cluster.
     Args:
-        data (`pandas.DataFrame`): Data with clusters assigned.
+        stats (`cluster_stats.ClusterStats`): Statistics of the features of every cluster.
         figs_folder (`str`): Directory to save the result plot.
+        n_jobs (`int`): Number of processes rendering the plot.
+        skip_unchanged (`bool`): If true, do not redraw the plot if the counts did not change.
     Returns:
         None.
     """
 
-    cluster_counts = data.groupby('cluster').count()[['Unnamed: 0']]
+    # Same column as the count of bean ids the csv used to be written from
+    cluster_counts = pd.DataFrame({'Unnamed: 0': stats.sizes}, index=stats.clusters)
     counts_path = os.path.join(figs_folder, 'cluster_counts.csv')
     cluster_counts.to_csv(counts_path, index=False)
 
-    ax = cluster_counts.divide(len(data)).plot(kind="barh", color='#888b8d', alpha=0.5)
-    ax.set_xlabel("Fraction of beans belonging to cluster");
-    ax.set_ylabel("Cluster label");
-    ax.set_title("Relative size of each cluster");
-    ax.get_legend().remove()
     fig_path = os.path.join(figs_folder, 'cluster-counts-' + now + '.png')
-    fig = ax.get_figure()
-    fig.savefig(fig_path)
+    render([FigureJob(draw_cluster_counts, fig_path, (cluster_counts.divide(stats.sizes.sum()),), (12, 8))],
+           rc=mpl_update, n_jobs=n_jobs, skip_unchanged=skip_unchanged)
 
 
 if __name__ == "__main__":
@@ -115,23 +158,28 @@ if __name__ == "__main__":
     The script fetches the trained model, prints the model coefficients and evaluates its prediction accuracy.
     """
 
+    metrics.start_run('evaluate_model', config.METRICS_ENABLED, config.METRICS_REPORT_DIR)
+
     with open(config.YAML_PATH, "r") as f:
         config = yaml.load(f, Loader=yaml.FullLoader)
 
     config_em = config["evaluate_model"]
 
     try:
-        logger.debug("Loading true target values, predictions and the trained model")
-        data_clusters = read_data(config["train_model"]['save_csv']['data_path'])
-        logger.info("Successfully loaded true target values, predictions and the trained model")
+        logger.debug("Loading the cluster statistics of the trained model")
+        feature_names = config['generate_feature']['feature_split']['feature_names']
+        config_tm = config['train_model']
+        data_path = resolve_path(config_tm['save_csv']['data_path'], config['storage']['format'])
+        stats = load_cluster_stats(config_tm['train_model']['save_tmo_path'], config_tm['train_model']['k_chosen'],
+                                   data_path, feature_names, **config_tm['cluster_stats'])
+        logger.info("Successfully loaded the cluster statistics")
     except Exception as e:
-        logger.error("Failed to load the trained model and prediction values.", e)
+        logger.error("Failed to load the cluster statistics.", e)
         sys.exit(1)
 
     try:
-        feature_names = config['generate_feature']['feature_split']['feature_names']
-        plot_lift(data_clusters, feature_names, **config_em['plot_lift'])
-        count_clusters(data_clusters, **config_em['count_clusters'])
+        plot_lift(stats, feature_names, **config_em['plot_lift'], **config['render'])
+        count_clusters(stats, **config_em['count_clusters'], **config['render'])
         logger.info("Successfully created plots for lift and cluster counts.")
     except Exception as e:
         logger.error("Error occurred during creating plots for lift and cluster counts.")
@@ -8,14 +8,18 @@ warnings.filterwarnings('ignore')
 sys.path.append('./config')
 import config
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import pandas as pd
 import datetime
 
+from storage import write_table, resolve_path, ChunkWriter, read_head
+from partitions import source_paths, open_source
+from render import FigureJob, render
+from instrument import metrics
+from profiling import Profiler
+
 from cycler import cycler
 
-# Update matplotlib defaults to something nicer
+# matplotlib defaults for the figures of this stage, applied by render.render
 mpl_update = {
     'font.size': 16,
     'axes.prop_cycle': cycler('color', ['#0085ca', '#888b8d', '#00c389', '#f4364c', '#e56db1']),
@@ -31,19 +35,41 @@ mpl_update = {
     'font.family': 'sans-serif',
     'font.sans-serif': 'Tahoma'
 }
-mpl.rcParams.update(mpl_update)
 
 now = datetime.datetime.now().strftime("%Y-%m-%d")
 dateplus = lambda x: "%s-%s" % (now, x)
 
-logging.config.fileConfig(config.LOGGING_CONFIG)
+logging.config.fileConfig(config.LOGGING_CONFIG, disable_existing_loggers=False)
 logger = logging.getLogger('generate-features')
 
 
+def read_raw_data(file_path, chunk_size=None, **kwargs):
+    """Read the raw data, in chunks if `chunk_size` is set.
+    The raw data is a csv file, compressed with gzip or zstd if its name ends with `.gz` or `.zst`, or a partitioned
+    dataset: a directory, or an S3 prefix ending with '/', that holds the partitions and their manifest (see
+    src/partitions.py). S3 objects are streamed, without a local copy.
+    Args:
+        file_path (`str`): Local path or `s3://bucket/key` URL of the raw data.
+        chunk_size (`int`): Number of rows per chunk, the whole file or partition at once if None.
+        kwargs: Other arguments of `pandas.read_csv`.
+    Yields:
+        data (`pandas.DataFrame`): Rows of the raw data.
+    """
+    for source in source_paths(file_path):
+        logger.debug("Reading %s", source)
+        with open_source(source) as f:
+            if chunk_size is None:
+                yield pd.read_csv(f, **kwargs)
+            else:
+                for chunk in pd.read_csv(f, chunksize=chunk_size, **kwargs):
+                    yield chunk
+
+
+@metrics.timed('generate_features.read_data')
 def read_data(file_path, column_names):
     """Read the data file.
     Args:
-        file_path (`str`): Location of the cloud data.
+        file_path (`str`): Location of the cloud data, see `read_raw_data`.
         column_names (`:obj:`list` of :obj:`str`): List of column names to be saved to the output.
     Returns:
         bean_data (`pandas.DataFrame`): The bean data in a pandas data frame.
@@ -54,7 +80,7 @@ def read_data(file_path, column_names):
         raise FileNotFoundError
 
     try:
-        bean_data = pd.read_csv(file_path, usecols=column_names)
+        bean_data = pd.concat(read_raw_data(file_path, usecols=column_names), ignore_index=True)
         logger.info("Data successfully loaded")
     except Exception as e:
         logger.error("Failed to read data from {}".format(file_path), e)
@@ -76,12 +102,22 @@ def feature_split(data, feature_names):
     return result
 
 
-def histogram(features, figs_folder, figs_name):
+def draw_histogram(fig, ax, values, feat):
+    """Draw the histogram of one feature."""
+    ax.hist([values], bins=40)
+    ax.set_xlabel(' '.join(feat.split('_')).capitalize())
+    ax.set_ylabel('Number of observations')
+
+
+@metrics.timed('generate_features.histogram')
+def histogram(features, figs_folder, figs_name, n_jobs=None, skip_unchanged=False):
     """Create histograms for all features.
     Args:
         features (`pandas.DataFrame`): Features data frame.
         figs_folder (`str`): Directory for bar plots.
         figs_name (`str`): Name for bar plots
+        n_jobs (`int`): Number of processes rendering the histograms, the number of CPUs if None.
+        skip_unchanged (`bool`): If true, do not redraw histograms of features whose values did not change.
     Returns:
         None.
     """
@@ -90,24 +126,78 @@ def histogram(features, figs_folder, figs_name):
     if not figs_folder or not figs_name:
         logger.warning("Directory and name for histograms should be non-empty")
 
-    # Plot histograms for all the features
-    figs = []
-    for feat in features.columns:
-        try:
-            fig, ax = plt.subplots(figsize=(12, 8))
-            ax.hist([features[feat].values], bins=40)
-            ax.set_xlabel(' '.join(feat.split('_')).capitalize())
-            ax.set_ylabel('Number of observations')
-            fig_path = os.path.join(figs_folder, feat + '-' + dateplus(figs_name))
-            fig.savefig(fig_path)
-            figs.append(fig)
-        except Exception as e:
-            logger.error("Failed to plot {}".format(feat), e)
-            pass
+    # Plot histograms for all the features, one figure in memory per rendering process
+    jobs = [FigureJob(draw_histogram, os.path.join(figs_folder, feat + '-' + dateplus(figs_name)),
+                      (features[feat].values, feat), (12, 8)) for feat in features.columns]
+    try:
+        render(jobs, rc=mpl_update, n_jobs=n_jobs, skip_unchanged=skip_unchanged)
+    except Exception as e:
+        logger.error("Failed to plot the histograms")
+        logger.error(e)
 
     return
 
 
+def validate_chunk(chunk, feature_names):
+    """Drop the rows of a chunk whose features are missing or not numeric.
+    Args:
+        chunk (`pandas.DataFrame`): Chunk of the raw data.
+        feature_names (`:obj:`list` of :obj:`str`): List of column names to be used as features.
+    Returns:
+        chunk (`pandas.DataFrame`): The chunk with numeric features and only the valid rows.
+    """
+
+    chunk = chunk.copy()
+    chunk[feature_names] = chunk[feature_names].apply(pd.to_numeric, errors='coerce')
+    valid = chunk[feature_names].notnull().all(axis=1)
+    if not valid.all():
+        logger.warning("Dropped %d rows with missing or non-numeric features", (~valid).sum())
+    return chunk[valid]
+
+
+@metrics.timed('generate_features.stream_features')
+def stream_features(file_path, column_names, feature_names, data_path, chunk_size, dtypes=None, fmt='csv',
+                    export_csv=False):
+    """Read the raw data in chunks, project and validate each chunk and append it to the output file.
+    Peak memory depends on the chunk size and not on the size of the raw data.
+    Args:
+        file_path (`str`): Location of the raw data, see `read_raw_data`.
+        column_names (`:obj:`list` of :obj:`str`): List of column names to be saved to the output.
+        feature_names (`:obj:`list` of :obj:`str`): List of column names to be used as features.
+        data_path (`str`): Path to save the data.
+        chunk_size (`int`): Number of rows per chunk.
+        dtypes (`dict`): Types of the columns, columns not listed are parsed as strings.
+        fmt (`str`): Storage format of the output, 'csv' or 'parquet', written to `data_path` with its extension.
+        export_csv (`bool`): If true, also write the csv file to `data_path` when `fmt` is not csv.
+    Returns:
+        n_rows (`int`): Number of rows written.
+    """
+
+    if not file_path or not data_path:
+        raise FileNotFoundError
+
+    dtypes = dtypes or {}
+    dtypes = {column: dtypes.get(column, str) for column in column_names}
+    writers = [ChunkWriter(resolve_path(data_path, fmt), fmt)]
+    if fmt != 'csv' and export_csv:
+        writers.append(ChunkWriter(data_path, 'csv'))
+    n_rows = 0
+    try:
+        for i, chunk in enumerate(read_raw_data(file_path, chunk_size, usecols=column_names, dtype=dtypes)):
+            chunk = validate_chunk(chunk, feature_names)
+            for writer in writers:
+                writer.write(chunk)
+            n_rows += len(chunk)
+            logger.debug("Chunk %d written, %d rows so far", i, n_rows)
+    finally:
+        for writer in writers:
+            writer.close()
+
+    logger.info("Streamed %d rows to %s", n_rows, writers[0].data_path)
+    return n_rows
+
+
+@metrics.timed('generate_features.save_csv')
 def save_csv(data, data_path):
     """Save the data frame.
     Args:
@@ -130,11 +220,38 @@ if __name__ == "__main__":
     The script reads the acquired data and creates histograms for all the features.
     """
 
+    metrics.start_run('generate_features', config.METRICS_ENABLED, config.METRICS_REPORT_DIR)
+    Profiler(config.PROFILE_DIR, config.PROFILE_SAMPLE_RATE, config.PROFILE_TOP_N,
+             config.PROFILE_MAX_FILES).start_run('generate_features')
+
     with open(config.YAML_PATH, "r") as f:
         config = yaml.load(f, Loader=yaml.FullLoader)
 
     config_gf = config["generate_feature"]
 
+    if config_gf['stream_features']['enabled']:
+        # Stream the raw data to the output and plot the histograms of the first chunk only
+        storage_format = config['storage']['format']
+        if storage_format == 'feather':
+            logger.error("Feather files cannot be written in chunks, set storage: format: to csv or parquet or "
+                         "disable stream_features")
+            sys.exit(1)
+        try:
+            chunk_size = config_gf['stream_features']['chunk_size']
+            data_path = config_gf['save_csv']['data_path']
+            stream_features(feature_names=config_gf['feature_split']['feature_names'], data_path=data_path,
+                            chunk_size=chunk_size, dtypes=config_gf['stream_features']['dtypes'], fmt=storage_format,
+                            export_csv=config['storage']['export_csv'], **config_gf['read_data'])
+            sample = read_head(resolve_path(data_path, storage_format), chunk_size)
+            histogram(feature_split(sample, **config_gf['feature_split']), **config_gf['histogram'],
+                      **config['render'])
+            logger.info("Successfully streamed the data for modeling")
+        except Exception as e:
+            logger.error("Error occurred while streaming the data for modeling.")
+            logger.error(e)
+            sys.exit(1)
+        sys.exit(0)
+
     try:
         logger.debug("Loading data")
         data = read_data(**config_gf['read_data'])
@@ -150,7 +267,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
     try:
-        histogram(features, **config_gf['histogram'])
+        histogram(features, **config_gf['histogram'], **config['render'])
         logger.info("Successfully plot features")
     except Exception as e:
         logger.error("Error occurred while plotting features.", e)
@@ -158,7 +275,11 @@ if __name__ == "__main__":
 
     try:
         logger.debug("Saving data after feature engineering")
-        save_csv(data, **config_gf['save_csv'])
+        storage_format = config['storage']['format']
+        if storage_format != 'csv':
+            write_table(data, resolve_path(config_gf['save_csv']['data_path'], storage_format), storage_format)
+        if storage_format == 'csv' or config['storage']['export_csv']:
+            save_csv(data, **config_gf['save_csv'])
     except Exception as e:
         logger.error("Error occurred while saving the data for modeling.", e)
         sys.exit(1)
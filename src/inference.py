@@ -0,0 +1,68 @@
+import numpy as np
+
+
+class CentroidPredictor(object):
+    """Predicts k-means clusters of unscaled features with plain NumPy.
+
+    Equivalent to `StandardScaler.transform` followed by `KMeans.predict`, without importing sklearn or pandas.
+    The parameters come from the inference artifact written by train_model.save_inference_artifact, a `.npz`
+    file with the scaler `mean` and `scale` and the k-means `centroids`.
+    """
+
+    def __init__(self, mean, scale, centroids, version=None):
+        """
+        Args:
+            mean (`numpy.ndarray`): Feature means of the scaler, shape (n_features,).
+            scale (`numpy.ndarray`): Feature scales of the scaler, shape (n_features,).
+            centroids (`numpy.ndarray`): Cluster centers in the scaled space, shape (k, n_features).
+            version (`str`): Version of the model the parameters belong to.
+        """
+        self.mean = np.asarray(mean, dtype=float)
+        self.scale = np.asarray(scale, dtype=float)
+        self.centroids = np.asarray(centroids, dtype=float)
+        self.version = version
+        self._centroid_norms = (self.centroids ** 2).sum(axis=1)
+
+    @classmethod
+    def load(cls, artifact_path, version=None):
+        """Load the predictor from an inference artifact.
+        Args:
+            artifact_path (`str`): Path to the `.npz` inference artifact.
+            version (`str`): Version of the model the artifact belongs to.
+        Returns:
+            predictor (`CentroidPredictor`): The loaded predictor.
+        """
+        with np.load(artifact_path) as artifact:
+            return cls(artifact['mean'], artifact['scale'], artifact['centroids'], version=version)
+
+    @classmethod
+    def from_models(cls, feat_scaler, kmeans_model, version=None):
+        """Build the predictor from a fitted scaler and k-means model.
+        Args:
+            feat_scaler (`sklearn.preprocessing._data.StandardScaler`): Scaler for standardizing the features.
+            kmeans_model (`sklearn.cluster.KMeans`): Trained model object.
+            version (`str`): Version of the model.
+        Returns:
+            predictor (`CentroidPredictor`): The predictor.
+        """
+        return cls(feat_scaler.mean_, feat_scaler.scale_, kmeans_model.cluster_centers_, version=version)
+
+    @property
+    def n_features(self):
+        return self.centroids.shape[1]
+
+    def predict(self, raw_features):
+        """Predict the clusters of one or more feature vectors.
+        Args:
+            raw_features (`numpy.ndarray`): Unscaled features in the order of `feature_names`, either one vector of
+                shape (n_features,) or a batch of shape (n_samples, n_features).
+        Returns:
+            clusters (`numpy.ndarray`): Array of predicted clusters, shape (n_samples,).
+        """
+        features = np.asarray(raw_features, dtype=float)
+        if features.ndim == 1:
+            features = features.reshape(1, -1)
+        scaled_features = (features - self.mean) / self.scale
+        # Squared distance up to the per-row constant ||x||^2
+        distances = self._centroid_norms - 2 * scaled_features.dot(self.centroids.T)
+        return distances.argmin(axis=1)
@@ -0,0 +1,336 @@
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import datetime
+import functools
+import threading
+
+logger = logging.getLogger('instrument')
+
+# Upper bounds in seconds of the latency histogram buckets, from a fast request to a slow pipeline stage
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                   300.0, 1800.0)
+
+# Prefix of every exported metric
+NAMESPACE = 'bean'
+
+DESCRIPTIONS = {
+    'stage_seconds': 'Wall time of the pipeline stages and instrumented functions',
+    'stage_peak_rss_bytes': 'Peak resident memory of the process at the end of the stage',
+    'stage_rss_growth_bytes': 'Largest increase of the peak resident memory of the process during the stage',
+    'pipeline_stage_seconds': 'Wall time of the stage scripts run by pipeline.py, cached or not',
+    'request_seconds': 'Wall time of the app requests',
+    'request_phase_seconds': 'Wall time of the phases of the app requests',
+    'process_peak_rss_bytes': 'Peak resident memory of the process',
+}
+
+
+def peak_rss_bytes():
+    """Peak resident memory of this process in bytes, None where the `resource` module is not available."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Histogram(object):
+    """Count of the observed values per bucket, with their sum and extremes."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            buckets (`tuple` of `float`): Increasing upper bounds of the buckets, an unbounded bucket is added last.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        # A linear scan is faster than bisect for the few buckets of a latency histogram
+        i = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating within its bucket, None without observations."""
+        if self.count == 0:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= target:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                estimate = lower + (upper - lower) * (target - cumulative) / count
+                return min(max(estimate, self.min), self.max)
+            cumulative += count
+        return self.max
+
+    def summary(self):
+        """Count, sum, mean, extremes and estimated quantiles, in JSON-serializable form."""
+        if self.count == 0:
+            return {'count': 0, 'sum': 0.0}
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count, 'min': self.min,
+                'max': self.max, 'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99)}
+
+
+class _NullTimer(object):
+    """Timer of disabled metrics, which does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, name, labels, track_memory):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.track_memory = track_memory
+
+    def __enter__(self):
+        self.rss_before = peak_rss_bytes() if self.track_memory else None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.metrics.observe(self.name, self.seconds, **self.labels)
+        if self.track_memory and self.rss_before is not None:
+            rss_after = peak_rss_bytes()
+            self.metrics.set_max('stage_peak_rss_bytes', rss_after, **self.labels)
+            self.metrics.set_max('stage_rss_growth_bytes', rss_after - self.rss_before, **self.labels)
+        return False
+
+
+class Metrics(object):
+    """Latency histograms and memory gauges of the pipeline stages and the app requests.
+
+    Stages are timed with the `stage` context manager or the `timed` decorator, which also record the peak resident
+    memory of the process. Requests are timed with `timer`. When the metrics are disabled, the timers return at once
+    and nothing is recorded, so the instrumented code pays one attribute lookup.
+
+    The metrics are exported in the Prometheus text format by `prometheus`, and as a JSON report of the run by
+    `report`. They are kept per process: every gunicorn worker and every stage script has its own.
+    """
+
+    def __init__(self, enabled=True, buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            enabled (`bool`): If false, nothing is recorded.
+            buckets (`tuple` of `float`): Upper bounds in seconds of the histogram buckets.
+        """
+        self.enabled = enabled
+        self.buckets = buckets
+        self.run_name = None
+        self.started_at = datetime.datetime.now()
+        self._histograms = {}
+        self._gauges = {}
+        self._gauge_sources = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, seconds, **labels):
+        """Record one duration in the histogram of a metric and label values."""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(self.buckets))
+        histogram.observe(seconds)
+
+    def set_max(self, name, value, **labels):
+        """Raise a gauge of a metric and label values to `value` if it is lower."""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = max(self._gauges.get(key, value), value)
+
+    def timer(self, name, **labels):
+        """Context manager recording its wall time in the histogram `name`, e.g. a request phase."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels, track_memory=False)
+
+    def stage(self, stage):
+        """Context manager recording the wall time and peak resident memory of a pipeline stage or function."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, 'stage_seconds', {'stage': stage}, track_memory=True)
+
+    def timed(self, stage):
+        """Decorator recording every call of a function as the stage `stage`."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.stage(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def register_gauges(self, name, source):
+        """Export the numbers returned by `source`, e.g. the `stats()` of a cache, as the gauges `<name>_<key>`.
+        Args:
+            name (`str`): Prefix of the gauges.
+            source (`callable`): Function returning a `dict` of numbers, called at every export.
+        """
+        self._gauge_sources.append((name, source))
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._gauges = {}
+
+    def _source_gauges(self):
+        gauges = {('process_peak_rss_bytes', ()): peak_rss_bytes()}
+        for name, source in self._gauge_sources:
+            try:
+                values = source()
+            except Exception as e:
+                logger.warning("Failed to read the %s gauges: %s", name, e)
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges[('{}_{}'.format(name, key), ())] = value
+        return gauges
+
+    def prometheus(self):
+        """Export the metrics in the Prometheus text exposition format.
+        Returns:
+            text (`str`): One `# HELP` and `# TYPE` header per metric, followed by its samples.
+        """
+        lines = []
+        families = {}
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            families.setdefault(name, []).append((labels, histogram))
+        for name, series in families.items():
+            full_name = '{}_{}'.format(NAMESPACE, name)
+            lines.append('# HELP {} {}'.format(full_name, DESCRIPTIONS.get(name, name)))
+            lines.append('# TYPE {} histogram'.format(full_name))
+            for labels, histogram in series:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append('{}_bucket{} {}'.format(full_name, _labels(labels + (('le', le),)), cumulative))
+                lines.append('{}_sum{} {}'.format(full_name, _labels(labels), repr(histogram.sum)))
+                lines.append('{}_count{} {}'.format(full_name, _labels(labels), histogram.count))
+
+        gauges = dict(self._gauges)
+        gauges.update(self._source_gauges())
+        gauge_families = {}
+        for (name, labels), value in sorted(gauges.items()):
+            if value is not None:
+                gauge_families.setdefault(name, []).append((labels, value))
+        for name, series in gauge_families.items():
+            full_name = '{}_{}'.format(NAMESPACE, name)
+            lines.append('# HELP {} {}'.format(full_name, DESCRIPTIONS.get(name, name)))
+            lines.append('# TYPE {} gauge'.format(full_name))
+            for labels, value in series:
+                lines.append('{}{} {}'.format(full_name, _labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        """Describe the run: its duration, peak memory and the statistics of every timed stage and request.
+        Returns:
+            report (`dict`): JSON-serializable report.
+        """
+        finished_at = datetime.datetime.now()
+        report = {'run': self.run_name, 'pid': os.getpid(),
+                  'started_at': self.started_at.isoformat(timespec='seconds'),
+                  'finished_at': finished_at.isoformat(timespec='seconds'),
+                  'seconds': (finished_at - self.started_at).total_seconds(),
+                  'peak_rss_bytes': peak_rss_bytes(), 'stages': {}, 'timers': []}
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            summary = histogram.summary()
+            if name == 'stage_seconds':
+                stage = dict(labels)['stage']
+                summary['peak_rss_bytes'] = self._gauges.get(('stage_peak_rss_bytes', labels))
+                summary['rss_growth_bytes'] = self._gauges.get(('stage_rss_growth_bytes', labels))
+                report['stages'][stage] = summary
+            else:
+                report['timers'].append(dict(summary, name=name, labels=dict(labels)))
+        return report
+
+    def write_report(self, report_dir):
+        """Write the report of the run to `<report_dir>/<run>-<start time>-<pid>.json`, the start time to the
+        microsecond, so that the runs started within the same second keep their own report.
+        Returns:
+            report_path (`str`): Path of the report.
+        """
+        os.makedirs(report_dir, exist_ok=True)
+        report_path = os.path.join(report_dir, '{}-{}-{}.json'.format(
+            self.run_name or 'run', self.started_at.strftime('%Y%m%d-%H%M%S-%f'), os.getpid()))
+        with open(report_path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+        logger.info("Run report written to %s", report_path)
+        return report_path
+
+    def start_run(self, run_name, enabled=True, report_dir=None):
+        """Start recording a batch job, whose report is written to `report_dir` when the process exits.
+        Args:
+            run_name (`str`): Name of the job, e.g. the stage script.
+            enabled (`bool`): If false, nothing is recorded and no report is written.
+            report_dir (`str`): Directory of the run reports, no report if None.
+        Returns:
+            None.
+        """
+        self.enabled = enabled
+        self.run_name = run_name
+        self.started_at = datetime.datetime.now()
+        self.reset()
+        if enabled and report_dir:
+            atexit.register(self._write_report_at_exit, report_dir)
+
+    def _write_report_at_exit(self, report_dir):
+        try:
+            self.write_report(report_dir)
+        except Exception as e:
+            logger.warning("Failed to write the run report: %s", e)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, _escape(value)) for key, value in labels) + '}'
+
+
+# Metrics of this process, shared by the instrumented modules
+metrics = Metrics()
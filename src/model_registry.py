@@ -0,0 +1,174 @@
+import os
+import re
+import sys
+import time
+import pickle
+import logging
+import threading
+from collections import namedtuple
+
+sys.path.append('./src')
+from inference import CentroidPredictor
+from similarity import SimilarityIndex
+from cluster_stats import ClusterStats
+
+logger = logging.getLogger('model-registry')
+
+# Models are saved by train_model.train_model as kmeans-<k>-<date>.pkl
+MODEL_PATTERN = re.compile(r'^kmeans-(\d+)-(\d{4}-\d{2}-\d{2})\.pkl$')
+
+LoadedModel = namedtuple('LoadedModel', ['predictor', 'version', 'fingerprint', 'load_seconds', 'loaded_at', 'index',
+                                         'stats'])
+
+
+def find_latest_model(model_dir, k=None):
+    """Find the newest trained k-means model in a directory.
+    Args:
+        model_dir (`str`): Directory with the trained model objects.
+        k (`int`): Only consider models trained with this number of clusters. All models are considered if None.
+    Returns:
+        model_path (`str`): Path to the newest model, None if there is no model in the directory.
+    """
+
+    candidates = []
+    for entry in os.scandir(model_dir):
+        match = MODEL_PATTERN.match(entry.name)
+        if match is None:
+            continue
+        if k is not None and int(match.group(1)) != int(k):
+            continue
+        # Order by the training date in the file name, then by modification time for same-day retrains
+        candidates.append((match.group(2), entry.stat().st_mtime, entry.path))
+
+    if not candidates:
+        return None
+    return max(candidates)[2]
+
+
+def artifact_path(model_path):
+    """Path of the inference artifact saved next to a pickled model."""
+    return os.path.splitext(model_path)[0] + '.npz'
+
+
+def index_path(model_path):
+    """Path of the similarity index saved next to a pickled model."""
+    return os.path.splitext(model_path)[0] + '.index.npz'
+
+
+def stats_path(model_path):
+    """Path of the cluster statistics saved next to a pickled model."""
+    return os.path.splitext(model_path)[0] + '.stats.npz'
+
+
+class ModelRegistry(object):
+    """Keeps a predictor for the newest k-means model in memory for the lifetime of a worker.
+
+    The predictor is loaded from the model's `.npz` inference artifact when there is one, so that sklearn is never
+    imported by the worker, and built from the pickled scaler and model otherwise. The similarity index of the model
+    and the cluster statistics are loaded with it when train_model.py saved them.
+
+    Requests read an immutable `LoadedModel` snapshot, so a reload swaps the reference in one step and
+    requests that are already running keep scoring with the snapshot they started with.
+    """
+
+    def __init__(self, model_dir, scaler_path, k=None, check_interval=30):
+        """
+        Args:
+            model_dir (`str`): Directory with the trained model objects.
+            scaler_path (`str`): Path to the pickled feature scaler.
+            k (`int`): Number of clusters of the model to serve. The newest model of any k is served if None.
+            check_interval (`float`): Minimum number of seconds between two checks for a newer model.
+        """
+        self.model_dir = model_dir
+        self.scaler_path = scaler_path
+        self.k = k
+        self.check_interval = check_interval
+        self._current = None
+        self._last_check = 0.0
+        self._reload_lock = threading.Lock()
+
+    def _fingerprint(self):
+        """Identify the artifacts on disk by model path and modification times of model, artifact or scaler,
+        similarity index and cluster statistics."""
+        model_path = find_latest_model(self.model_dir, self.k)
+        if model_path is None:
+            raise FileNotFoundError("No trained model found in {}".format(self.model_dir))
+        artifact = artifact_path(model_path)
+        extras = tuple(os.path.getmtime(path) if os.path.exists(path) else None
+                       for path in (index_path(model_path), stats_path(model_path)))
+        if os.path.exists(artifact):
+            return (model_path, os.path.getmtime(model_path), os.path.getmtime(artifact)) + extras
+        return (model_path, os.path.getmtime(model_path), os.path.getmtime(self.scaler_path)) + extras
+
+    def _load(self, fingerprint):
+        """Load the predictor for the model identified by `fingerprint`."""
+        start = time.perf_counter()
+        model_path = fingerprint[0]
+        version = os.path.splitext(os.path.basename(model_path))[0]
+        if os.path.exists(artifact_path(model_path)):
+            predictor = CentroidPredictor.load(artifact_path(model_path), version=version)
+        else:
+            with open(self.scaler_path, 'rb') as f:
+                scaler = pickle.load(f)
+            with open(model_path, 'rb') as f:
+                model = pickle.load(f)
+            predictor = CentroidPredictor.from_models(scaler, model, version=version)
+        index = None
+        if os.path.exists(index_path(model_path)):
+            index = SimilarityIndex.load(index_path(model_path), version=version)
+        stats = None
+        if os.path.exists(stats_path(model_path)):
+            stats = ClusterStats.load(stats_path(model_path))
+        load_seconds = time.perf_counter() - start
+        logger.info("Loaded model %s in %.3f seconds", version, load_seconds)
+        return LoadedModel(predictor, version, fingerprint, load_seconds, time.time(), index, stats)
+
+    def load(self):
+        """Load the newest model synchronously, e.g. once at worker startup.
+        Returns:
+            loaded (`LoadedModel`): The snapshot that is now being served.
+        """
+        with self._reload_lock:
+            self._last_check = time.monotonic()
+            fingerprint = self._fingerprint()
+            if self._current is None or self._current.fingerprint != fingerprint:
+                self._current = self._load(fingerprint)
+            return self._current
+
+    def _refresh(self):
+        """Reload in the background if a newer model was written. Runs with the reload lock held."""
+        try:
+            fingerprint = self._fingerprint()
+            if fingerprint != self._current.fingerprint:
+                self._current = self._load(fingerprint)
+        except Exception as e:
+            logger.error("Failed to reload the model, still serving %s", self._current.version)
+            logger.error(e)
+        finally:
+            self._reload_lock.release()
+
+    def get(self):
+        """Get the snapshot to score with, scheduling a background reload check when one is due.
+        Returns:
+            loaded (`LoadedModel`): The predictor and metadata currently being served.
+        """
+        if self._current is None:
+            return self.load()
+
+        now = time.monotonic()
+        if now - self._last_check >= self.check_interval and self._reload_lock.acquire(blocking=False):
+            self._last_check = now
+            threading.Thread(target=self._refresh, name='model-reload', daemon=True).start()
+        return self._current
+
+    def info(self):
+        """Describe the model being served.
+        Returns:
+            info (`dict`): Model version, load time in seconds and load timestamp; empty if nothing is loaded.
+        """
+        current = self._current
+        if current is None:
+            return {}
+        return {'version': current.version,
+                'load_seconds': current.load_seconds,
+                'loaded_at': current.loaded_at}
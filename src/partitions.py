@@ -0,0 +1,290 @@
+import io
+import os
+import re
+import gzip
+import json
+import hashlib
+import logging
+from contextlib import contextmanager
+
+from s3_transfer import is_s3_url, open_object
+
+logger = logging.getLogger('partitions')
+
+MANIFEST_NAME = 'manifest.json'
+
+# File suffix of every supported compression, zstd needs the zstandard package
+COMPRESSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# Partition of the rows whose partition value is missing
+MISSING_PARTITION = '__missing__'
+
+
+def infer_compression(path):
+    """Infer the compression of a file from its suffix, None if it is not compressed."""
+    for compression, suffix in COMPRESSIONS.items():
+        if compression and path.endswith(suffix):
+            return compression
+    return None
+
+
+def compress(content, compression):
+    """Compress bytes, reproducibly: the same content always gives the same bytes.
+    Args:
+        content (`bytes`): Content to compress.
+        compression (`str`): None, 'gzip' or 'zstd'.
+    Returns:
+        compressed (`bytes`): The compressed content.
+    """
+
+    if compression is None:
+        return content
+    if compression == 'gzip':
+        # A fixed modification time in the gzip header keeps unchanged partitions byte-identical
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as f:
+            f.write(content)
+        return buffer.getvalue()
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=9).compress(content)
+    raise ValueError("Unknown compression {}, expected one of gzip, zstd".format(compression))
+
+
+def decompressed(fileobj, compression):
+    """Wrap a binary file object to read its decompressed content."""
+    if compression is None:
+        return fileobj
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    raise ValueError("Unknown compression {}, expected one of gzip, zstd".format(compression))
+
+
+def is_dataset(path):
+    """A partitioned dataset is a local directory or an S3 prefix ending with '/', holding a manifest."""
+    if is_s3_url(path):
+        return path.endswith('/')
+    return os.path.isdir(path)
+
+
+def join(dataset_path, name):
+    """Path of a file of a dataset, for a local directory or an S3 prefix."""
+    if is_s3_url(dataset_path):
+        return dataset_path + name
+    return os.path.join(dataset_path, name)
+
+
+def manifest_path(dataset_path):
+    return join(dataset_path, MANIFEST_NAME)
+
+
+@contextmanager
+def open_source(path):
+    """Open a local file or an S3 object for reading, decompressing it according to its suffix.
+    Args:
+        path (`str`): Local path or `s3://bucket/key` URL. S3 objects are streamed, without a local copy.
+    Yields:
+        f (file-like): Binary file object of the decompressed content.
+    """
+    raw = open_object(path) if is_s3_url(path) else open(path, 'rb')
+    try:
+        yield decompressed(raw, infer_compression(path))
+    finally:
+        raw.close()
+
+
+def read_manifest(dataset_path):
+    """Read the manifest of a local or S3 dataset.
+    Args:
+        dataset_path (`str`): Local directory or S3 prefix of the dataset.
+    Returns:
+        manifest (`dict`): The manifest, None if the dataset has no manifest yet.
+    """
+    path = manifest_path(dataset_path)
+    if not is_s3_url(path) and not os.path.exists(path):
+        return None
+    with open_source(path) as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def source_paths(path):
+    """Files to read for a raw data path: the partitions of a dataset in manifest order, or the file itself."""
+    if not is_dataset(path):
+        return [path]
+    manifest = read_manifest(path)
+    if manifest is None:
+        raise FileNotFoundError("No {} in the dataset {}".format(MANIFEST_NAME, path))
+    return [join(path, partition['file']) for partition in manifest['partitions']]
+
+
+def partition_values(data, partition_by):
+    """Value of the partition column of every row.
+    Args:
+        data (`pandas.DataFrame`): Raw data.
+        partition_by (`str`): Column to partition by, or 'grading_year' for the year of `Grading.Date`.
+    Returns:
+        values (`pandas.Series`): Partition of every row, as strings.
+    """
+    if partition_by == 'grading_year':
+        values = data['Grading.Date'].astype(str).str.extract(r'(\d{4})', expand=False)
+    else:
+        values = data[partition_by]
+    return values.where(values.notnull(), MISSING_PARTITION).astype(str)
+
+
+def partition_file_name(value, compression):
+    """File name of a partition, readable and unique for every partition value."""
+    safe = re.sub(r'[^A-Za-z0-9_.-]+', '_', value).strip('_.') or 'partition'
+    digest = hashlib.md5(value.encode('utf-8')).hexdigest()[:8]
+    return 'part-{}-{}.csv{}'.format(safe, digest, COMPRESSIONS[compression])
+
+
+def write_partitions(data, dataset_dir, partition_by=None, compression='gzip'):
+    """Write the raw data as compressed csv partitions and a manifest listing them.
+
+    The manifest records the SHA-256 of the uncompressed content of every partition, so that the partitions that
+    changed between two versions of the data are found without transferring the partitions.
+
+    Args:
+        data (`pandas.DataFrame`): Raw data.
+        dataset_dir (`str`): Directory to write the dataset to.
+        partition_by (`str`): Column to partition by, or 'grading_year' for the year of `Grading.Date`. One partition
+            if None.
+        compression (`str`): None, 'gzip' or 'zstd'.
+    Returns:
+        manifest (`dict`): The manifest written to `dataset_dir`.
+    """
+
+    if compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression {}, expected one of gzip, zstd".format(compression))
+    os.makedirs(dataset_dir, exist_ok=True)
+
+    if partition_by is None:
+        groups = [('all', data)]
+    else:
+        groups = data.groupby(partition_values(data, partition_by), sort=True)
+
+    partitions = []
+    for value, rows in groups:
+        content = rows.to_csv(index=False).encode('utf-8')
+        file_name = partition_file_name(value, compression)
+        compressed = compress(content, compression)
+        with open(os.path.join(dataset_dir, file_name), 'wb') as f:
+            f.write(compressed)
+        partitions.append({'value': value, 'file': file_name, 'rows': len(rows), 'bytes': len(content),
+                           'compressed_bytes': len(compressed), 'sha256': hashlib.sha256(content).hexdigest()})
+
+    manifest = {'partition_by': partition_by, 'compression': compression, 'partitions': partitions}
+    write_manifest(manifest, dataset_dir)
+    logger.info("Wrote %d rows in %d partitions to %s, %.1f MB compressed from %.1f MB", len(data), len(partitions),
+                dataset_dir, sum(p['compressed_bytes'] for p in partitions) / 1e6,
+                sum(p['bytes'] for p in partitions) / 1e6)
+    return manifest
+
+
+def write_manifest(manifest, dataset_dir):
+    # Written last and renamed into place, so a dataset never lists partitions that are not there yet
+    path = os.path.join(dataset_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def changed_partitions(manifest, previous):
+    """Partitions of `manifest` that are new or whose content differs from `previous`.
+    Args:
+        manifest (`dict`): Manifest of the new version of the dataset.
+        previous (`dict`): Manifest of the version already transferred, None if there is none.
+    Returns:
+        partitions (`:obj:`list` of :obj:`dict`): Entries of `manifest` to transfer.
+    """
+    known = {p['file']: p['sha256'] for p in (previous or {}).get('partitions', [])}
+    return [p for p in manifest['partitions'] if known.get(p['file']) != p['sha256']]
+
+
+def _remote_manifest(client, bucket, prefix):
+    """Manifest of a dataset in S3, None if there is none."""
+    from botocore.exceptions import ClientError
+
+    try:
+        body = client.get_object(Bucket=bucket, Key=prefix + MANIFEST_NAME)['Body']
+    except ClientError as e:
+        if str(e.response.get('Error', {}).get('Code')) in ('404', 'NoSuchKey'):
+            return None
+        raise
+    return json.loads(body.read().decode('utf-8'))
+
+
+def upload_dataset(client, dataset_dir, bucket, prefix, max_concurrency=8, **transfer_kwargs):
+    """Upload the partitions of a local dataset that changed since the last upload, then its manifest.
+    Args:
+        client (`botocore.client.S3`): S3 client.
+        dataset_dir (`str`): Directory of the dataset, written by `write_partitions`.
+        bucket (`str`): Name of the bucket.
+        prefix (`str`): Prefix of the dataset in the bucket, ending with '/'.
+        max_concurrency (`int`): Number of partitions uploaded at the same time.
+        transfer_kwargs: Other arguments of `s3_transfer.upload`.
+    Returns:
+        uploaded (`:obj:`list` of :obj:`str`): Files of the partitions uploaded.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from s3_transfer import upload
+
+    manifest = read_manifest(dataset_dir)
+    previous = _remote_manifest(client, bucket, prefix)
+    changed = changed_partitions(manifest, previous)
+    # Partitions are small next to the whole data, so they are sent side by side rather than in parts
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        list(pool.map(lambda p: upload(client, os.path.join(dataset_dir, p['file']), bucket, prefix + p['file'],
+                                       max_concurrency=1, skip_unchanged=False, **transfer_kwargs), changed))
+
+    # The new manifest goes up once every partition it lists is in place
+    client.upload_file(os.path.join(dataset_dir, MANIFEST_NAME), bucket, prefix + MANIFEST_NAME)
+    current = {p['file'] for p in manifest['partitions']}
+    for stale in [p['file'] for p in (previous or {}).get('partitions', []) if p['file'] not in current]:
+        client.delete_object(Bucket=bucket, Key=prefix + stale)
+    logger.info("Uploaded %d of %d partitions to s3://%s/%s", len(changed), len(manifest['partitions']), bucket,
+                prefix)
+    return [p['file'] for p in changed]
+
+
+def download_dataset(client, bucket, prefix, dataset_dir, max_concurrency=8, **transfer_kwargs):
+    """Download the partitions of an S3 dataset that changed since the last download, then its manifest.
+    Args:
+        client (`botocore.client.S3`): S3 client.
+        bucket (`str`): Name of the bucket.
+        prefix (`str`): Prefix of the dataset in the bucket, ending with '/'.
+        dataset_dir (`str`): Local directory of the dataset.
+        max_concurrency (`int`): Number of partitions downloaded at the same time.
+        transfer_kwargs: Other arguments of `s3_transfer.download`.
+    Returns:
+        downloaded (`:obj:`list` of :obj:`str`): Files of the partitions downloaded.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from s3_transfer import download
+
+    manifest = _remote_manifest(client, bucket, prefix)
+    if manifest is None:
+        raise FileNotFoundError("No {} under s3://{}/{}".format(MANIFEST_NAME, bucket, prefix))
+    os.makedirs(dataset_dir, exist_ok=True)
+    previous = read_manifest(dataset_dir)
+    # Partitions deleted locally are downloaded again even if their content did not change
+    changed = changed_partitions(manifest, previous)
+    changed += [p for p in manifest['partitions']
+                if p not in changed and not os.path.exists(os.path.join(dataset_dir, p['file']))]
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        list(pool.map(lambda p: download(client, bucket, prefix + p['file'], os.path.join(dataset_dir, p['file']),
+                                         max_concurrency=1, skip_unchanged=False, **transfer_kwargs), changed))
+
+    # The local manifest is replaced last, an interrupted run compares against the previous one again
+    current = {p['file'] for p in manifest['partitions']}
+    write_manifest(manifest, dataset_dir)
+    for stale in [p['file'] for p in (previous or {}).get('partitions', []) if p['file'] not in current]:
+        if os.path.exists(os.path.join(dataset_dir, stale)):
+            os.remove(os.path.join(dataset_dir, stale))
+    logger.info("Downloaded %d of %d partitions of s3://%s/%s", len(changed), len(manifest['partitions']), bucket,
+                prefix)
+    return [p['file'] for p in changed]
@@ -0,0 +1,440 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+import subprocess
+import logging.config
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import yaml
+
+sys.path.append('./config')
+import config
+
+from storage import resolve_path, write_table
+from s3_transfer import is_s3_url, object_etag
+from partitions import is_dataset, manifest_path
+from instrument import metrics
+
+logging.config.fileConfig(config.LOGGING_CONFIG, disable_existing_loggers=False)
+logger = logging.getLogger('pipeline')
+
+HASH_BLOCK_SIZE = 1 << 20
+
+Task = namedtuple('Task', ['name', 'func', 'deps', 'plots'])
+
+# Figures drawn in this process change the global rcParams, so tasks that draw figures take turns
+PLOT_LOCK = threading.Lock()
+
+
+def stage_definitions(config_yaml):
+    """Declare the pipeline stages with what their outputs depend on.
+    Args:
+        config_yaml (`dict`): Parsed config.yaml.
+    Returns:
+        stages (`:obj:`list` of :obj:`dict`): Stages in execution order. Each stage has the script to run, the source
+            modules and config.yaml sections its outputs depend on, its input data files, the directories it writes
+            to and whether its outputs can be cached.
+    """
+
+    storage_format = config_yaml['storage']['format']
+    clean_path = resolve_path(config_yaml['generate_feature']['save_csv']['data_path'], storage_format)
+    clusters_path = resolve_path(config_yaml['train_model']['save_csv']['data_path'], storage_format)
+
+    return [
+        # The raw data lives in S3, so acquiring it cannot be fingerprinted locally
+        {'name': 'acquire_data', 'script': 'src/acquire_data.py', 'sources': [], 'config_sections': [],
+         'inputs': [], 'output_dirs': [], 'cache': False},
+        {'name': 'generate_features', 'script': 'src/generate_features.py',
+         'sources': ['src/storage.py', 'src/render.py', 'src/s3_transfer.py', 'src/partitions.py',
+                     'src/instrument.py', 'src/profiling.py'],
+         'config_sections': ['storage', 'render', 'generate_feature'],
+         'inputs': [config_yaml['generate_feature']['read_data']['file_path']],
+         'output_dirs': ['data', 'figures'], 'cache': True},
+        {'name': 'train_model', 'script': 'src/train_model.py',
+         'sources': ['src/storage.py', 'src/render.py', 'src/similarity.py', 'src/cluster_stats.py',
+                     'src/instrument.py', 'src/profiling.py'],
+         'config_sections': ['storage', 'render', 'generate_feature', 'train_model'], 'inputs': [clean_path],
+         'output_dirs': ['data', 'models', 'figures'], 'cache': True},
+        {'name': 'evaluate_model', 'script': 'src/evaluate_model.py',
+         'sources': ['src/storage.py', 'src/render.py', 'src/cluster_stats.py', 'src/model_registry.py',
+                     'src/instrument.py'],
+         'config_sections': ['storage', 'render', 'generate_feature', 'train_model', 'evaluate_model'],
+         'inputs': [clusters_path], 'output_dirs': ['figures'], 'cache': True},
+    ]
+
+
+class StageCache(object):
+    """Content-addressed cache of stage outputs, keyed by a fingerprint of everything the outputs depend on.
+
+    Output files are stored once per content hash under `objects/`; `stages/<name>-<fingerprint>.json` lists the
+    files a stage produced for a fingerprint. File hashes are memoized by path, size and modification time so that
+    unchanged inputs are not rehashed on every run.
+    """
+
+    def __init__(self, cache_dir, max_cache_mb):
+        """
+        Args:
+            cache_dir (`str`): Directory of the cache.
+            max_cache_mb (`float`): Size of the stored objects above which the least recently used are evicted.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_cache_mb * 1e6
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.stages_dir = os.path.join(cache_dir, 'stages')
+        self.hashes_path = os.path.join(cache_dir, 'hashes.json')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.stages_dir, exist_ok=True)
+        try:
+            with open(self.hashes_path) as f:
+                self._hashes = json.load(f)
+        except (IOError, ValueError):
+            self._hashes = {}
+
+    def file_hash(self, path):
+        """SHA-256 of a file's content, memoized by path, size and modification time."""
+        stat = os.stat(path)
+        key = '{}:{}:{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in self._hashes:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                    digest.update(block)
+            self._hashes[key] = digest.hexdigest()
+        return self._hashes[key]
+
+    def fingerprint(self, stage, config_yaml):
+        """Fingerprint a stage by its script and sources, its config.yaml sections and its input data."""
+        digest = hashlib.sha256(stage['name'].encode())
+        for path in [stage['script']] + stage['sources'] + stage['inputs']:
+            digest.update(path.encode())
+            if is_dataset(path):
+                # The manifest of a partitioned dataset holds the hash of every partition
+                path = manifest_path(path)
+            if is_s3_url(path):
+                # Streamed inputs are fingerprinted by their ETag, which changes with their content
+                digest.update(object_etag(path).encode())
+            else:
+                digest.update(self.file_hash(path).encode() if os.path.exists(path) else b'missing')
+        sections = {section: config_yaml.get(section) for section in stage['config_sections']}
+        digest.update(json.dumps(sections, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _manifest_path(self, stage, fingerprint):
+        return os.path.join(self.stages_dir, '{}-{}.json'.format(stage['name'], fingerprint))
+
+    def restore(self, stage, fingerprint):
+        """Make sure the cached outputs of a stage are in place.
+        Returns:
+            hit (`bool`): True if every output of the stage for this fingerprint is on disk now.
+        """
+        try:
+            with open(self._manifest_path(stage, fingerprint)) as f:
+                outputs = json.load(f)
+        except (IOError, ValueError):
+            return False
+
+        for path, content_hash in outputs.items():
+            if os.path.exists(path) and self.file_hash(path) == content_hash:
+                continue
+            object_path = os.path.join(self.objects_dir, content_hash)
+            if not os.path.exists(object_path):
+                logger.info("Output %s of %s was evicted from the cache", path, stage['name'])
+                return False
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            shutil.copyfile(object_path, path)
+            logger.info("Restored %s from the cache", path)
+
+        for content_hash in outputs.values():
+            os.utime(os.path.join(self.objects_dir, content_hash))
+        return True
+
+    def store(self, stage, fingerprint, outputs):
+        """Store the output files of a stage run under its fingerprint."""
+        manifest = {}
+        for path in outputs:
+            content_hash = self.file_hash(path)
+            object_path = os.path.join(self.objects_dir, content_hash)
+            if not os.path.exists(object_path):
+                shutil.copyfile(path, object_path)
+            os.utime(object_path)
+            manifest[path] = content_hash
+        with open(self._manifest_path(stage, fingerprint), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used objects until the cache fits in its size limit."""
+        objects = [entry for entry in os.scandir(self.objects_dir) if entry.is_file()]
+        total = sum(entry.stat().st_size for entry in objects)
+        for entry in sorted(objects, key=lambda entry: entry.stat().st_mtime):
+            if total <= self.max_bytes:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+            logger.info("Evicted %s from the cache", entry.name)
+
+    def save(self):
+        """Persist the memoized file hashes."""
+        with open(self.hashes_path, 'w') as f:
+            json.dump(self._hashes, f)
+
+
+def snapshot(dirs):
+    """Modification times of all files under some directories."""
+    files = {}
+    for directory in dirs:
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                files[path] = os.stat(path).st_mtime_ns
+    return files
+
+
+def run_stage(stage):
+    """Run the script of a stage in its own interpreter.
+    Returns:
+        outputs (`:obj:`list` of :obj:`str`): Files created or modified under the stage's output directories.
+    """
+    before = snapshot(stage['output_dirs'])
+    result = subprocess.run([sys.executable, stage['script']])
+    if result.returncode != 0:
+        raise RuntimeError("Stage {} failed with exit code {}".format(stage['name'], result.returncode))
+    after = snapshot(stage['output_dirs'])
+    return sorted(path for path, mtime in after.items() if before.get(path) != mtime)
+
+
+def run_pipeline(config_yaml, stages=None, use_cache=True):
+    """Run the pipeline stages in order, skipping the stages whose outputs are cached for their fingerprint.
+    Args:
+        config_yaml (`dict`): Parsed config.yaml.
+        stages (`:obj:`list` of :obj:`str`): Names of the stages to run, all stages if None.
+        use_cache (`bool`): If false, run every stage and do not read or write the cache.
+    Returns:
+        report (`:obj:`list` of :obj:`dict`): Stage name, whether it was skipped and its wall time in seconds.
+    """
+
+    cache = StageCache(**config_yaml['pipeline']['cache']) if use_cache else None
+    report = []
+    try:
+        for stage in stage_definitions(config_yaml):
+            if stages is not None and stage['name'] not in stages:
+                continue
+            start = time.perf_counter()
+            cacheable = cache is not None and stage['cache']
+            # Fingerprint after the previous stages ran, their outputs are this stage's inputs
+            fingerprint = cache.fingerprint(stage, config_yaml) if cacheable else None
+            skipped = cacheable and cache.restore(stage, fingerprint)
+            if skipped:
+                logger.info("Skipped %s, outputs are cached for fingerprint %s", stage['name'], fingerprint[:12])
+            else:
+                logger.info("Running %s", stage['name'])
+                outputs = run_stage(stage)
+                if cacheable:
+                    cache.store(stage, fingerprint, outputs)
+            seconds = time.perf_counter() - start
+            metrics.observe('pipeline_stage_seconds', seconds, stage=stage['name'], cached=str(skipped).lower())
+            report.append({'stage': stage['name'], 'skipped': skipped, 'seconds': seconds})
+    finally:
+        if cache is not None:
+            cache.save()
+    return report
+
+
+def _run_task(task, inputs, start):
+    """Run a task on the results of its dependencies, timing it relative to the start of the run."""
+    began = time.perf_counter()
+    with metrics.stage('pipeline.' + task.name):
+        if task.plots:
+            with PLOT_LOCK:
+                result = task.func(*inputs)
+        else:
+            result = task.func(*inputs)
+    return result, began - start, time.perf_counter() - began
+
+
+def run_dag(tasks, max_workers=4):
+    """Run tasks in a thread pool as soon as the tasks they depend on finished.
+    Args:
+        tasks (`:obj:`list` of :obj:`Task`): Tasks to run. A task is called with the results of its `deps` in order
+            and the tasks with `plots` set never run at the same time as each other.
+        max_workers (`int`): Number of tasks that run concurrently.
+    Returns:
+        results (`dict`): Result of each task by name.
+        report (`:obj:`list` of :obj:`dict`): Task name, its start in seconds since the start of the run and its wall
+            time in seconds, in the order the tasks finished.
+    """
+
+    names = {task.name for task in tasks}
+    for task in tasks:
+        missing = [dep for dep in task.deps if dep not in names]
+        if missing:
+            raise ValueError("Task {} depends on unknown tasks {}".format(task.name, ', '.join(missing)))
+
+    pending = {task.name: task for task in tasks}
+    results = {}
+    report = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pipeline') as pool:
+        running = {}
+        while pending or running:
+            for task in [task for task in pending.values() if all(dep in results for dep in task.deps)]:
+                del pending[task.name]
+                inputs = [results[dep] for dep in task.deps]
+                running[pool.submit(_run_task, task, inputs, start)] = task
+            if not running:
+                raise ValueError("Tasks {} depend on each other".format(', '.join(pending)))
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    results[task.name], began, seconds = future.result()
+                except Exception:
+                    logger.error("Task %s failed", task.name)
+                    for other in running:
+                        other.cancel()
+                    raise
+                report.append({'stage': task.name, 'start': began, 'seconds': seconds})
+                logger.info("Finished %s in %.2f seconds", task.name, seconds)
+    return results, report
+
+
+def dag_supported(config_yaml):
+    """The DAG shares whole data frames between tasks, the streaming modes need the stage scripts."""
+    return not (config_yaml['generate_feature']['stream_features']['enabled'] or
+                config_yaml['train_model']['train_model'].get('backend', 'kmeans') == 'minibatch')
+
+
+def dag_tasks(config_yaml, load_db=False):
+    """Declare the feature, training and evaluation steps as tasks that pass data frames in memory.
+    Args:
+        config_yaml (`dict`): Parsed config.yaml.
+        load_db (`bool`): If true, also persist the clusters to the bean database.
+    Returns:
+        tasks (`:obj:`list` of :obj:`Task`): The tasks of the pipeline.
+    """
+
+    # The stage modules are only needed here, running the cached stage scripts does not pay for their imports
+    import generate_features as gf
+    import train_model as tm
+    import evaluate_model as em
+
+    config_gf = config_yaml['generate_feature']
+    config_tm = config_yaml['train_model']
+    config_em = config_yaml['evaluate_model']
+    feature_names = config_gf['feature_split']['feature_names']
+    storage_format = config_yaml['storage']['format']
+
+    def save_table(data, data_path):
+        if storage_format != 'csv':
+            write_table(data, resolve_path(data_path, storage_format), storage_format)
+        if storage_format == 'csv' or config_yaml['storage']['export_csv']:
+            write_table(data, data_path, 'csv')
+
+    def scale(data):
+        data_model = data[feature_names]
+        data_scaler = tm.get_scaler(data_model, feature_names, **config_tm['get_scaler'])
+        return data_scaler, data_model, tm.stand_feat(data_model, feature_names, data_scaler)
+
+    def fit(data, scaled):
+        data_scaler, data_model, scaled_features = scaled
+        model = tm.train_model(scaled_features, **config_tm['train_model'])
+        model_name = 'kmeans-' + str(config_tm['train_model']['k_chosen']) + '-' + tm.now
+        save_tmo_path = config_tm['train_model']['save_tmo_path']
+        tm.save_inference_artifact(data_scaler, model, os.path.join(save_tmo_path, model_name + '.npz'))
+        config_index = config_tm['similarity_index']
+        tm.save_similarity_index(data_scaler, model, data[config_index['id_column']].values, data_model.values,
+                                 os.path.join(save_tmo_path, model_name + '.index.npz'),
+                                 exact_max=config_index['exact_max'], list_size=config_index['list_size'],
+                                 random_state=config_tm['train_model']['random_state'])
+        return tm.predict_cluster(data_scaler, data_model, model)
+
+    def cluster_stats(scaled, clusters_pred):
+        stats_name = 'kmeans-' + str(config_tm['train_model']['k_chosen']) + '-' + tm.now + '.stats.npz'
+        return tm.save_cluster_stats(scaled[1].values, clusters_pred, feature_names,
+                                     os.path.join(config_tm['train_model']['save_tmo_path'], stats_name),
+                                     **config_tm['cluster_stats'])
+
+    def label(data, clusters_pred):
+        data_full = data.copy()
+        data_full['cluster'] = clusters_pred
+        return data_full
+
+    sweep_config = {key: value for key, value in config_tm['plot_sil_iner'].items() if key != 'figs_folder'}
+    config_render = config_yaml['render']
+    tasks = [
+        Task('read_data', lambda: gf.read_data(**config_gf['read_data']), [], False),
+        Task('feature_split', lambda data: gf.feature_split(data, **config_gf['feature_split']), ['read_data'], False),
+        Task('histogram', lambda features: gf.histogram(features, **config_gf['histogram'], **config_render),
+             ['feature_split'], True),
+        Task('save_features', lambda data: save_table(data, config_gf['save_csv']['data_path']), ['read_data'], False),
+        Task('scale', scale, ['read_data'], False),
+        Task('sweep_k', lambda scaled: tm.sweep_k(scaled[2], **sweep_config), ['scale'], False),
+        Task('plot_sil_iner', lambda results: tm.plot_k_sweep(results, config_tm['plot_sil_iner']['figs_folder'],
+                                                              **config_render), ['sweep_k'], True),
+        Task('train_model', fit, ['read_data', 'scale'], False),
+        Task('cluster_stats', cluster_stats, ['scale', 'train_model'], False),
+        Task('label_clusters', label, ['read_data', 'train_model'], False),
+        Task('save_clusters', lambda data_full: save_table(data_full, config_tm['save_csv']['data_path']),
+             ['label_clusters'], False),
+        Task('plot_lift', lambda stats: em.plot_lift(stats, feature_names, **config_em['plot_lift'], **config_render),
+             ['cluster_stats'], True),
+        Task('count_clusters', lambda stats: em.count_clusters(stats, **config_em['count_clusters'], **config_render),
+             ['cluster_stats'], True),
+    ]
+
+    if load_db:
+        import bean_db
+        clusters_path = resolve_path(config_tm['save_csv']['data_path'], storage_format)
+        tasks.append(Task('persist_to_db', lambda _: bean_db.persist_to_db(bean_db.default_engine_string(),
+                                                                           data_path=clusters_path),
+                          ['save_clusters'], False))
+    return tasks
+
+
+if __name__ == "__main__":
+    """
+    The script runs the model pipeline, skipping the stages whose inputs, config and source did not change.
+    """
+
+    parser = argparse.ArgumentParser(description="Run the model pipeline with stage caching")
+    parser.add_argument('--stages', nargs='+', default=None, help="Names of the stages to run, all if omitted")
+    parser.add_argument('--no-cache', action='store_true', help="Rerun every stage without using the cache")
+    parser.add_argument('--dag', action='store_true',
+                        help="Run the stages after acquire_data in one process, with independent steps in parallel")
+    args = parser.parse_args()
+    metrics.start_run('pipeline', config.METRICS_ENABLED, config.METRICS_REPORT_DIR)
+
+    with open(config.YAML_PATH, "r") as f:
+        config_yaml = yaml.load(f, Loader=yaml.FullLoader)
+
+    config_dag = config_yaml['pipeline']['dag']
+    if args.dag and not dag_supported(config_yaml):
+        logger.warning("The streaming modes run as separate stages, ignoring --dag")
+        args.dag = False
+
+    try:
+        if args.dag:
+            report = []
+            if args.stages is None or 'acquire_data' in args.stages:
+                report = run_pipeline(config_yaml, stages=['acquire_data'], use_cache=False)
+            _, dag_report = run_dag(dag_tasks(config_yaml, load_db=config_dag['load_db']),
+                                    max_workers=config_dag['max_workers'])
+            report.extend(dag_report)
+        else:
+            report = run_pipeline(config_yaml, stages=args.stages, use_cache=not args.no_cache)
+    except Exception as e:
+        logger.error("Pipeline failed.")
+        logger.error(e)
+        sys.exit(1)
+
+    for row in report:
+        if 'start' in row:
+            logger.info("%-20s started %8.2f s  took %8.2f s", row['stage'], row['start'], row['seconds'])
+        else:
+            logger.info("%-20s %-8s %8.2f s", row['stage'], 'cached' if row['skipped'] else 'ran', row['seconds'])
@@ -0,0 +1,176 @@
+import io
+import os
+import hmac
+import glob
+import time
+import atexit
+import random
+import pstats
+import logging
+import cProfile
+import datetime
+import threading
+
+logger = logging.getLogger('profiling')
+
+
+class _NullProfile(object):
+    """Profile of a call that is not profiled, which does nothing."""
+    path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PROFILE = _NullProfile()
+
+
+class _Profile(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.path = None
+
+    def start(self):
+        self.profile = cProfile.Profile()
+        self.start_time = time.perf_counter()
+        try:
+            self.profile.enable()
+        except ValueError as e:
+            # Since Python 3.12, another profiler such as a debugger or coverage tool may already be active
+            logger.warning("Not profiling %s: %s", self.name, e)
+            self.profile = None
+            self.profiler._lock.release()
+
+    def stop(self):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        seconds = time.perf_counter() - self.start_time
+        try:
+            self.path = self.profiler.dump(self.profile, self.name, seconds)
+        except Exception as e:
+            logger.warning("Failed to save the profile of %s: %s", self.name, e)
+        finally:
+            self.profiler._lock.release()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+class Profiler(object):
+    """Profile a sample of the calls of a request handler or a script run with cProfile.
+
+    A call is profiled when it is forced, e.g. by an admin request, or at random with probability `sample_rate`, so
+    that a low rate can be left on in production: the calls that are not profiled only draw a random number. Each
+    profile is saved as `<name>-<time>-<pid>.prof`, to be opened with `pstats` or snakeviz, next to a `.txt` summary of
+    the top functions by cumulative and own time.
+
+    cProfile only profiles the thread that started it, and one profile runs at a time per process: a call that would
+    start a second one is not profiled.
+    """
+
+    def __init__(self, profile_dir, sample_rate=0.0, top_n=30, max_profiles=100, admin_token=None):
+        """
+        Args:
+            profile_dir (`str`): Directory the profiles are saved to.
+            sample_rate (`float`): Fraction of the calls profiled, 0 to only profile forced calls, 1 for all of them.
+            top_n (`int`): Number of functions listed in the summaries.
+            max_profiles (`int`): Number of profiles kept in `profile_dir`, the oldest are deleted. None keeps all.
+            admin_token (`str`): Secret that forces profiling when passed to `is_admin`, never if None.
+        """
+        self.profile_dir = profile_dir
+        self.sample_rate = sample_rate
+        self.top_n = top_n
+        self.max_profiles = max_profiles
+        self.admin_token = admin_token
+        self._lock = threading.Lock()
+
+    def is_admin(self, token):
+        """Whether `token`, e.g. the value of a request header, is the admin token."""
+        if not self.admin_token or not token:
+            return False
+        return hmac.compare_digest(str(token).encode('utf-8'), self.admin_token.encode('utf-8'))
+
+    def profile(self, name, forced=False):
+        """Context manager profiling its block if the call is forced or sampled.
+        Args:
+            name (`str`): Name of the profiled handler or script, the prefix of the profile files.
+            forced (`bool`): If true, profile the call whatever the sample rate.
+        Returns:
+            profile: Context manager whose `path` is the saved profile once the block exits, None if not profiled.
+        """
+        if not forced and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            return _NULL_PROFILE
+        if not self._lock.acquire(blocking=False):
+            logger.info("Not profiling %s, another profile is running", name)
+            return _NULL_PROFILE
+        return _Profile(self, name)
+
+    def start_run(self, run_name):
+        """Profile the rest of a script run if it is sampled, the profile is saved when the process exits.
+        Args:
+            run_name (`str`): Name of the script.
+        Returns:
+            profiled (`bool`): Whether the run is profiled.
+        """
+        profile = self.profile(run_name)
+        if profile is _NULL_PROFILE:
+            return False
+        profile.start()
+        atexit.register(profile.stop)
+        logger.info("Profiling the %s run", run_name)
+        return True
+
+    def summary(self, profile, name, seconds):
+        """Describe the top functions of a profile by cumulative and by own time.
+        Returns:
+            summary (`str`): Text listing of the `top_n` functions of each order.
+        """
+        stream = io.StringIO()
+        stream.write('Profile of {} ({:.3f} s, pid {})\n'.format(name, seconds, os.getpid()))
+        stats = pstats.Stats(profile, stream=stream).strip_dirs()
+        for sort in ['cumulative', 'tottime']:
+            stream.write('\nTop {} functions by {} time\n'.format(self.top_n, 'own' if sort == 'tottime' else sort))
+            stats.sort_stats(sort).print_stats(self.top_n)
+        return stream.getvalue()
+
+    def dump(self, profile, name, seconds):
+        """Save a profile and its summary to `profile_dir`, then delete the oldest profiles over `max_profiles`.
+        Returns:
+            profile_path (`str`): Path of the `.prof` file.
+        """
+        os.makedirs(self.profile_dir, exist_ok=True)
+        base = os.path.join(self.profile_dir, '{}-{}-{}'.format(
+            name, datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'), os.getpid()))
+        profile.dump_stats(base + '.prof')
+        with open(base + '.txt', 'w') as f:
+            f.write(self.summary(profile, name, seconds))
+        logger.info("Profile of %s (%.3f s) saved to %s.prof", name, seconds, base)
+
+        if self.max_profiles is not None:
+            # Several workers may prune the directory at once, a profile deleted by another one is skipped
+            saved = sorted(glob.glob(os.path.join(self.profile_dir, '*.prof')), key=_mtime)
+            for old in saved[:max(len(saved) - self.max_profiles, 0)]:
+                for path in [old, os.path.splitext(old)[0] + '.txt']:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+        return base + '.prof'
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
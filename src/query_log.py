@@ -0,0 +1,149 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+
+import sqlalchemy as sql
+
+logger = logging.getLogger('query-log')
+
+# Put on the queue to stop the writer
+_STOP = object()
+
+
+class QueryLog(object):
+    """Logs user queries to the database off the request path.
+
+    Requests put records on a bounded in-memory queue and return immediately. A background thread takes them off the
+    queue and inserts them in batches of up to `batch_size` records, at least every `flush_ms` milliseconds. When the
+    database falls behind and the queue is full, requests wait at most `block_ms` milliseconds for room and then drop
+    their record, counting it in `stats()`.
+
+    The writer thread is started by the first record of each process, so that workers forked from a preloaded master
+    each run their own writer.
+    """
+
+    def __init__(self, engine, table, max_queue=10000, batch_size=100, flush_ms=500, block_ms=0):
+        """
+        Args:
+            engine (`sqlalchemy.engine.Engine`): Engine connected to the database.
+            table (`sqlalchemy.Table`): The `user_query` table.
+            max_queue (`int`): Maximum number of records waiting to be written.
+            batch_size (`int`): Maximum number of records inserted per transaction.
+            flush_ms (`float`): Maximum number of milliseconds a record waits for its batch to fill up.
+            block_ms (`float`): Maximum number of milliseconds a request waits for room on a full queue.
+        """
+        self.engine = engine
+        self.table = table
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_ms = flush_ms
+        self.block_ms = block_ms
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_writer(self):
+        """Start the writer thread of this process if it is not running yet."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._thread = threading.Thread(target=self._run, name='query-log-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.close)
+
+    def submit(self, record):
+        """Queue a user query to be written.
+        Args:
+            record (`dict`): Values of the `user_query` columns.
+        Returns:
+            queued (`bool`): False if the record was dropped because the queue was full.
+        """
+        self._ensure_writer()
+        try:
+            if self.block_ms > 0:
+                self._queue.put(record, timeout=self.block_ms / 1000)
+            else:
+                self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning("Query log queue is full, %d records dropped so far", self.dropped)
+            return False
+
+    def _write(self, batch):
+        """Insert one batch of records in one transaction."""
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(self.table.insert(), batch)
+            self.written += len(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            logger.error("Failed to write %d user queries", len(batch))
+            logger.error(e)
+
+    def _run(self):
+        """Take records off the queue and write them in batches until stopped."""
+        try:
+            self.table.create(self.engine, checkfirst=True)
+        except sql.exc.DBAPIError as e:
+            # Workers starting at the same time race to create the table
+            if not self.engine.has_table(self.table.name):
+                logger.error("Failed to create the %s table", self.table.name)
+                logger.error(e)
+
+        stopped = False
+        while not stopped:
+            record = self._queue.get()
+            if record is _STOP:
+                break
+            batch = [record]
+            deadline = time.monotonic() + self.flush_ms / 1000
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    record = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    stopped = True
+                    break
+                batch.append(record)
+            self._write(batch)
+
+    def close(self, timeout=5):
+        """Write the queued records and stop the writer of this process.
+        Args:
+            timeout (`float`): Maximum number of seconds to wait for the queued records to be written.
+        """
+        if self._pid != os.getpid() or self._thread is None or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.warning("Query log queue is full, %d queued records are not written", self._queue.qsize())
+            return
+        self._thread.join(timeout)
+
+    def stats(self):
+        """Describe the log.
+        Returns:
+            stats (`dict`): Number of queued, written, dropped and failed records.
+        """
+        return {'queued': self._queue.qsize() if self._pid == os.getpid() else 0,
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed}
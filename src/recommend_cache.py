@@ -0,0 +1,125 @@
+import time
+import logging
+import threading
+
+import sqlalchemy as sql
+
+logger = logging.getLogger('recommend-cache')
+
+
+class TopKCache(object):
+    """Keeps the top beans by total cup point of the whole catalog and of every cluster in memory.
+
+    The cache is rebuilt when the catalog version stamped by bean_db.persist_to_db changes. The version is
+    checked at most once every `check_interval` seconds, so serving from the cache runs no SQL in between.
+    """
+
+    def __init__(self, engine, bean_table, version_table, k, check_interval=10):
+        """
+        Args:
+            engine (`sqlalchemy.engine.Engine`): Engine connected to the database.
+            bean_table (`sqlalchemy.Table`): The `bean_attributes` table.
+            version_table (`sqlalchemy.Table`): The `catalog_version` table.
+            k (`int`): Number of beans kept per cluster.
+            check_interval (`float`): Minimum number of seconds between two checks of the catalog version.
+        """
+        self.engine = engine
+        self.bean_table = bean_table
+        self.version_table = version_table
+        self.k = k
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._entries = None
+        self._last_check = 0.0
+        self._refresh_lock = threading.Lock()
+
+    def _catalog_version(self, conn):
+        """Read the catalog version, None if the catalog has never been stamped."""
+        try:
+            return conn.execute(sql.select([self.version_table.c.version])).scalar()
+        except sql.exc.DBAPIError:
+            return None
+
+    def _query_top(self, conn, cluster):
+        """Query the top beans of a cluster, or of the whole catalog if `cluster` is None."""
+        table = self.bean_table
+        query = sql.select([table])
+        if cluster is not None:
+            query = query.where(table.c.cluster == cluster)
+        query = query.order_by(table.c.total_cup_point.desc()).limit(self.k)
+        return [dict(row) for row in conn.execute(query)]
+
+    def load(self):
+        """Build the cache for the whole catalog and for every cluster in it.
+        Returns:
+            version (`str`): Catalog version the cache was built from.
+        """
+        start = time.perf_counter()
+        with self.engine.connect() as conn:
+            version = self._catalog_version(conn)
+            cluster_column = self.bean_table.c.cluster
+            clusters = [row[0] for row in conn.execute(sql.select([cluster_column]).
+                                                       where(cluster_column.isnot(None)).distinct())]
+            entries = {None: self._query_top(conn, None)}
+            for cluster in clusters:
+                entries[cluster] = self._query_top(conn, cluster)
+
+        self._version, self._entries = version, entries
+        self._last_check = time.monotonic()
+        logger.info("Cached top %d beans of %d clusters for catalog version %s in %.3f seconds",
+                    self.k, len(clusters), version, time.perf_counter() - start)
+        return version
+
+    def _refresh(self):
+        """Rebuild the cache if the catalog version changed since it was built."""
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval or not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_check = now
+            with self.engine.connect() as conn:
+                version = self._catalog_version(conn)
+            if version != self._version:
+                logger.info("Catalog version changed from %s to %s", self._version, version)
+                self.load()
+        except Exception as e:
+            logger.error("Failed to refresh the cache, still serving catalog version %s", self._version)
+            logger.error(e)
+        finally:
+            self._refresh_lock.release()
+
+    def get(self, cluster=None):
+        """Get the top beans of a cluster.
+        Args:
+            cluster (`int`): The cluster label, or None for the top beans of the whole catalog.
+        Returns:
+            beans (`:obj:`list` of :obj:`dict`): At most `k` rows of `bean_attributes` by total cup point.
+        """
+        if self._entries is None:
+            self.load()
+        else:
+            self._refresh()
+
+        entries = self._entries
+        beans = entries.get(cluster)
+        if beans is not None:
+            self.hits += 1
+            return beans
+
+        self.misses += 1
+        with self.engine.connect() as conn:
+            beans = self._query_top(conn, cluster)
+        entries[cluster] = beans
+        return beans
+
+    def stats(self):
+        """Describe the cache.
+        Returns:
+            stats (`dict`): Catalog version, number of cached entries and hit/miss counters.
+        """
+        return {'version': self._version,
+                'entries': len(self._entries or {}),
+                'hits': self.hits,
+                'misses': self.misses}
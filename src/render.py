@@ -0,0 +1,109 @@
+import os
+import pickle
+import hashlib
+import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger('render')
+
+# Extension of the file next to a figure holding the hash of the data it was drawn from
+HASH_SUFFIX = '.sha256'
+
+# `draw(fig, ax, *args)` draws one figure of size `figsize` that is saved to `fig_path`
+FigureJob = namedtuple('FigureJob', ['draw', 'fig_path', 'args', 'figsize'])
+
+
+def _content(arg):
+    """Reduce an argument of a drawing function to its content, independent of how its data frame was built."""
+    if isinstance(arg, (pd.DataFrame, pd.Series)):
+        names = list(arg.columns) if isinstance(arg, pd.DataFrame) else [arg.name]
+        return names, pd.util.hash_pandas_object(arg, index=True).values.tobytes()
+    if isinstance(arg, np.ndarray):
+        return arg.dtype.str, arg.shape, arg.tobytes()
+    return arg
+
+
+def data_hash(job, rc=None):
+    """Hash the drawing function, data and style of a figure."""
+    # The function's module is left out, it is __main__ when the stage runs as a script
+    payload = (job.draw.__name__, [_content(arg) for arg in job.args], job.figsize, sorted((rc or {}).items()))
+    return hashlib.sha256(pickle.dumps(payload, protocol=4)).hexdigest()
+
+
+def saved_hash(fig_path):
+    """Data hash saved next to a figure by `render`, None if the figure does not exist or has none."""
+    if not os.path.exists(fig_path):
+        return None
+    try:
+        with open(fig_path + HASH_SUFFIX) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def render_figure(job, rc=None, fig_hash=None):
+    """Draw and save one figure on the Agg canvas, outside of pyplot so that no figure outlives this call.
+    Args:
+        job (`FigureJob`): The figure to draw.
+        rc (`dict`): rcParams to draw the figure with.
+        fig_hash (`str`): Data hash to save next to the figure, in `<fig_path>.sha256`.
+    Returns:
+        fig_path (`str`): Path of the saved figure.
+    """
+
+    # matplotlib is only imported by the processes that draw
+    import matplotlib as mpl
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    with mpl.rc_context(rc):
+        fig = Figure(figsize=job.figsize)
+        FigureCanvasAgg(fig)
+        ax = fig.subplots()
+        job.draw(fig, ax, *job.args)
+        fig.savefig(job.fig_path)
+    # Release the figure's memory before drawing the next one in this process
+    fig.clear()
+    # The hash is written after the figure, so an interrupted save is redrawn by the next run
+    hash_path = job.fig_path + HASH_SUFFIX
+    if fig_hash:
+        with open(hash_path, 'w') as f:
+            f.write(fig_hash)
+    elif os.path.exists(hash_path):
+        os.remove(hash_path)
+    return job.fig_path
+
+
+def render(jobs, rc=None, n_jobs=None, skip_unchanged=False):
+    """Render figures headless, in a pool of worker processes.
+    Args:
+        jobs (`:obj:`list` of :obj:`FigureJob`): Figures to render. Their drawing functions and data must be picklable.
+        rc (`dict`): rcParams to draw the figures with.
+        n_jobs (`int`): Number of worker processes, the number of CPUs if None. Figures are rendered in this process
+            if 1 or if there is only one figure to render.
+        skip_unchanged (`bool`): If true, do not redraw figures whose file was drawn from the same data.
+    Returns:
+        rendered (`:obj:`list` of :obj:`str`): Paths of the figures that were drawn.
+    """
+
+    pending = []
+    for job in jobs:
+        fig_hash = data_hash(job, rc)
+        if skip_unchanged and saved_hash(job.fig_path) == fig_hash:
+            logger.debug("Skipped %s, its data did not change", job.fig_path)
+            continue
+        pending.append((job, fig_hash))
+
+    if n_jobs == 1 or len(pending) <= 1:
+        rendered = [render_figure(job, rc, fig_hash) for job, fig_hash in pending]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs or os.cpu_count(), len(pending))) as pool:
+            futures = [pool.submit(render_figure, job, rc, fig_hash) for job, fig_hash in pending]
+            rendered = [future.result() for future in futures]
+
+    logger.info("Rendered %d figures, skipped %d unchanged", len(rendered), len(jobs) - len(rendered))
+    return rendered
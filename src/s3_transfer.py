@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger('s3-transfer')
+
+MB = 1024 * 1024
+READ_BLOCK_SIZE = MB
+
+
+class ObjectChangedError(Exception):
+    """The S3 object was replaced while it was being downloaded."""
+
+
+def is_s3_url(path):
+    return isinstance(path, str) and path.startswith('s3://')
+
+
+def parse_s3_url(url):
+    """Split `s3://bucket/key` into the bucket and the key."""
+    bucket, _, key = url[len('s3://'):].partition('/')
+    if not bucket or not key:
+        raise ValueError("Expected an S3 URL of the form s3://bucket/key, got {}".format(url))
+    return bucket, key
+
+
+def s3_client(public_key=None, secret_key=None, endpoint_url=None, max_concurrency=8, region_name=None):
+    """Create an S3 client with a connection per concurrent part.
+    Args:
+        public_key (`str`): AWS access key id. The default credential chain of boto3 is used if None.
+        secret_key (`str`): AWS secret access key.
+        endpoint_url (`str`): URL of an S3-compatible service such as MinIO, AWS S3 if None.
+        max_concurrency (`int`): Number of parts transferred at the same time.
+        region_name (`str`): AWS region of the bucket.
+    Returns:
+        client (`botocore.client.S3`): The S3 client.
+    """
+    # boto3 is only imported by the stages that transfer data
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client('s3', aws_access_key_id=public_key, aws_secret_access_key=secret_key,
+                        endpoint_url=endpoint_url, region_name=region_name,
+                        config=Config(max_pool_connections=max(10, max_concurrency)))
+
+
+def _error_code(error):
+    return str(error.response.get('Error', {}).get('Code'))
+
+
+def local_etag(file_path, part_size=None):
+    """ETag S3 gives an object with the content of a local file.
+    Args:
+        file_path (`str`): Path of the local file.
+        part_size (`int`): Part size of a multipart upload, None for an object uploaded in one request.
+    Returns:
+        etag (`str`): MD5 of the file or, for a multipart upload, MD5 of the MD5 of the parts followed by the number
+            of parts, without quotes.
+    """
+
+    with open(file_path, 'rb') as f:
+        if part_size is None:
+            digest = hashlib.md5()
+            for block in iter(lambda: f.read(READ_BLOCK_SIZE), b''):
+                digest.update(block)
+            return digest.hexdigest()
+
+        part_digests = [hashlib.md5(part).digest() for part in iter(lambda: f.read(part_size), b'')]
+    return '{}-{}'.format(hashlib.md5(b''.join(part_digests)).hexdigest(), len(part_digests))
+
+
+def is_current(client, bucket, key, file_path, head=None):
+    """Check whether a local file has the same size and ETag as the S3 object.
+    Args:
+        client (`botocore.client.S3`): S3 client.
+        bucket (`str`): Name of the bucket.
+        key (`str`): Key of the object.
+        file_path (`str`): Path of the local file.
+        head (`dict`): Response of `head_object` for the object, requested if None.
+    Returns:
+        current (`bool`): True if the local file holds the content of the object.
+    """
+
+    if not os.path.exists(file_path):
+        return False
+    head = head or client.head_object(Bucket=bucket, Key=key)
+    if os.path.getsize(file_path) != head['ContentLength']:
+        return False
+
+    etag = head['ETag'].strip('"')
+    part_size = None
+    if '-' in etag:
+        # The part size of a multipart object is the size of its first part
+        part_size = client.head_object(Bucket=bucket, Key=key, PartNumber=1)['ContentLength']
+    # Objects encrypted with KMS have ETags that are not MD5s, they never match and are always transferred
+    return local_etag(file_path, part_size) == etag
+
+
+def upload(client, file_path, bucket, key, chunk_size_mb=8, max_concurrency=8, skip_unchanged=True):
+    """Upload a file in parts sent in parallel.
+    Args:
+        client (`botocore.client.S3`): S3 client.
+        file_path (`str`): Path of the file to upload.
+        bucket (`str`): Name of the bucket.
+        key (`str`): Key of the object.
+        chunk_size_mb (`float`): Size of the parts in MB, at least 5 for AWS S3. Smaller files are sent in one
+            request.
+        max_concurrency (`int`): Number of parts sent at the same time.
+        skip_unchanged (`bool`): If true, do not upload a file the object already holds.
+    Returns:
+        uploaded (`bool`): False if the upload was skipped.
+    """
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import ClientError
+
+    chunk_size = int(chunk_size_mb * MB)
+    if skip_unchanged:
+        try:
+            if is_current(client, bucket, key, file_path):
+                logger.info("s3://%s/%s already holds %s, skipped the upload", bucket, key, file_path)
+                return False
+        except ClientError as e:
+            if _error_code(e) not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+
+    transfer_config = TransferConfig(multipart_threshold=chunk_size, multipart_chunksize=chunk_size,
+                                     max_concurrency=max_concurrency, use_threads=max_concurrency > 1)
+    start = time.time()
+    client.upload_file(file_path, bucket, key, Config=transfer_config)
+    logger.info("Uploaded %s to s3://%s/%s in %.1f s", file_path, bucket, key, time.time() - start)
+    return True
+
+
+def _load_state(state_path):
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _save_state(state, state_path):
+    # Written to a temporary file and renamed, so an interruption never leaves a truncated state
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def _fetch_range(client, bucket, key, etag, part_path, first, last, max_retries):
+    """Download bytes `first` to `last` of the object into the same bytes of the partial file, with retries."""
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    for attempt in range(max_retries + 1):
+        try:
+            # IfMatch fails the request if the object was replaced since the download started
+            body = client.get_object(Bucket=bucket, Key=key, Range='bytes={}-{}'.format(first, last),
+                                     IfMatch=etag)['Body']
+            written = 0
+            with open(part_path, 'r+b') as f:
+                f.seek(first)
+                for block in iter(lambda: body.read(READ_BLOCK_SIZE), b''):
+                    f.write(block)
+                    written += len(block)
+            if written != last - first + 1:
+                raise IOError("Received {} of {} bytes".format(written, last - first + 1))
+            return
+        except ClientError as e:
+            if _error_code(e) in ('PreconditionFailed', '412'):
+                raise ObjectChangedError("s3://{}/{} changed during the download".format(bucket, key))
+            error = e
+        except (BotoCoreError, IOError) as e:
+            error = e
+        if attempt == max_retries:
+            raise error
+        delay = 0.5 * 2 ** attempt
+        logger.warning("Range %d-%d failed (%s), retrying in %.1f s", first, last, error, delay)
+        time.sleep(delay)
+
+
+def download(client, bucket, key, file_path, chunk_size_mb=8, max_concurrency=8, max_retries=5,
+             skip_unchanged=True):
+    """Download an object in byte ranges fetched in parallel, resuming an interrupted download.
+
+    The ranges are written into `<file_path>.part` and the ranges done are recorded in `<file_path>.part.json`, so a
+    download that failed or was interrupted only fetches the missing ranges when it is run again. The partial file
+    replaces `file_path` once every range is done.
+
+    Args:
+        client (`botocore.client.S3`): S3 client.
+        bucket (`str`): Name of the bucket.
+        key (`str`): Key of the object.
+        file_path (`str`): Path to save the object.
+        chunk_size_mb (`float`): Size of the ranges in MB.
+        max_concurrency (`int`): Number of ranges fetched at the same time.
+        max_retries (`int`): Number of retries of a failed range, with exponential backoff.
+        skip_unchanged (`bool`): If true, do not download an object the local file already holds.
+    Returns:
+        downloaded (`bool`): False if the download was skipped.
+    """
+
+    head = client.head_object(Bucket=bucket, Key=key)
+    size, etag = head['ContentLength'], head['ETag']
+    if skip_unchanged and is_current(client, bucket, key, file_path, head):
+        logger.info("%s already holds s3://%s/%s, skipped the download", file_path, bucket, key)
+        return False
+
+    part_path, state_path = file_path + '.part', file_path + '.part.json'
+    chunk_size = int(chunk_size_mb * MB)
+    state = _load_state(state_path)
+    if (state is not None and os.path.exists(part_path) and
+            (state['etag'], state['size'], state['chunk_size']) == (etag, size, chunk_size)):
+        logger.info("Resuming the download of s3://%s/%s, %d ranges already done", bucket, key, len(state['done']))
+    else:
+        state = {'etag': etag, 'size': size, 'chunk_size': chunk_size, 'done': []}
+        directory = os.path.dirname(os.path.abspath(file_path))
+        os.makedirs(directory, exist_ok=True)
+        with open(part_path, 'wb') as f:
+            f.truncate(size)
+        _save_state(state, state_path)
+
+    done = set(state['done'])
+    ranges = [(i, start, min(start + chunk_size, size) - 1)
+              for i, start in enumerate(range(0, size, chunk_size)) if i not in done]
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        futures = {pool.submit(_fetch_range, client, bucket, key, etag, part_path, first, last, max_retries): i
+                   for i, first, last in ranges}
+        try:
+            for future in as_completed(futures):
+                future.result()
+                done.add(futures[future])
+                state['done'] = sorted(done)
+                _save_state(state, state_path)
+        except ObjectChangedError:
+            # The ranges done belong to the old object, the next run starts over
+            os.remove(state_path)
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+
+    os.replace(part_path, file_path)
+    os.remove(state_path)
+    logger.info("Downloaded s3://%s/%s (%d bytes) to %s in %.1f s", bucket, key, size, file_path,
+                time.time() - start_time)
+    return True
+
+
+def open_object(url, client=None):
+    """Open an S3 object as a stream, to read it without a local copy.
+    Args:
+        url (`str`): URL of the object, `s3://bucket/key`.
+        client (`botocore.client.S3`): S3 client. If None, one is created from the default credential chain of boto3
+            and the `S3_ENDPOINT_URL` environment variable.
+    Returns:
+        body (`botocore.response.StreamingBody`): File-like content of the object.
+    """
+    bucket, key = parse_s3_url(url)
+    client = client or s3_client(endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+    return client.get_object(Bucket=bucket, Key=key)['Body']
+
+
+def object_etag(url, client=None):
+    """ETag of an S3 object, which changes whenever its content changes."""
+    bucket, key = parse_s3_url(url)
+    client = client or s3_client(endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+    return client.head_object(Bucket=bucket, Key=key)['ETag'].strip('"')
@@ -0,0 +1,193 @@
+import numpy as np
+
+
+def nearest_centroids(points, centroids, chunk_size=65536):
+    """Index of the nearest centroid of every point, computed in chunks to bound the memory of the distance matrix.
+    Args:
+        points (`numpy.ndarray`): Points of shape (n_points, n_features).
+        centroids (`numpy.ndarray`): Centroids of shape (n_centroids, n_features).
+        chunk_size (`int`): Number of points per chunk.
+    Returns:
+        nearest (`numpy.ndarray`): Index of the nearest centroid of each point, shape (n_points,).
+    """
+
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    nearest = np.empty(len(points), dtype=np.int64)
+    for start in range(0, len(points), chunk_size):
+        # Squared distance up to the per-row constant ||x||^2
+        distances = centroid_norms - 2 * points[start:start + chunk_size].dot(centroids.T)
+        nearest[start:start + chunk_size] = distances.argmin(axis=1)
+    return nearest
+
+
+def split_cluster(points, n_lists, rng, sample_per_list=32, n_iter=10):
+    """Split the points of one k-means cluster into `n_lists` lists with a few Lloyd iterations on a sample.
+    Args:
+        points (`numpy.ndarray`): Scaled features of the beans of the cluster.
+        n_lists (`int`): Number of lists to split the cluster into.
+        rng (`numpy.random.RandomState`): Random number generator for sampling.
+        sample_per_list (`int`): Number of sampled beans per list the centroids are fitted on.
+        n_iter (`int`): Number of Lloyd iterations.
+    Returns:
+        centroids (`numpy.ndarray`): Centroids of the lists, shape (n_lists, n_features).
+    """
+
+    if n_lists <= 1:
+        return points.mean(axis=0, keepdims=True)
+
+    sample = points[rng.choice(len(points), min(len(points), n_lists * sample_per_list), replace=False)]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = nearest_centroids(sample, centroids)
+        counts = np.bincount(labels, minlength=n_lists)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        # Lists that lost all their points keep their previous centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+class SimilarityIndex(object):
+    """Finds the beans nearest to a flavor profile in the scaled feature space of the model.
+
+    Small catalogs are searched exactly, in one vectorized pass over every bean. Larger catalogs are laid out as an
+    inverted file (IVF): every k-means cluster of the model is split into lists of about `list_size` beans, the beans
+    are stored grouped by list, and a query only scans the `n_probe` lists with the nearest centroids. The results of
+    an IVF search are approximate, beans in lists that are not probed are missed.
+
+    Like `CentroidPredictor`, the index only needs NumPy. It is saved by train_model.save_similarity_index as a `.npz`
+    file next to the pickled model.
+    """
+
+    def __init__(self, mean, scale, ids, features, list_centroids=None, list_offsets=None, version=None):
+        """
+        Args:
+            mean (`numpy.ndarray`): Feature means of the scaler, shape (n_features,).
+            scale (`numpy.ndarray`): Feature scales of the scaler, shape (n_features,).
+            ids (`numpy.ndarray`): Bean ids, shape (n_beans,).
+            features (`numpy.ndarray`): Scaled features of the beans in the order of `ids`, shape (n_beans, n_features).
+            list_centroids (`numpy.ndarray`): Centroids of the IVF lists, shape (n_lists, n_features). None for an
+                exact index.
+            list_offsets (`numpy.ndarray`): Position in `ids` of the first bean of every list, followed by the number
+                of beans, shape (n_lists + 1,). None for an exact index.
+            version (`str`): Version of the model the index belongs to.
+        """
+        self.mean = np.asarray(mean, dtype=float)
+        self.scale = np.asarray(scale, dtype=float)
+        self.ids = np.asarray(ids)
+        self.features = np.ascontiguousarray(features, dtype=np.float32)
+        self.list_centroids = None if list_centroids is None else np.asarray(list_centroids, dtype=np.float32)
+        self.list_offsets = None if list_offsets is None else np.asarray(list_offsets, dtype=np.int64)
+        self.version = version
+        self._norms = (self.features ** 2).sum(axis=1)
+        if self.list_centroids is not None:
+            self._list_norms = (self.list_centroids ** 2).sum(axis=1)
+
+    @classmethod
+    def build(cls, mean, scale, ids, raw_features, centroids, exact_max=50000, list_size=1000, random_state=None,
+              version=None):
+        """Build the index of a catalog.
+        Args:
+            mean (`numpy.ndarray`): Feature means of the scaler, shape (n_features,).
+            scale (`numpy.ndarray`): Feature scales of the scaler, shape (n_features,).
+            ids (`numpy.ndarray`): Bean ids, shape (n_beans,).
+            raw_features (`numpy.ndarray`): Unscaled features of the beans, shape (n_beans, n_features).
+            centroids (`numpy.ndarray`): Cluster centers of the model in the scaled space, shape (k, n_features).
+            exact_max (`int`): Catalogs of up to this many beans get an exact index.
+            list_size (`int`): Approximate number of beans per list of an IVF index.
+            random_state (`int`): Seed for sampling the beans the list centroids are fitted on.
+            version (`str`): Version of the model the index belongs to.
+        Returns:
+            index (`SimilarityIndex`): The index.
+        """
+
+        ids = np.asarray(ids)
+        features = ((np.asarray(raw_features, dtype=float) - mean) / scale).astype(np.float32)
+        if len(ids) <= exact_max:
+            return cls(mean, scale, ids, features, version=version)
+
+        # The k-means clusters are the coarse partitions, each one is split into lists of about `list_size` beans
+        rng = np.random.RandomState(random_state)
+        clusters = nearest_centroids(features, np.asarray(centroids, dtype=np.float32))
+        list_centroids = []
+        for cluster in range(len(centroids)):
+            members = features[clusters == cluster]
+            if len(members):
+                list_centroids.append(split_cluster(members, int(np.ceil(len(members) / list_size)), rng))
+        list_centroids = np.vstack(list_centroids)
+
+        lists = nearest_centroids(features, list_centroids)
+        order = np.argsort(lists, kind='mergesort')
+        list_offsets = np.searchsorted(lists[order], np.arange(len(list_centroids) + 1))
+        return cls(mean, scale, ids[order], features[order], list_centroids, list_offsets, version=version)
+
+    @classmethod
+    def load(cls, index_path, version=None):
+        """Load an index saved with `save`.
+        Args:
+            index_path (`str`): Path to the `.npz` index.
+            version (`str`): Version of the model the index belongs to.
+        Returns:
+            index (`SimilarityIndex`): The loaded index.
+        """
+        with np.load(index_path) as saved:
+            exact = len(saved['list_offsets']) == 0
+            return cls(saved['mean'], saved['scale'], saved['ids'], saved['features'],
+                       None if exact else saved['list_centroids'], None if exact else saved['list_offsets'],
+                       version=version)
+
+    def save(self, index_path):
+        """Save the index as a `.npz` file.
+        Args:
+            index_path (`str`): Path to save the index.
+        Returns:
+            None.
+        """
+        n_features = self.features.shape[1]
+        np.savez(index_path, mean=self.mean, scale=self.scale, ids=self.ids, features=self.features,
+                 list_centroids=(np.empty((0, n_features), dtype=np.float32) if self.is_exact
+                                 else self.list_centroids),
+                 list_offsets=np.empty(0, dtype=np.int64) if self.is_exact else self.list_offsets)
+
+    @property
+    def is_exact(self):
+        return self.list_centroids is None
+
+    @property
+    def n_beans(self):
+        return len(self.ids)
+
+    def search(self, raw_profile, k=15, n_probe=8):
+        """Find the beans nearest to one flavor profile.
+        Args:
+            raw_profile (`numpy.ndarray`): Unscaled features in the order of `feature_names`, shape (n_features,).
+            k (`int`): Number of beans to return.
+            n_probe (`int`): Number of IVF lists scanned. Ignored by an exact index.
+        Returns:
+            ids (`numpy.ndarray`): Ids of the nearest beans, nearest first. Fewer than `k` if the probed lists hold
+                fewer beans.
+            distances (`numpy.ndarray`): Euclidean distances of the beans to the profile in the scaled space.
+        """
+
+        query = ((np.asarray(raw_profile, dtype=float).ravel() - self.mean) / self.scale).astype(np.float32)
+        if self.is_exact:
+            positions = None
+            distances = self._norms - 2 * self.features.dot(query)
+        else:
+            list_distances = self._list_norms - 2 * self.list_centroids.dot(query)
+            n_probe = min(n_probe, len(list_distances))
+            probed = np.argpartition(list_distances, n_probe - 1)[:n_probe]
+            # The beans of a list are contiguous, so every probed list is scanned as one slice
+            bounds = [(self.list_offsets[i], self.list_offsets[i + 1]) for i in probed]
+            positions = np.concatenate([np.arange(start, stop) for start, stop in bounds])
+            distances = np.concatenate([self._norms[start:stop] - 2 * self.features[start:stop].dot(query)
+                                        for start, stop in bounds])
+
+        k = min(k, len(distances))
+        if k == 0:
+            return self.ids[:0], np.empty(0)
+        top = np.argpartition(distances, k - 1)[:k] if k < len(distances) else np.arange(k)
+        top = top[np.argsort(distances[top], kind='mergesort')]
+        nearest = top if positions is None else positions[top]
+        return self.ids[nearest], np.sqrt(np.maximum(distances[top] + query.dot(query), 0))
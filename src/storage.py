@@ -0,0 +1,196 @@
+import os
+import logging
+
+logger = logging.getLogger('storage')
+
+# File extension of every supported intermediate format
+FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+
+def resolve_path(data_path, fmt):
+    """Swap the extension of a configured data path for the extension of a storage format.
+    Args:
+        data_path (`str`): Path from config.yaml, e.g. './data/clusters.csv'.
+        fmt (`str`): Storage format, one of 'csv', 'parquet' or 'feather'.
+    Returns:
+        path (`str`): The path with the extension of the format.
+    """
+
+    if fmt not in FORMATS:
+        raise ValueError("Unknown storage format {}, expected one of {}".format(fmt, ', '.join(FORMATS)))
+    return os.path.splitext(data_path)[0] + FORMATS[fmt]
+
+
+def infer_format(data_path):
+    """Infer the storage format from the extension of a path, defaulting to csv."""
+    extension = os.path.splitext(data_path)[1]
+    for fmt, fmt_extension in FORMATS.items():
+        if extension == fmt_extension:
+            return fmt
+    return 'csv'
+
+
+def write_table(data, data_path, fmt='csv'):
+    """Write a data frame in a storage format.
+    Args:
+        data (`pandas.DataFrame`): Data to be stored.
+        data_path (`str`): Path to save the data.
+        fmt (`str`): Storage format, one of 'csv', 'parquet' or 'feather'. Parquet and feather need pyarrow.
+    Returns:
+        None.
+    """
+
+    if not data_path:
+        raise FileNotFoundError
+
+    if fmt == 'parquet':
+        data.to_parquet(data_path, index=False)
+    elif fmt == 'feather':
+        data.reset_index(drop=True).to_feather(data_path)
+    elif fmt == 'csv':
+        data.to_csv(data_path, index=False)
+    else:
+        raise ValueError("Unknown storage format {}, expected one of {}".format(fmt, ', '.join(FORMATS)))
+    logger.debug("Wrote %d rows to %s", len(data), data_path)
+
+
+class ChunkWriter(object):
+    """Write a data frame chunk by chunk to one csv or parquet file, so that it never has to fit in memory.
+
+    Every chunk of a parquet file is a row group. Feather files cannot be appended to, so they are not supported.
+    """
+
+    def __init__(self, data_path, fmt='csv'):
+        """
+        Args:
+            data_path (`str`): Path to save the data, replaced by the first chunk.
+            fmt (`str`): Storage format, 'csv' or 'parquet'. Parquet needs pyarrow.
+        """
+        if not data_path:
+            raise FileNotFoundError
+        if fmt not in ('csv', 'parquet'):
+            raise ValueError("Storage format {} cannot be written in chunks, use csv or parquet".format(fmt))
+        self.data_path = data_path
+        self.fmt = fmt
+        self.n_chunks = 0
+        self._writer = None
+
+    def write(self, chunk):
+        """Append a chunk, whose columns must match those of the first chunk."""
+        if self.fmt == 'csv':
+            first = self.n_chunks == 0
+            chunk.to_csv(self.data_path, index=False, mode='w' if first else 'a', header=first)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self._writer is None:
+                # A column that is empty in the first chunk holds strings, as the other text columns
+                schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                schema = pa.schema([pa.field(field.name, pa.string()) if field.type == pa.null() else field
+                                    for field in schema])
+                self._writer = pq.ParquetWriter(self.data_path, schema)
+            self._writer.write_table(pa.Table.from_pandas(chunk, schema=self._writer.schema, preserve_index=False))
+        self.n_chunks += 1
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def read_table_chunks(data_path, chunk_size, fmt=None, columns=None):
+    """Read a csv or parquet data file in chunks, so that it never has to fit in memory.
+    Args:
+        data_path (`str`): Location of the data.
+        chunk_size (`int`): Maximum number of rows per chunk. Parquet files are read one row group at a time, so their
+            chunks are never larger than their row groups.
+        fmt (`str`): Storage format, inferred from the extension of `data_path` if None.
+        columns (`:obj:`list` of :obj:`str`): Columns to read, in this order. All columns are read if None.
+    Returns:
+        chunks (`generator` of `pandas.DataFrame`): The data, at most `chunk_size` rows at a time.
+    """
+
+    if not data_path:
+        raise FileNotFoundError
+
+    import pandas as pd
+
+    fmt = fmt or infer_format(data_path)
+    if fmt == 'csv':
+        for chunk in pd.read_csv(data_path, usecols=columns, chunksize=chunk_size):
+            yield chunk if columns is None else chunk[columns]
+    elif fmt == 'parquet':
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(data_path)
+        for i in range(parquet_file.num_row_groups):
+            group = parquet_file.read_row_group(i, columns=columns).to_pandas()
+            for start in range(0, len(group), chunk_size):
+                yield group.iloc[start:start + chunk_size].reset_index(drop=True)
+    else:
+        raise ValueError("Storage format {} cannot be read in chunks, use csv or parquet".format(fmt))
+
+
+def read_head(data_path, n_rows, fmt=None):
+    """Read the first rows of a data file without reading the whole csv or parquet file.
+    Args:
+        data_path (`str`): Location of the data.
+        n_rows (`int`): Number of rows to read.
+        fmt (`str`): Storage format, inferred from the extension of `data_path` if None.
+    Returns:
+        data (`pandas.DataFrame`): At most `n_rows` rows of the data.
+    """
+
+    import pandas as pd
+
+    fmt = fmt or infer_format(data_path)
+    if fmt == 'csv':
+        return pd.read_csv(data_path, nrows=n_rows)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(data_path)
+        groups, n_read = [], 0
+        for i in range(parquet_file.num_row_groups):
+            if n_read >= n_rows:
+                break
+            groups.append(parquet_file.read_row_group(i).to_pandas())
+            n_read += len(groups[-1])
+        if not groups:
+            return parquet_file.read().to_pandas()
+        return pd.concat(groups, ignore_index=True).head(n_rows)
+    return read_table(data_path, fmt).head(n_rows)
+
+
+def read_table(data_path, fmt=None, columns=None):
+    """Read a data frame written by `write_table`, optionally only some of its columns.
+    Args:
+        data_path (`str`): Location of the data.
+        fmt (`str`): Storage format, inferred from the extension of `data_path` if None.
+        columns (`:obj:`list` of :obj:`str`): Columns to read, in this order. All columns are read if None.
+    Returns:
+        data (`pandas.DataFrame`): The data.
+    """
+
+    if not data_path:
+        raise FileNotFoundError
+
+    # Imported here so that resolving paths, e.g. in pipeline.py, does not pay for pandas
+    import pandas as pd
+
+    fmt = fmt or infer_format(data_path)
+    if fmt == 'parquet':
+        data = pd.read_parquet(data_path, columns=columns)
+    elif fmt == 'feather':
+        data = pd.read_feather(data_path, columns=columns)
+    elif fmt == 'csv':
+        data = pd.read_csv(data_path, usecols=columns)
+    else:
+        raise ValueError("Unknown storage format {}, expected one of {}".format(fmt, ', '.join(FORMATS)))
+
+    return data if columns is None else data[columns]
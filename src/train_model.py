@@ -1,18 +1,20 @@
 import sys
 import os
+import time
 import yaml
 import warnings
 import logging.config
 warnings.filterwarnings('ignore')
 import pandas as pd
+import numpy as np
 import datetime
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 from cycler import cycler
 import sklearn
 from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import adjusted_rand_score
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 
 now = datetime.datetime.now().strftime("%Y-%m-%d")
 dateplus = lambda x: "%s-%s" % (now, x)
@@ -20,13 +22,21 @@ dateplus = lambda x: "%s-%s" % (now, x)
 sys.path.append('./config')
 import config
 
+from storage import read_table, write_table, resolve_path, read_table_chunks, ChunkWriter
+from render import FigureJob, render
+from similarity import SimilarityIndex
+from cluster_stats import ClusterStats
+from inference import CentroidPredictor
+from instrument import metrics
+from profiling import Profiler
+
 # Logging
 # logging.config.fileConfig(config.LOGGING_CONFIG)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s     %(message)s')
 logger = logging.getLogger("train-model")
 
 
-# Update matplotlib defaults to something nicer
+# matplotlib defaults for the figures of this stage, applied by render.render
 mpl_update = {
     'font.size': 16,
     'axes.prop_cycle': cycler('color', ['#0085ca', '#888b8d', '#00c389', '#f4364c', '#e56db1']),
@@ -40,13 +50,14 @@ mpl_update = {
     'lines.linewidth': 3,
     'text.color': '#677385'
 }
-mpl.rcParams.update(mpl_update)
 
 
-def read_data(file_path):
-    """Read the csv data file.
+@metrics.timed('train_model.read_data')
+def read_data(file_path, columns=None):
+    """Read the data file in any format of storage.py, inferred from its extension.
     Args:
         file_path (`str`): Location of the data to be read in.
+        columns (`:obj:`list` of :obj:`str`): Columns to read. All columns are read if None.
     Returns:
         bean_data (`pandas.DataFrame`): The bean data in a pandas data frame.
     """
@@ -56,7 +67,7 @@ def read_data(file_path):
         raise FileNotFoundError
 
     try:
-        bean_data = pd.read_csv(file_path)
+        bean_data = read_table(file_path, columns=columns)
     except Exception as e:
         logger.error("Failed to read data from {}".format(file_path), e)
         pass
@@ -64,6 +75,42 @@ def read_data(file_path):
     return bean_data
 
 
+def read_chunks(file_path, feature_names, chunk_size):
+    """Read the feature columns of the csv or parquet data file in chunks.
+    Args:
+        file_path (`str`): Location of the data to be read in, its format is inferred from its extension.
+        feature_names (`:obj:`list` of :obj:`str`): List of column names to be used as features.
+        chunk_size (`int`): Number of rows per chunk.
+    Returns:
+        chunks (`generator` of `pandas.DataFrame`): The features, `chunk_size` rows at a time.
+    """
+
+    if not file_path:
+        raise FileNotFoundError
+
+    for chunk in read_table_chunks(file_path, chunk_size, columns=feature_names):
+        yield chunk
+
+
+def read_index_arrays(file_path, id_column, feature_names, chunk_size):
+    """Read the bean ids and features of the csv or parquet data file in chunks, keeping only their arrays.
+    Args:
+        file_path (`str`): Location of the data to be read in.
+        id_column (`str`): Name of the bean id column.
+        feature_names (`:obj:`list` of :obj:`str`): List of column names to be used as features.
+        chunk_size (`int`): Number of rows per chunk.
+    Returns:
+        ids (`numpy.ndarray`): Bean ids, shape (n_beans,).
+        raw_features (`numpy.ndarray`): Unscaled features as float32, shape (n_beans, n_features).
+    """
+
+    ids, raw_features = [], []
+    for chunk in read_chunks(file_path, [id_column] + feature_names, chunk_size):
+        ids.append(chunk[id_column].values)
+        raw_features.append(chunk[feature_names].values.astype(np.float32))
+    return np.concatenate(ids), np.concatenate(raw_features)
+
+
 def feature_split(data, feature_names):
     """Split the data into features.
     Args:
@@ -77,23 +124,30 @@ def feature_split(data, feature_names):
     return result
 
 
+@metrics.timed('train_model.get_scaler')
 def get_scaler(unscaled_date, feature_names, feature_scaler_path):
     """Get the scaler user for standardizing the features.
     Args:
-        unscaled_date (`pandas.DataFrame`): Features before scaling.
+        unscaled_date (`pandas.DataFrame` or iterable of `pandas.DataFrame`): Features before scaling, either in one
+            data frame or in chunks as returned by `read_chunks`.
         feature_names (`:obj:`list` of :obj:`str`): List of feature names
     Returns:
         feature_scaler (`sklearn.preprocessing._data.StandardScaler`): The feature scaler.
     """
 
     scaler = StandardScaler()
-    feature_scaler = scaler.fit(unscaled_date[feature_names])
+    if isinstance(unscaled_date, pd.DataFrame):
+        feature_scaler = scaler.fit(unscaled_date[feature_names])
+    else:
+        for chunk in unscaled_date:
+            feature_scaler = scaler.partial_fit(chunk[feature_names])
 
     with open(feature_scaler_path, "wb") as f:
         pickle.dump(feature_scaler, f)
     return feature_scaler
 
 
+@metrics.timed('train_model.stand_feat')
 def stand_feat(unscaled_date, feature_names, feature_scaler):
     """Get the scaler user for standardizing the features.
     Args:
@@ -112,7 +166,75 @@ def stand_feat(unscaled_date, feature_names, feature_scaler):
         return
 
 
-def plot_sil_iner(scaled_features, kmin, kmax, random_state, figs_folder):
+def fit_k(scaled_features, k, random_state, sample_size=None):
+    """Fit a k-means model for one number of clusters and score it.
+    Args:
+        scaled_features (`numpy.ndarray`): Features after scaling.
+        k (`int`): The number of clusters.
+        random_state (`int`): The random state parameter for k-means clustering and silhouette sampling.
+        sample_size (`int`): Number of beans sampled to estimate the silhouette score, all beans if None.
+    Returns:
+        result (`dict`): The number of clusters, inertia, silhouette score and fit time in seconds.
+    """
+
+    start = time.perf_counter()
+    model = KMeans(n_clusters=k, random_state=random_state)
+    model.fit(scaled_features)
+    fit_seconds = time.perf_counter() - start
+    silhouette = sklearn.metrics.silhouette_score(scaled_features, model.labels_, sample_size=sample_size,
+                                                  random_state=random_state)
+    return {'k': k, 'inertia': model.inertia_, 'silhouette': silhouette, 'fit_seconds': fit_seconds}
+
+
+@metrics.timed('train_model.sweep_k')
+def sweep_k(scaled_features, kmin, kmax, random_state, n_jobs=None, sample_size=None, patience=None, tol=0.01):
+    """Fit and score k-means models for a range of cluster numbers in a process pool.
+
+    The candidates are fitted in waves of `n_jobs`. With `patience` set, the sweep stops once the relative inertia
+    improvement stays below `tol` without a new best silhouette score for `patience` consecutive values of k.
+    Args:
+        scaled_features (`numpy.ndarray`): Features after scaling.
+        kmin (`int`): The minimum number of the clusters.
+        kmax (`int`): The maximum number of the clusters (exclusive).
+        random_state (`int`): The random state parameter for k-means clustering.
+        n_jobs (`int`): Number of worker processes, the number of CPUs if None.
+        sample_size (`int`): Number of beans sampled to estimate the silhouette score, all beans if None.
+        patience (`int`): Number of flat values of k before stopping early, no early stopping if None.
+        tol (`float`): Minimum relative inertia improvement that counts as progress.
+    Returns:
+        results (`pandas.DataFrame`): One row per fitted k with its inertia, silhouette score and fit seconds.
+    """
+
+    n_jobs = n_jobs or os.cpu_count()
+    candidates = list(range(kmin, kmax))
+    results = []
+    flat = 0
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        for offset in range(0, len(candidates), n_jobs):
+            futures = [pool.submit(fit_k, scaled_features, k, random_state, sample_size)
+                       for k in candidates[offset:offset + n_jobs]]
+            for future in futures:
+                result = future.result()
+                if results:
+                    previous = results[-1]
+                    improvement = (previous['inertia'] - result['inertia']) / previous['inertia']
+                    best_silhouette = max(r['silhouette'] for r in results)
+                    flat = flat + 1 if improvement < tol and result['silhouette'] <= best_silhouette else 0
+                results.append(result)
+                logger.debug("k=%d: inertia %.2f, silhouette %.4f", result['k'], result['inertia'],
+                             result['silhouette'])
+
+            if patience is not None and flat >= patience:
+                logger.info("Stopped the k sweep at k=%d, no improvement for %d values of k",
+                            results[-1]['k'], flat)
+                break
+
+    return pd.DataFrame(results, columns=['k', 'inertia', 'silhouette', 'fit_seconds'])
+
+
+def plot_sil_iner(scaled_features, kmin, kmax, random_state, figs_folder, n_jobs=None, sample_size=None,
+                  patience=None, tol=0.01, skip_unchanged=False):
     """Plot silhouette and inertia scores for different number of clusters.
     Args:
         scaled_features (`pandas.DataFrame`): Features after scaling.
@@ -120,61 +242,88 @@ def plot_sil_iner(scaled_features, kmin, kmax, random_state, figs_folder):
         kmax (`int`): The maximum number of the clusters.
         random_state (`int`): The random state parameter for k-means clustering
         figs_folder (`str`): Directory for resulting figs.
+        n_jobs (`int`): Number of worker processes for the sweep, the number of CPUs if None.
+        sample_size (`int`): Number of beans sampled to estimate the silhouette score, all beans if None.
+        patience (`int`): Number of flat values of k before stopping early, no early stopping if None.
+        tol (`float`): Minimum relative inertia improvement that counts as progress.
+        skip_unchanged (`bool`): If true, do not redraw plots of unchanged sweep results.
+    Returns:
+        results (`pandas.DataFrame`): One row per fitted k with its inertia, silhouette score and fit seconds.
+    """
+
+    results = sweep_k(scaled_features, kmin, kmax, random_state, n_jobs=n_jobs, sample_size=sample_size,
+                      patience=patience, tol=tol)
+    plot_k_sweep(results, figs_folder, n_jobs=n_jobs, skip_unchanged=skip_unchanged)
+
+    return results
+
+
+def draw_k_sweep(fig, ax, k, scores, ylabel, title=None):
+    """Draw the scatter plot of a score against the number of clusters."""
+    ax.scatter(k, scores)
+    ax.set_xlabel('Number of clusters, $k$')
+    ax.set_ylabel(ylabel)
+    if title:
+        ax.set_title(title)
+
+
+def plot_k_sweep(results, figs_folder, n_jobs=None, skip_unchanged=False):
+    """Save the results of a k sweep and plot its inertia and silhouette scores.
+    Args:
+        results (`pandas.DataFrame`): Results of `sweep_k`.
+        figs_folder (`str`): Directory for resulting figs.
+        n_jobs (`int`): Number of processes rendering the plots, the number of CPUs if None.
+        skip_unchanged (`bool`): If true, do not redraw plots of unchanged sweep results.
     Returns:
         None.
     """
 
-    silhouette = []
-    inertia = []
-
-    # To capture model objects for each k
-    models = {}
-
-    # Upper bound for range of k to try
-    for k in range(kmin, kmax):
-        # Create model object
-        model = KMeans(n_clusters=k, random_state=random_state)
-        # Train model object
-        model.fit(scaled_features)
-        # Get inertia calculated for trained model
-        inertia.append(model.inertia_)
-        # Calculate silhouette score of trained model
-        silhouette.append(sklearn.metrics.silhouette_score(scaled_features, model.labels_))
-        # Capture trained model object
-        models[k] = model
-
-    fig, ax = plt.subplots(figsize=(12, 8));
-    ax.scatter(range(kmin, kmax), inertia);
-    ax.set_xlabel('Number of clusters, $k$');
-    ax.set_ylabel('Inertia');
-    ax.set_title('Inertia vs number of clusters');
-    fig_path = os.path.join(figs_folder, dateplus('initial.png'))
-    fig.savefig(fig_path)
-
-    fig, ax = plt.subplots(figsize=(12, 8));
-    ax.scatter(range(kmin, kmax), silhouette);
-    ax.set_xlabel('Number of clusters, $k$');
-    ax.set_ylabel('Silhouette score');
-    fig_path = os.path.join(figs_folder, dateplus('silhouette.png'))
-    fig.savefig(fig_path)
-
-
-def train_model(scaled_features, k_chosen, random_state, save_tmo_path):
+    results.to_csv(os.path.join(figs_folder, dateplus('k-sweep.csv')), index=False)
+
+    k = results['k'].values
+    render([FigureJob(draw_k_sweep, os.path.join(figs_folder, dateplus('initial.png')),
+                      (k, results['inertia'].values, 'Inertia', 'Inertia vs number of clusters'), (12, 8)),
+            FigureJob(draw_k_sweep, os.path.join(figs_folder, dateplus('silhouette.png')),
+                      (k, results['silhouette'].values, 'Silhouette score'), (12, 8))],
+           rc=mpl_update, n_jobs=n_jobs, skip_unchanged=skip_unchanged)
+
+
+@metrics.timed('train_model.train_model')
+def train_model(scaled_features, k_chosen, random_state, save_tmo_path, backend='kmeans', batch_size=1024,
+                init_model_path=None):
     """Train the k-means clustering model.
     Args:
-        scaled_features (`pd.DataFrame`): Data frame of scaled features.
+        scaled_features (`pd.DataFrame` or iterable of `numpy.ndarray`): Data frame of scaled features. The
+            'minibatch' backend also accepts an iterable of scaled chunks, so the features never have to fit in memory.
         k_chosen (`int`): The optimal number of clusters.
         random_state (`int`): The random state parameter for k-means clustering
         save_tmo_path (`str`): Path to save trained model object.
+        backend (`str`): 'kmeans' for full-batch k-means or 'minibatch' for mini-batch k-means.
+        batch_size (`int`): Number of samples per mini-batch update of the 'minibatch' backend.
+        init_model_path (`str`): Trained mini-batch model to update with the new features instead of fitting from
+            scratch. Only used by the 'minibatch' backend.
     Returns:
-        kmeans_model (`sklearn.cluster.KMeans`): Trained model object.
+        kmeans_model (`sklearn.cluster.KMeans` or `sklearn.cluster.MiniBatchKMeans`): Trained model object.
     """
 
-    logger.info('Training a K-means')
+    logger.info('Training a K-means with the %s backend', backend)
 
     try:
-        kmeans_model = KMeans(n_clusters=k_chosen, random_state=random_state)
-        kmeans_model.fit(scaled_features)
+        if backend == 'minibatch':
+            if init_model_path is not None:
+                with open(init_model_path, "rb") as f:
+                    kmeans_model = pickle.load(f)
+                logger.info("Updating the centroids of %s", init_model_path)
+            else:
+                kmeans_model = MiniBatchKMeans(n_clusters=k_chosen, random_state=random_state, batch_size=batch_size)
+            chunks = [scaled_features] if isinstance(scaled_features, (np.ndarray, pd.DataFrame)) else scaled_features
+            for chunk in chunks:
+                chunk = np.asarray(chunk)
+                for start in range(0, len(chunk), batch_size):
+                    kmeans_model.partial_fit(chunk[start:start + batch_size])
+        else:
+            kmeans_model = KMeans(n_clusters=k_chosen, random_state=random_state)
+            kmeans_model.fit(scaled_features)
     except Exception as e:
         logger.error("Error occurred when fitting the model", e)
         pass
@@ -192,6 +341,130 @@ def train_model(scaled_features, k_chosen, random_state, save_tmo_path):
     return kmeans_model
 
 
+def compare_models(scaled_features, kmeans_model, reference_model):
+    """Compare the quality of a model against a reference model, e.g. mini-batch against full-batch k-means.
+    Args:
+        scaled_features (`numpy.ndarray`): Features after scaling to evaluate the models on.
+        kmeans_model (`sklearn.cluster.MiniBatchKMeans`): Trained model object to evaluate.
+        reference_model (`sklearn.cluster.KMeans`): Trained reference model object.
+    Returns:
+        comparison (`dict`): Inertia of both models on the features, the relative inertia gap and the label
+            agreement as adjusted Rand index.
+    """
+
+    inertia = -kmeans_model.score(scaled_features)
+    reference_inertia = -reference_model.score(scaled_features)
+    comparison = {'inertia': inertia,
+                  'reference_inertia': reference_inertia,
+                  'inertia_gap': (inertia - reference_inertia) / reference_inertia,
+                  'label_agreement': adjusted_rand_score(reference_model.predict(scaled_features),
+                                                         kmeans_model.predict(scaled_features))}
+    logger.info("Inertia %(inertia).2f against %(reference_inertia).2f for the reference "
+                "(relative gap %(inertia_gap).3f), label agreement (ARI) %(label_agreement).3f", comparison)
+    return comparison
+
+
+@metrics.timed('train_model.save_clusters_streaming')
+def save_clusters_streaming(file_path, feature_names, feat_scaler, kmeans_model, data_path, chunk_size, stats=None,
+                            fmt='csv', export_csv=False):
+    """Predict the clusters of the csv or parquet data file chunk by chunk and append them to the output file.
+    Args:
+        file_path (`str`): Location of the data to be predicted, its format is inferred from its extension.
+        feature_names (`:obj:`list` of :obj:`str`): List of column names to be used as features.
+        feat_scaler (`sklearn.preprocessing._data.StandardScaler`): Scaler for standardizing the features.
+        kmeans_model (`sklearn.cluster.KMeans`): Trained model object.
+        data_path (`str`): Path to save the data with clusters.
+        chunk_size (`int`): Number of rows per chunk.
+        stats (`cluster_stats.ClusterStats`): Statistics updated with every chunk, if not None.
+        fmt (`str`): Storage format of the output, 'csv' or 'parquet', written to `data_path` with its extension.
+        export_csv (`bool`): If true, also write the csv file to `data_path` when `fmt` is not csv.
+    Returns:
+        None.
+    """
+
+    if not file_path or not data_path:
+        raise FileNotFoundError
+
+    writers = [ChunkWriter(resolve_path(data_path, fmt), fmt)]
+    if fmt != 'csv' and export_csv:
+        writers.append(ChunkWriter(data_path, 'csv'))
+    try:
+        for chunk in read_table_chunks(file_path, chunk_size):
+            chunk['cluster'] = predict_cluster(feat_scaler, chunk[feature_names], kmeans_model)
+            for writer in writers:
+                writer.write(chunk)
+            if stats is not None:
+                stats.update(chunk['cluster'].values, chunk[feature_names].values)
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+@metrics.timed('train_model.save_cluster_stats')
+def save_cluster_stats(raw_features, clusters, feature_names, stats_path, n_bins=512, margin=0.5):
+    """Compute the statistics of the features of every cluster in one pass and save them as a `.npz` file.
+    Args:
+        raw_features (`numpy.ndarray`): Unscaled features of the beans in the order of `feature_names`.
+        clusters (`numpy.ndarray`): Cluster of every bean.
+        feature_names (`:obj:`list` of :obj:`str`): List of feature names.
+        stats_path (`str`): Path to save the statistics.
+        n_bins (`int`): Number of histogram bins per feature, for the quantiles.
+        margin (`float`): Room left in the histograms for later beans outside of the range of these, as a
+            fraction of the range.
+    Returns:
+        stats (`cluster_stats.ClusterStats`): The saved statistics.
+    """
+
+    stats = ClusterStats.for_data(feature_names, raw_features, n_bins=n_bins, margin=margin)
+    stats.update(clusters, raw_features)
+    stats.save(stats_path)
+    logger.info("Statistics of %d clusters saved to %s", len(stats.clusters), stats_path)
+    return stats
+
+
+@metrics.timed('train_model.save_inference_artifact')
+def save_inference_artifact(feat_scaler, kmeans_model, artifact_path):
+    """Save the parameters needed for inference as a compact `.npz` file that loads without sklearn.
+    Args:
+        feat_scaler (`sklearn.preprocessing._data.StandardScaler`): Scaler for standardizing the features.
+        kmeans_model (`sklearn.cluster.KMeans`): Trained model object.
+        artifact_path (`str`): Path to save the inference artifact.
+    Returns:
+        None.
+    """
+
+    np.savez(artifact_path, mean=feat_scaler.mean_, scale=feat_scaler.scale_,
+             centroids=kmeans_model.cluster_centers_)
+    logger.info("Inference artifact saved to %s", artifact_path)
+
+
+@metrics.timed('train_model.save_similarity_index')
+def save_similarity_index(feat_scaler, kmeans_model, ids, raw_features, index_path, exact_max=50000, list_size=1000,
+                          random_state=None):
+    """Build the nearest-neighbour index of the catalog in the scaled feature space and save it as a `.npz` file.
+    Args:
+        feat_scaler (`sklearn.preprocessing._data.StandardScaler`): Scaler for standardizing the features.
+        kmeans_model (`sklearn.cluster.KMeans`): Trained model object, its clusters partition the index.
+        ids (`numpy.ndarray`): Bean ids.
+        raw_features (`numpy.ndarray`): Unscaled features of the beans in the order of `feature_names`.
+        index_path (`str`): Path to save the index.
+        exact_max (`int`): Catalogs of up to this many beans get an exact index, larger ones an IVF index.
+        list_size (`int`): Approximate number of beans per list of an IVF index.
+        random_state (`int`): Seed for fitting the list centroids.
+    Returns:
+        index (`similarity.SimilarityIndex`): The saved index.
+    """
+
+    start = time.perf_counter()
+    index = SimilarityIndex.build(feat_scaler.mean_, feat_scaler.scale_, ids, raw_features,
+                                  kmeans_model.cluster_centers_, exact_max=exact_max, list_size=list_size,
+                                  random_state=random_state)
+    index.save(index_path)
+    logger.info("%s similarity index of %d beans saved to %s in %.2f seconds",
+                'Exact' if index.is_exact else 'IVF', index.n_beans, index_path, time.perf_counter() - start)
+    return index
+
+
 def predict_cluster(feat_scaler, raw_features, kmeans_model):
     """Predict the clusters.
     Args:
@@ -207,6 +480,21 @@ def predict_cluster(feat_scaler, raw_features, kmeans_model):
     return clusters
 
 
+@metrics.timed('train_model.predict_cluster_batch')
+def predict_cluster_batch(feat_scaler, raw_features, kmeans_model):
+    """Predict the clusters of a batch of feature vectors with the NumPy predictor the app serves.
+    Args:
+        feat_scaler (`sklearn.preprocessing._data.StandardScaler`): Scaler for standardizing the features.
+        raw_features (`numpy.ndarray`): Array of unscaled features, one row per sample in the order of `feature_names`.
+        kmeans_model (`sklearn.cluster.KMeans`): Trained model object.
+    Returns:
+        clusters (`numpy.ndarray`): Array of predicted clusters.
+    """
+
+    return CentroidPredictor.from_models(feat_scaler, kmeans_model).predict(raw_features)
+
+
+@metrics.timed('train_model.save_csv')
 def save_csv(data, data_path):
     """Save the data frame.
     Args:
@@ -228,25 +516,53 @@ if __name__ == "__main__":
     The script trains a logistic/svm model on the training data and calculates predicted values for the test data.
     """
 
+    metrics.start_run('train_model', config.METRICS_ENABLED, config.METRICS_REPORT_DIR)
+    Profiler(config.PROFILE_DIR, config.PROFILE_SAMPLE_RATE, config.PROFILE_TOP_N,
+             config.PROFILE_MAX_FILES).start_run('train_model')
+
     with open(config.YAML_PATH, "r") as f:
         config = yaml.load(f, Loader=yaml.FullLoader)
 
     config_tm = config["train_model"]
+    feature_names = config['generate_feature']['feature_split']['feature_names']
+    storage_format = config['storage']['format']
+    path_csv = config['generate_feature']['save_csv']['data_path']
+    path_full = resolve_path(path_csv, storage_format)
+
+    # The mini-batch backend streams the features from the csv or parquet file in chunks, the k sweep and model
+    # comparison use the first chunk
+    streaming = config_tm['train_model'].get('backend', 'kmeans') == 'minibatch'
+    chunk_size = config_tm['read_chunks']['chunk_size']
+    if streaming and storage_format == 'feather':
+        logger.error("Feather files cannot be read and written in chunks, set storage: format: to csv or parquet or "
+                     "use the kmeans backend")
+        sys.exit(1)
 
     try:
         logger.debug("Loading data")
-        path_full = config['generate_feature']['save_csv']['data_path']
-        data_full = read_data(path_full)
-        data_model = feature_split(data_full, **config['generate_feature']['feature_split'])
+        if streaming:
+            data_model = next(read_chunks(path_full, feature_names, chunk_size))
+        else:
+            # Only the features are needed for fitting, the other columns are read when saving the clusters
+            data_model = read_data(path_full, columns=feature_names)
         logger.info("Successfully loaded the data for modeling")
     except Exception as e:
         logger.error("Failed to load the data for modeling.", e)
         sys.exit(1)
 
     try:
-        feature_names = config['generate_feature']['feature_split']['feature_names']
-        data_scaler = get_scaler(data_model, feature_names, **config_tm['get_scaler'])
-        data = stand_feat(data_model, feature_names, data_scaler)
+        if streaming and config_tm['train_model'].get('init_model_path'):
+            # Keep the scaler of the model being updated so that its centroids stay valid
+            with open(config_tm['get_scaler']['feature_scaler_path'], "rb") as f:
+                data_scaler = pickle.load(f)
+            data = data_scaler.transform(data_model)
+        elif streaming:
+            data_scaler = get_scaler(read_chunks(path_full, feature_names, chunk_size), feature_names,
+                                     **config_tm['get_scaler'])
+            data = data_scaler.transform(data_model)
+        else:
+            data_scaler = get_scaler(data_model, feature_names, **config_tm['get_scaler'])
+            data = stand_feat(data_model, feature_names, data_scaler)
     except Exception as e:
         logger.error("Failed to standardize the features")
         logger.error(e)
@@ -257,7 +573,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
     try:
-        plot_sil_iner(data, **config_tm['plot_sil_iner'])
+        plot_sil_iner(data, **config_tm['plot_sil_iner'], skip_unchanged=config['render']['skip_unchanged'])
         logger.info("Successfully created and saved the silhouette and inertia plots")
     except Exception as e:
         logger.error("Failed to create the silhouette and inertia plots")
@@ -266,17 +582,75 @@ if __name__ == "__main__":
 
     try:
         logger.debug("Fitting model")
-        model = train_model(data, **config_tm['train_model'])
-        clusters_pred = predict_cluster(data_scaler, data_model, model)
+        if streaming:
+            scaled_chunks = (data_scaler.transform(chunk) for chunk in read_chunks(path_full, feature_names,
+                                                                                    chunk_size))
+            model = train_model(scaled_chunks, **config_tm['train_model'])
+            reference_model = KMeans(n_clusters=config_tm['train_model']['k_chosen'],
+                                     random_state=config_tm['train_model']['random_state']).fit(data)
+            compare_models(data, model, reference_model)
+        else:
+            model = train_model(data, **config_tm['train_model'])
+            clusters_pred = predict_cluster(data_scaler, data_model, model)
+        artifact_name = 'kmeans-' + str(config_tm['train_model']['k_chosen']) + '-' + now + '.npz'
+        save_inference_artifact(data_scaler, model, os.path.join(config_tm['train_model']['save_tmo_path'],
+                                                                 artifact_name))
         logger.info("Successfully fitted and saved the model")
     except Exception as e:
         logger.error("Failed to fit the model.", e)
         sys.exit(1)
 
+    stats_name = 'kmeans-' + str(config_tm['train_model']['k_chosen']) + '-' + now + '.stats.npz'
+    stats_path = os.path.join(config_tm['train_model']['save_tmo_path'], stats_name)
+    if streaming:
+        try:
+            # The statistics are accumulated chunk by chunk, their histogram range is set by the first chunk
+            stats = ClusterStats.for_data(feature_names, data_model.values, **config_tm['cluster_stats'])
+            save_clusters_streaming(path_full, feature_names, data_scaler, model, chunk_size=chunk_size,
+                                    stats=stats, fmt=storage_format, export_csv=config['storage']['export_csv'],
+                                    **config_tm['save_csv'])
+            stats.save(stats_path)
+            logger.info("Statistics of %d clusters saved to %s", len(stats.clusters), stats_path)
+            logger.info("Predictions for clusters successfully created and saved")
+        except Exception as e:
+            logger.error("Failed to make predictions of the clusters")
+            logger.error(e)
+            sys.exit(1)
+    else:
+        try:
+            data_full = read_data(path_full)
+            data_full['cluster'] = clusters_pred
+            logger.info("Predictions for clusters successfully created and saved")
+        except Exception as e:
+            logger.error("Failed to make predictions of the clusters")
+
+        if storage_format != 'csv':
+            write_table(data_full, resolve_path(config_tm['save_csv']['data_path'], storage_format), storage_format)
+        if storage_format == 'csv' or config['storage']['export_csv']:
+            save_csv(data_full, **config_tm['save_csv'])
+
+        try:
+            save_cluster_stats(data_model.values, clusters_pred, feature_names, stats_path,
+                               **config_tm['cluster_stats'])
+        except Exception as e:
+            logger.error("Failed to save the cluster statistics")
+            logger.error(e)
+            sys.exit(1)
+
     try:
-        data_full['cluster'] = clusters_pred
-        logger.info("Predictions for clusters successfully created and saved")
+        config_index = config_tm['similarity_index']
+        columns = [config_index['id_column']] + feature_names
+        if streaming:
+            ids, raw_features = read_index_arrays(path_full, config_index['id_column'], feature_names, chunk_size)
+        else:
+            ids, raw_features = data_full[config_index['id_column']].values, data_full[feature_names].values
+        index_name = 'kmeans-' + str(config_tm['train_model']['k_chosen']) + '-' + now + '.index.npz'
+        save_similarity_index(data_scaler, model, ids, raw_features,
+                              os.path.join(config_tm['train_model']['save_tmo_path'], index_name),
+                              exact_max=config_index['exact_max'], list_size=config_index['list_size'],
+                              random_state=config_tm['train_model']['random_state'])
+        logger.info("Successfully built and saved the similarity index")
     except Exception as e:
-        logger.error("Failed to make predictions of the clusters")
-
-    save_csv(data_full, **config_tm['save_csv'])
+        logger.error("Failed to build the similarity index")
+        logger.error(e)
+        sys.exit(1)
@@ -1,6 +1,6 @@
-import boto3
 import os
 import sys
+import tempfile
 import logging.config
 import logging
 from botocore.exceptions import ClientError
@@ -8,15 +8,19 @@ from botocore.exceptions import ClientError
 sys.path.append('./config')
 import config
 
-logging.config.fileConfig(config.LOGGING_CONFIG)
+sys.path.append('./src')
+from s3_transfer import s3_client, upload
+from partitions import write_partitions, upload_dataset
+
+logging.config.fileConfig(config.LOGGING_CONFIG, disable_existing_loggers=False)
 logger = logging.getLogger('write_to_s3')
 
 if __name__ == "__main__":
-    """Write the data object to S3 bucket. 
+    """Write the data object, or its partitions that changed, to S3 bucket.
     """
 
     S3_BUCKET_NAME = config.S3_BUCKET_NAME
-    S3_OBJECT_NAME = config.S3_OBJECT_NAME
+    S3_OBJECT_NAME = config.S3_DATASET_PREFIX if config.S3_PARTITIONED else config.S3_OBJECT_NAME
     S3_PUBLIC_KEY = os.environ.get("AWS_ACCESS_KEY_ID")
     S3_SECRET_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
     DOWNLOADED_DATA_PATH = config.DOWNLOADED_DATA_PATH
@@ -27,14 +31,23 @@ if __name__ == "__main__":
             logger.error("Empty info for DOWNLOADED_DATA_PATH and S3 bucket in config.py")
             sys.exit(1)
 
-    s3 = boto3.client('s3', aws_access_key_id=S3_PUBLIC_KEY, aws_secret_access_key=S3_SECRET_KEY)
+    s3 = s3_client(S3_PUBLIC_KEY, S3_SECRET_KEY, config.S3_ENDPOINT_URL, config.S3_MAX_CONCURRENCY)
 
     try:
-        s3.upload_file(DOWNLOADED_DATA_PATH, S3_BUCKET_NAME, S3_OBJECT_NAME)
-        logger.info('Data successfully write to the S3 bucket {} with name {}'.format(S3_BUCKET_NAME,
-                                                                                      S3_OBJECT_NAME))
+        if config.S3_PARTITIONED:
+            # pandas is only needed to split the data into partitions
+            import pandas as pd
+            with tempfile.TemporaryDirectory() as dataset_dir:
+                write_partitions(pd.read_csv(DOWNLOADED_DATA_PATH), dataset_dir, config.S3_PARTITION_BY,
+                                 config.S3_COMPRESSION)
+                upload_dataset(s3, dataset_dir, S3_BUCKET_NAME, S3_OBJECT_NAME,
+                               max_concurrency=config.S3_MAX_CONCURRENCY, chunk_size_mb=config.S3_CHUNK_SIZE_MB)
+            logger.info('Partitions successfully written to the S3 bucket {} under {}'.format(S3_BUCKET_NAME,
+                                                                                             S3_OBJECT_NAME))
+        elif upload(s3, DOWNLOADED_DATA_PATH, S3_BUCKET_NAME, S3_OBJECT_NAME, chunk_size_mb=config.S3_CHUNK_SIZE_MB,
+                    max_concurrency=config.S3_MAX_CONCURRENCY, skip_unchanged=config.S3_SKIP_UNCHANGED):
+            logger.info('Data successfully write to the S3 bucket {} with name {}'.format(S3_BUCKET_NAME,
+                                                                                          S3_OBJECT_NAME))
     except ClientError as e:
-        logger.error("Error occurred with the S3 client.", e)
+        logger.error("Error occurred with the S3 client. %s", e)
         sys.exit(1)
-
-